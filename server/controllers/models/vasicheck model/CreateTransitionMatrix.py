@@ -1,6 +1,17 @@
+import importlib.util
+import os
 import pandas as pd
 import numpy as np
 
+# Transition counting engine of the Django app (Functions/transition_counts.py), which this
+# standalone script cannot import as a package
+_engine_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'django files', 'Functions', 'transition_counts.py'
+)
+_engine_spec = importlib.util.spec_from_file_location('transition_counts', _engine_path)
+transition_counts = importlib.util.module_from_spec(_engine_spec)
+_engine_spec.loader.exec_module(transition_counts)
+
 def create_transition_matrix(data, start_col, end_col, states):
     """
     Create a transition matrix from account-level data.
@@ -14,12 +25,11 @@ def create_transition_matrix(data, start_col, end_col, states):
     Returns:
         Transition matrix (counts and probabilities)
     """
-    # Initialize matrix
-    tm_counts = pd.DataFrame(0, index=states, columns=states, dtype=int)
-    
-    # Count transitions
-    for _, row in data.iterrows():
-        tm_counts.loc[row[start_col], row[end_col]] += 1
+    # Count transitions: states are mapped to their index in states and counted in one bincount
+    tm_counts = pd.DataFrame(
+        transition_counts.count_code_transitions(data[start_col].to_numpy(), data[end_col].to_numpy(), states),
+        index=states, columns=states,
+    )
     
     # Convert counts to probabilities
     tm_probs = tm_counts.div(tm_counts.sum(axis=1), axis=0)
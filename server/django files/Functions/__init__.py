@@ -25,3 +25,5 @@ from .cal_forward_exposure4 import *
 from .calculate_marginal_pd import *
 from .populate_reporting_table import *
 from .calculate_ecl import *
+from .fused_cash_flow_chain import *
+from .ecl_summary_cube import *
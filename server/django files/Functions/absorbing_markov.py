@@ -0,0 +1,73 @@
+import numpy as np
+from django.conf import settings
+
+# Number of periods the cumulative PD is computed over; None is the probability of ever reaching default
+CUMULATIVE_PD_HORIZON = getattr(settings, 'CUMULATIVE_PD_HORIZON', None)
+
+
+def build_transition_matrices(flows_df, key_columns, code_order, min_probability=0.0):
+    """
+    Dense transition matrices of the flow rates in flows_df (columns v_credit_risk_basis_cd_from,
+    v_credit_risk_basis_cd_to and n_transition_prob), one per distinct value of key_columns,
+    e.g. (transition_date, v_combined_group). Flows between codes not in code_order are ignored.
+
+    :param min_probability: Probability used for flows with a zero probability (smoothing).
+    :return: (keys, matrices, observed):
+        keys: DataFrame of the key_columns values, in order of first appearance.
+        matrices: array (keys, codes, codes); matrices[k, i, j] = probability of moving from code i to j.
+        observed: bool array (keys, codes); True for the codes with at least one flow out.
+    """
+    code_index = {code: index for index, code in enumerate(code_order)}
+    from_index = flows_df['v_credit_risk_basis_cd_from'].str.lower().map(code_index)
+    to_index = flows_df['v_credit_risk_basis_cd_to'].str.lower().map(code_index)
+    known = (from_index.notna() & to_index.notna()).to_numpy()
+    flows_df = flows_df[known]
+
+    keys = flows_df[key_columns].drop_duplicates().reset_index(drop=True)
+    key_index = flows_df[key_columns].merge(keys.reset_index(), on=key_columns, how='left')['index'].to_numpy()
+    from_index = from_index[known].to_numpy(dtype=np.int64)
+    to_index = to_index[known].to_numpy(dtype=np.int64)
+    probabilities = flows_df['n_transition_prob'].astype(float).to_numpy()
+    probabilities = np.where(probabilities > 0, probabilities, min_probability)
+
+    code_count = len(code_order)
+    matrices = np.zeros((len(keys), code_count, code_count))
+    np.add.at(matrices, (key_index, from_index, to_index), probabilities)
+    observed = np.zeros((len(keys), code_count), dtype=bool)
+    observed[key_index, from_index] = True
+    return keys, matrices, observed
+
+
+def absorption_probabilities(matrices, default_index, horizon=None):
+    """
+    Probability of reaching the default code from every code, for all matrices at once. The
+    default code is made absorbing.
+
+    Without horizon this is the probability of ever defaulting: b solves (I - Q) b = r, where Q
+    holds the transitions between the other (transient) codes and r the transitions into
+    default. With horizon h, it is the probability of having defaulted within h periods, the
+    default column of P^h.
+
+    :param matrices: Array (keys, codes, codes) of one-period transition probabilities.
+    :return: Array (keys, codes); the default code's probability is 1.
+    """
+    matrices = matrices.copy()
+    matrices[:, default_index, :] = 0.0
+    matrices[:, default_index, default_index] = 1.0
+    if horizon is not None:
+        return np.linalg.matrix_power(matrices, int(horizon))[:, :, default_index]
+
+    code_count = matrices.shape[-1]
+    transient = np.arange(code_count) != default_index
+    q = matrices[:, transient][:, :, transient]
+    r = matrices[:, transient, default_index]
+    identity = np.eye(code_count - 1)
+    try:
+        solved = np.linalg.solve(identity - q, r[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        # Codes that only lead to each other, never to default, make I - Q singular
+        solved = np.stack([np.linalg.lstsq(identity - q_k, r_k, rcond=None)[0] for q_k, r_k in zip(q, r)])
+
+    result = np.ones((len(matrices), code_count))
+    result[:, transient] = solved
+    return result
@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection
+
+# Default number of keys (accounts, primary keys) per batch
+KEY_BATCH_SIZE = 5000
+
+
+def get_key_ranges(table_name, key_column, where='TRUE', params=None, batch_size=None):
+    """
+    Split the distinct values of key_column in table_name into consecutive ranges of batch_size
+    keys, computed in a single scan.
+
+    Ranges are disjoint and cover whole keys: with key_column = the account number, every row of
+    an account falls in exactly one range, however many rows it has. Filter a batch with
+    `key_column BETWEEN first AND last`, which uses the key's index instead of an OFFSET.
+
+    :param where: SQL condition selecting the rows to split, with %s placeholders for params.
+    :return: List of (first_key, last_key) tuples in key order.
+    """
+    batch_size = batch_size or KEY_BATCH_SIZE
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT MIN(k), MAX(k)
+            FROM (
+                SELECT k, (ROW_NUMBER() OVER (ORDER BY k) - 1) / %s AS batch
+                FROM (SELECT DISTINCT {key_column} AS k FROM {table_name} WHERE {where}) keys
+            ) numbered
+            GROUP BY batch
+            ORDER BY batch;
+        """, [batch_size] + list(params or []))
+        return cursor.fetchall()
+
+
+def hash_bucket_condition(key_column, bucket_count):
+    """
+    SQL condition selecting one of bucket_count hash buckets of key_column; pass the bucket
+    number (0 to bucket_count - 1) as its parameter. Buckets are disjoint and keep all rows of
+    a key together, without the keys having to be sorted or known in advance.
+    """
+    return f"mod(hashtext({key_column}::text) & 2147483647, {int(bucket_count)}) = %s"
+
+
+def shard_filter(key_column, shard):
+    """
+    (' AND condition', params) restricting key_column to shard = (index, count), or ('', [])
+    when shard is None, ready to append to a WHERE clause.
+    """
+    if shard is None:
+        return '', []
+    index, count = shard
+    return f" AND {hash_bucket_condition(key_column, count)}", [index]
+
+
+def run_batches(batches, process_batch, max_workers=4):
+    """
+    Run process_batch(batch) for every batch on a thread pool, re-raising the first error. Each
+    worker thread closes its database connection when its batch is done.
+
+    :return: List of the results, in batch order.
+    """
+    def run(batch):
+        try:
+            return process_batch(batch)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, batches))
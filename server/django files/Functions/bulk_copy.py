@@ -0,0 +1,113 @@
+import io
+import math
+import time
+from django.db import connection
+from .query_recorder import record_query
+
+# Number of rows buffered in memory before each COPY round-trip
+COPY_CHUNK_SIZE = 100000
+
+
+def format_copy_value(value, significant_digits=20):
+    """
+    Format a single value for PostgreSQL COPY text format.
+
+    Floats are written with the same number of significant digits Django uses when it
+    converts a float for a DecimalField (max_digits), so COPY and bulk_create round identically.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return '\\N'
+        return '%.*g' % (significant_digits, value)
+    text = str(value)
+    return (
+        text.replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r')
+    )
+
+
+def copy_rows(table_name, columns, rows, significant_digits=20, chunk_size=COPY_CHUNK_SIZE):
+    """
+    Stream an iterable of row tuples into table_name using PostgreSQL COPY FROM STDIN.
+
+    Rows are buffered in chunks of chunk_size so very large result sets never have to be
+    materialised as a single string. Run inside transaction.atomic() when the load must be
+    all-or-nothing.
+
+    :param table_name: Target table.
+    :param columns: Column names, in the same order as the values of each row.
+    :param rows: Iterable of tuples/lists.
+    :param significant_digits: Digits used when formatting float values.
+    :param chunk_size: Number of rows sent per COPY statement.
+    :return: Number of rows copied.
+    """
+    sql = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN"
+    total = 0
+
+    with connection.cursor() as cursor:
+        buffer = io.StringIO()
+        pending = 0
+        for row in rows:
+            buffer.write('\t'.join(format_copy_value(value, significant_digits) for value in row))
+            buffer.write('\n')
+            pending += 1
+            if pending >= chunk_size:
+                buffer.seek(0)
+                run_copy(cursor, sql, buffer, pending)
+                total += pending
+                buffer = io.StringIO()
+                pending = 0
+
+        if pending:
+            buffer.seek(0)
+            run_copy(cursor, sql, buffer, pending)
+            total += pending
+
+    return total
+
+
+def run_copy(cursor, sql, buffer, row_count):
+    # copy_expert bypasses the connection's execute wrappers; report it to the step metrics
+    started = time.perf_counter()
+    cursor.copy_expert(sql, buffer)
+    record_query(time.perf_counter() - started, row_count)
+
+
+def update_from_rows(table_name, key_column, key_type, columns, column_type, rows, significant_digits=20):
+    """
+    Set-based UPDATE of table_name from an iterable of (key, value1, value2, ...) tuples.
+
+    The rows are COPYed into a temp table and applied with a single UPDATE ... FROM, instead of
+    one UPDATE per row or a bulk_update CASE statement. Must run inside transaction.atomic(); the
+    temp table is dropped on commit.
+
+    :param table_name: Table to update.
+    :param key_column: Column matched against the first value of each row.
+    :param key_type: SQL type of the key column (e.g. 'BIGINT').
+    :param columns: Columns to set, in the same order as the remaining values of each row.
+    :param column_type: SQL type used for the value columns in the temp table (e.g. 'NUMERIC').
+    :return: Number of rows updated.
+    """
+    temp_table = f"tmp_{table_name}_update"
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {temp_table}")
+        cursor.execute(
+            f"CREATE TEMP TABLE {temp_table} ({key_column} {key_type} PRIMARY KEY, "
+            + ', '.join(f"{column} {column_type}" for column in columns)
+            + ") ON COMMIT DROP"
+        )
+
+    copy_rows(temp_table, [key_column] + list(columns), rows, significant_digits=significant_digits)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"ANALYZE {temp_table}")
+        cursor.execute(
+            f"UPDATE {table_name} AS target SET "
+            + ', '.join(f"{column} = src.{column}" for column in columns)
+            + f" FROM {temp_table} AS src WHERE target.{key_column} = src.{key_column}"
+        )
+        return cursor.rowcount
@@ -1,20 +1,7 @@
 from django.db import connection, transaction
-from IFRS9.models import Dim_Run
 from .save_log import save_log
+from .reference_data import get_latest_run_skey
 
-def get_latest_run_skey():
-    """
-    Retrieve the latest_run_skey from Dim_Run table.
-    """
-    try:
-        run_record = Dim_Run.objects.only('latest_run_skey').first()
-        if not run_record:
-            save_log('get_latest_run_skey', 'ERROR', "No run key available.")
-            return None
-        return run_record.latest_run_skey
-    except Exception as e:
-        save_log('get_latest_run_skey', 'ERROR', str(e))
-        return None
 
 def calculate_cashflow_fields(fic_mis_date):
     """
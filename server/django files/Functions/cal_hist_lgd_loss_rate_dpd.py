@@ -14,12 +14,12 @@ from IFRS9.models import (
     Ldn_LGD_Detailed,        # Detailed default event calculations per account
     Ldn_LGD_Aggregated,      # Aggregated LGD by segment
     Ldn_LGD_Default_Band,    # Dynamic default band configuration per segment
-    FSI_Product_Segment,     # Product segment model for segment_id
     Credit_Rating_Code_Band, # Rating codes for rating-based term structures
     FSI_LGD_Term_Structure   # The model to save overall LGD when rating/delinquency based
 )
 from django.conf import settings
 from .save_log import save_log
+from .reference_data import get_run_context
 
 # Define EPSILON as a Decimal to avoid float/Decimal issues.
 EPSILON = Decimal("0.000001")
@@ -299,9 +299,10 @@ def save_lgd_overall(fic_mis_date, segment_lgd_df):
                 return Decimal("0.00")
             return Decimal(str(num))
 
+        context = get_run_context()
         for _, row in segment_lgd_df.iterrows():
             segment_id = row['n_segment_skey']
-            product_segment = FSI_Product_Segment.objects.get(segment_id=segment_id)
+            product_segment = context.get_product_segment(segment_id)
             seg_lgd = safe_decimal(row['segment_lgd'])
 
             # (1) Save a record in Ldn_LGD_Term_Structure 
@@ -325,16 +326,18 @@ def save_lgd_overall(fic_mis_date, segment_lgd_df):
 
             # (3) Retrieve or create the Ldn_PD_Term_Structure instance 
             #     because FSI_LGD_Term_Structure references that.
-            ldn_pd_ts, created = Ldn_PD_Term_Structure.objects.get_or_create(
-                v_pd_term_structure_id=segment_id,
-                defaults={
-                    # If needed, fill required fields for Ldn_PD_Term_Structure
-                    'v_pd_term_structure_name': product_segment,
-                    'v_pd_term_frequency_unit': 'M',  # or Q/H/Y if you want
-                    'v_pd_term_structure_type': 'D', # or 'R' if rating-based
-                    'fic_mis_date': fic_mis_date,
-                }
-            )
+            ldn_pd_ts = context.get_pd_term_structure(segment_id)
+            if ldn_pd_ts is None:
+                ldn_pd_ts, created = Ldn_PD_Term_Structure.objects.get_or_create(
+                    v_pd_term_structure_id=segment_id,
+                    defaults={
+                        # If needed, fill required fields for Ldn_PD_Term_Structure
+                        'v_pd_term_structure_name': product_segment,
+                        'v_pd_term_frequency_unit': 'M',  # or Q/H/Y if you want
+                        'v_pd_term_structure_type': 'D', # or 'R' if rating-based
+                        'fic_mis_date': fic_mis_date,
+                    }
+                )
 
             # (4) For each code, create an FSI_LGD_Term_Structure row referencing the Ldn_PD_Term_Structure instance
             for single_code in codes_list:
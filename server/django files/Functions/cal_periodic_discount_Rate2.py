@@ -9,28 +9,12 @@ from datetime import datetime
 
 # Import your logging utility
 from .save_log import save_log  # Adjust the import path as necessary
-from IFRS9.models import Dim_Run
+from .reference_data import get_latest_run_skey
 
 # Define EIR boundaries (as decimal fractions)
 MAX_EIR = Decimal('9.9999999999999')  # Max value as decimal fraction (999.99999999999%)
 MIN_EIR = Decimal('0')                # Minimum EIR value (0%)
 
-def get_latest_run_skey():
-    """
-    Retrieve the latest_run_skey from Dim_Run table.
-    """
-    try:
-        run_record = Dim_Run.objects.only('latest_run_skey').first()
-        if not run_record:
-            save_log('get_latest_run_skey', 'ERROR', "No run key is available in Dim_Run")
-            return None
-        return run_record.latest_run_skey
-    except Dim_Run.DoesNotExist:
-        save_log('get_latest_run_skey', 'ERROR', "Dim_Run table is missing.")
-        return None
-    except Exception as e:
-        save_log('get_latest_run_skey', 'ERROR', f"Error retrieving latest run key: {e}")
-        return None
 
 def calculate_discount_factors(fic_mis_date):
     """
@@ -13,15 +13,30 @@ from IFRS9.models import (
     FSITransitionMatrix,      # New model for raw transition counts.
     Ldn_PD_Term_Structure_Dtl,
     FSICUMULATIVEPD,
+    FSITransitionCount,
     Ldn_PD_Term_Structure,  # Used to retrieve frequency unit and structure type.
     HistoricalDateRange
 )
 
 # Import the logging function.
 from .save_log import save_log
+from .reference_data import get_run_context
+from .absorbing_markov import CUMULATIVE_PD_HORIZON, absorption_probabilities, build_transition_matrices
+from .transition_counts import adjacent_flow_rates_from_counts
+from .transition_history import (
+    TRANSITION_HISTORY_INCREMENTAL,
+    count_and_save_transitions,
+    delete_transition_counts,
+    get_pair_periods,
+    get_partition_fingerprints,
+    get_stale_pairs,
+    period_filter,
+    plan_transition_pairs,
+)
 
 EPSILON = 1e-6  # Small value to avoid division by zero
 MIN_TRANSITION_PROB = 0.001  # Smoothing threshold for zero transition probability
+DEFAULT_BAND = "90+"  # Absorbing band of the cumulative PD
 
 # ---------------------------------------------------------------------
 # Decorator to log entry, exit, and errors for each function.
@@ -62,11 +77,12 @@ def get_band_order():
     return [band.n_delq_band_code.lower() for band in bands]
 
 @log_function
-def load_stage_data():
+def load_stage_data(periods=None):
     """
     Load raw delinquency data from FCT_Stage_Determination into a DataFrame.
     Filters records whose n_segment_skey appears in Ldn_PD_Term_Structure (v_pd_term_structure_type = 'D').
     Fields: fic_mis_date, n_segment_skey, n_prod_type, n_delq_band_code, v_amrt_term_unit, n_account_number.
+    With periods (monthly Periods), only the rows of those periods are loaded.
     """
     dpd_segments = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_type='D').values_list('v_pd_term_structure_id', flat=True)
     # Example: retrieve the first date range from your HistoricalDateRange table.
@@ -76,7 +92,10 @@ def load_stage_data():
             n_segment_skey__in=list(dpd_segments),
             fic_mis_date__gte=date_range.start_date,
             fic_mis_date__lte=date_range.end_date
-        ).values(
+        )
+        if periods is not None:
+            qs = qs.filter(period_filter(periods))
+        qs = qs.values(
             'fic_mis_date', 
             'n_segment_skey', 
             'n_prod_type', 
@@ -179,49 +198,38 @@ def build_group_default_band_mapping(stage_data_df):
     return mapping
 
 @log_function
-def compute_transition_counts_by_period(df_group, previous_period, current_period, band_order):
+def compute_transition_counts(stage_data_df, band_order, pairs_df):
     """
-    For a given group and adjacent periods (previous_period and current_period),
-    compute transition counts only for accounts common to both periods.
-    
+    Compute the transition counts of the period pairs in pairs_df (see transition_history) in one pass,
+    only for accounts common to both periods, and store them in FSITransitionCount.
+
     For each adjacent pair in band_order, count:
       - n_prev_period_accounts: unique accounts in previous_period for that band (that also appear in current_period)
       - n_next_period_accounts: unique accounts in current_period for the adjacent band (common accounts)
       - transition_prob = n_next_period_accounts / (n_prev_period_accounts + EPSILON)
-    
+
     Returns a DataFrame with columns:
-      v_combined_group, prev_delq_band, n_delq_band_code_to, n_prev_period_accounts, n_next_period_accounts, transition_prob.
+      v_combined_group, previous_period, current_period, prev_delq_band, n_delq_band_code_to,
+      n_prev_period_accounts, n_next_period_accounts, transition_prob.
     """
-    df_prev = df_group[df_group['period'] == previous_period].copy()
-    df_curr = df_group[df_group['period'] == current_period].copy()
-    
-    # Standardize band codes to lowercase.
-    df_prev['n_delq_band_code'] = df_prev['n_delq_band_code'].str.lower()
-    df_curr['n_delq_band_code'] = df_curr['n_delq_band_code'].str.lower()
-    
-    # Consider only accounts present in both periods.
-    common_accounts = set(df_prev['n_account_number'].unique()).intersection(set(df_curr['n_account_number'].unique()))
-    
-    records = []
-    for i in range(len(band_order) - 1):
-        prev_band = band_order[i]
-        next_band = band_order[i + 1]
-        accounts_prev = set(df_prev[df_prev['n_delq_band_code'] == prev_band]['n_account_number'].unique())
-        common_prev = accounts_prev.intersection(common_accounts)
-        accounts_next = set(df_curr[df_curr['n_delq_band_code'] == next_band]['n_account_number'].unique())
-        common_transition = common_prev.intersection(accounts_next)
-        n_prev = len(common_prev)
-        n_next = len(common_transition)
-        prob = n_next / (n_prev + EPSILON) if n_prev > 0 else 0.0
-        records.append({
-            'v_combined_group': df_group['v_combined_group'].iloc[0],
-            'prev_delq_band': prev_band,
-            'n_delq_band_code_to': next_band,
-            'n_prev_period_accounts': n_prev,
-            'n_next_period_accounts': n_next,
-            'transition_prob': prob
-        })
-    return pd.DataFrame(records)
+    pairs, counts, totals = count_and_save_transitions('D', stage_data_df, 'n_delq_band_code', band_order, pairs_df)
+    return adjacent_flow_rates_from_counts(pairs, counts, totals, band_order, 'prev_delq_band', 'n_delq_band_code_to')
+
+@log_function
+def clear_transition_history(group, transition_date, band_codes):
+    """
+    Delete the flow rates and transition counts of a group for one transition date before they are recomputed.
+    """
+    FSITransitionMatrix.objects.filter(
+        fic_mis_date=transition_date,
+        v_combined_group=group,
+        v_credit_risk_basis_cd_from__in=band_codes
+    ).delete()
+    FSIFlowRateHistory.objects.filter(
+        fic_mis_date=transition_date,
+        v_combined_group=group,
+        v_credit_risk_basis_cd_from__in=band_codes
+    ).delete()
 
 @log_function
 def save_flow_rates_to_history(flow_rates_df, transition_date):
@@ -231,11 +239,12 @@ def save_flow_rates_to_history(flow_rates_df, transition_date):
     """
     records = []
     group_to_seg = get_group_to_segments_mapping()
+    context = get_run_context()
     for _, row in flow_rates_df.iterrows():
         group = row['v_combined_group']
         seg_list = group_to_seg.get(group, [])
         segment_key = seg_list[0] if seg_list else group
-        instance = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_id=segment_key).first()
+        instance = context.get_pd_term_structure(segment_key)
         if not instance:
             raise ValueError(f"No instance for segment key {segment_key} on {transition_date}")
         record = FSIFlowRateHistory(
@@ -261,11 +270,12 @@ def save_transition_matrix(counts_df, transition_date, group_prod_type):
     """
     records = []
     group_to_seg = get_group_to_segments_mapping()
+    context = get_run_context()
     for _, row in counts_df.iterrows():
         group = row['v_combined_group']
         seg_list = group_to_seg.get(group, [])
         segment_key = seg_list[0] if seg_list else group
-        instance = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_id=segment_key).first()
+        instance = context.get_pd_term_structure(segment_key)
         if not instance:
             raise ValueError(f"No instance for segment key {segment_key} on {transition_date}")
         record = FSITransitionMatrix(
@@ -331,9 +341,14 @@ def compute_and_save_cumulative_pd(fic_mis_date):
     """
     Computes cumulative PD per transition date for each delinquency band and saves it into FSICUMULATIVEPD.
     Applies a smoothing threshold (MIN_TRANSITION_PROB) for zero transition probabilities.
+
+    The flow rates of every (transition date, group) form a transition matrix with DEFAULT_BAND absorbing;
+    the cumulative PD of a band is its probability of absorption into DEFAULT_BAND (within
+    CUMULATIVE_PD_HORIZON periods when set), solved for all groups at once.
     """
     try:
-        flow_rates_qs = FSIFlowRateHistory.objects.filter(fic_mis_date=fic_mis_date)
+        band_codes = get_band_order()
+        flow_rates_qs = FSIFlowRateHistory.objects.filter(fic_mis_date=fic_mis_date, v_credit_risk_basis_cd_from__in=band_codes)
         if not flow_rates_qs.exists():
             save_log("compute_and_save_cumulative_pd", "WARNING", f"No transition data for {fic_mis_date}")
             return 0
@@ -345,46 +360,41 @@ def compute_and_save_cumulative_pd(fic_mis_date):
         if flow_rates_df.empty:
             save_log("compute_and_save_cumulative_pd", "WARNING", "No valid flow rate data available.")
             return 0
-        flow_rates_df['n_transition_prob'] = flow_rates_df['n_transition_prob'].astype(float)
+
+        codes = band_codes if DEFAULT_BAND in band_codes else band_codes + [DEFAULT_BAND]
+        default_index = codes.index(DEFAULT_BAND)
+        keys, matrices, observed = build_transition_matrices(
+            flow_rates_df, ['transition_date', 'v_combined_group'], codes, MIN_TRANSITION_PROB
+        )
+        cumulative_pd = absorption_probabilities(matrices, default_index, CUMULATIVE_PD_HORIZON)
+
+        # Segment and product type of the first flow of every group; the segments come from the run context.
+        firsts = {
+            (row.transition_date, row.v_combined_group): (row.n_segment_skey, row.n_prod_type)
+            for row in flow_rates_df.drop_duplicates(['transition_date', 'v_combined_group']).itertuples(index=False)
+        }
+        context = get_run_context()
+
         records = []
-        for transition_date in sorted(flow_rates_df['transition_date'].unique()):
-            transition_df = flow_rates_df[flow_rates_df['transition_date'] == transition_date]
-            cumulative_pd = {}
-            for group in transition_df['v_combined_group'].unique():
-                group_df = transition_df[transition_df['v_combined_group'] == group]
-                # Get band order from the Dim_Delinquency_Band table.
-                band_order = get_band_order()
-                sorted_bands = sorted(group_df['v_credit_risk_basis_cd_from'].unique(), key=extract_numeric, reverse=True)
-                cumulative_pd[group] = {}
-                # Set the default band cumulative PD to 1.
-                cumulative_pd[group]["90+"] = 1.0  
-                for band in sorted_bands:
-                    if band == "90+":
-                        continue  # Skip the default band.
-                    transitions = group_df[group_df['v_credit_risk_basis_cd_from'] == band]
-                    # Apply smoothing: if a transition probability is zero, use a minimum value.
-                    adjusted_probs = transitions['n_transition_prob'].apply(lambda p: p if p > 0 else MIN_TRANSITION_PROB)
-                    pd_value = sum(adjusted_probs * transitions['v_credit_risk_basis_cd_to'].map(lambda x: cumulative_pd[group].get(x, 0)))
-                    cumulative_pd[group][band] = round(pd_value, 6)
-            for group, band_pds in cumulative_pd.items():
-                for band, pd_value in band_pds.items():
-                    segment_instance = Ldn_PD_Term_Structure.objects.filter(
-                        v_pd_term_structure_id=transition_df[transition_df['v_combined_group'] == group]['n_segment_skey'].iloc[0]
-                    ).first()
-                    if segment_instance:
-                        records.append(FSICUMULATIVEPD(
-                            fic_mis_date=fic_mis_date,
-                            transition_date=transition_date,
-                            n_segment_skey=segment_instance,
-                            n_prod_type=transition_df[transition_df['v_combined_group'] == group]['n_prod_type'].iloc[0],
-                            v_combined_group=group,
-                            v_credit_risk_basis_cd=band,
-                            n_cumulative_pd=pd_value
-                        ))
+        for k, (transition_date, group) in enumerate(keys.itertuples(index=False, name=None)):
+            segment_key, prod_type = firsts[(transition_date, group)]
+            segment_instance = context.get_pd_term_structure(segment_key)
+            if not segment_instance:
+                continue
+            # The default band, then every band with flow rates.
+            for index in [default_index] + [i for i in np.flatnonzero(observed[k]) if i != default_index]:
+                records.append(FSICUMULATIVEPD(
+                    fic_mis_date=fic_mis_date,
+                    transition_date=transition_date,
+                    n_segment_skey=segment_instance,
+                    n_prod_type=prod_type,
+                    v_combined_group=group,
+                    v_credit_risk_basis_cd=codes[index],
+                    n_cumulative_pd=round(float(cumulative_pd[k, index]), 6)
+                ))
         with transaction.atomic():
-            
-            FSICUMULATIVEPD.objects.bulk_create(records)
-        save_log("compute_and_save_cumulative_pd", "INFO", f"Cumulative PD successfully computed for {fic_mis_date}.")
+            FSICUMULATIVEPD.objects.bulk_create(records, batch_size=1000)
+        save_log("compute_and_save_cumulative_pd", "INFO", f"Cumulative PD successfully computed for {fic_mis_date} ({len(keys)} groups).")
         return 1
     except Exception as e:
         save_log("compute_and_save_cumulative_pd", "ERROR", f"Error computing cumulative PD: {e}")
@@ -469,6 +479,7 @@ def save_ttc_pd(ttc_pd_df, reporting_date, group_prod_type):
     """
     records = []
     group_to_segments = get_group_to_segments_mapping()
+    context = get_run_context()
     save_log("save_ttc_pd", "INFO", f"Group to segments mapping: {group_to_segments}")
 
     # Group the PD data by v_combined_group.
@@ -491,7 +502,7 @@ def save_ttc_pd(ttc_pd_df, reporting_date, group_prod_type):
                     continue
 
                 # Look up the instance for the segment in Ldn_PD_Term_Structure.
-                instance = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_id=seg_int).first()
+                instance = context.get_pd_term_structure(seg_int)
                 if not instance:
                     save_log("save_ttc_pd", "WARNING", f"No instance found for segment {seg_int} on {reporting_date}")
                     continue
@@ -511,7 +522,7 @@ def save_ttc_pd(ttc_pd_df, reporting_date, group_prod_type):
                 save_log("save_ttc_pd", "INFO", f"Processed all records for segment {seg_int} under group {group_key}.")
 
         # Now, also create records for the group itself.
-        instance = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_id=group_key).first()
+        instance = context.get_pd_term_structure(group_key)
         if not instance:
             save_log("save_ttc_pd", "WARNING", f"No instance found for group {group_key} on {reporting_date}")
         else:
@@ -534,24 +545,28 @@ def save_ttc_pd(ttc_pd_df, reporting_date, group_prod_type):
         save_log("save_ttc_pd", "WARNING", f"No records to save for reporting_date {reporting_date} using mapping {group_to_segments}")
 
 @log_function
-def provision_matrix(fic_mis_date):
+def provision_matrix(fic_mis_date, full_rebuild=None):
     """
     Main function to compute PDs using cumulative PD values.
     
-    1. Derives a monthly period column.
-    2. For each group, loops over adjacent periods and computes transitions between adjacent bands,
-       using only accounts common to both periods (new accounts are excluded).
-    3. Saves the computed flow rates and transition counts.
-    4. Computes and saves cumulative PD.
+    1. Plans the pairs of adjacent monthly periods of every group from fingerprints of the stage data.
+       Incrementally, only the pairs that are not counted yet or whose stage data changed are processed
+       (usually the newest month); with full_rebuild the whole history window is cleared and recounted.
+    2. Loads the stage data of those periods and computes the transitions between adjacent bands in one pass,
+       using only accounts common to both periods (new accounts are excluded). The counts are stored in FSITransitionCount.
+    3. Saves the computed flow rates and transition counts of those pairs.
+    4. Computes and saves cumulative PD for their transition dates.
     5. Finally, annualizes the cumulative PD using the formula:
          Annual PD = 1 - (1 - cum_PD)^(# periods per year)
     6. Saves the final annual PD into Ldn_PD_Term_Structure_Dtl and exports the result as CSV.
     
+    full_rebuild defaults to the opposite of TRANSITION_HISTORY_INCREMENTAL.
     Returns 1 if successful, or 0 if an exception occurs.
     """
     try:
         final_reporting_date = pd.to_datetime(fic_mis_date).date()
-     
+        if full_rebuild is None:
+            full_rebuild = not TRANSITION_HISTORY_INCREMENTAL
 
         date_range = HistoricalDateRange.objects.first()
         if date_range:
@@ -561,27 +576,47 @@ def provision_matrix(fic_mis_date):
             # Fallback if no date range is defined; for example, use a default range or raise an error.
             raise ValueError("No historical date range defined.")
         
-        # Then, clear only the records within that date range:
         band_codes = get_band_order()
-        FSITransitionMatrix.objects.filter(
-            fic_mis_date__gte=start_date,
-            fic_mis_date__lte=end_date,
-            v_credit_risk_basis_cd_from__in=band_codes
-        ).delete()
-        FSIFlowRateHistory.objects.filter(
-            fic_mis_date__gte=start_date,
-            fic_mis_date__lte=end_date,
-            v_credit_risk_basis_cd_from__in=band_codes
-        ).delete()
-        FSICUMULATIVEPD.objects.filter(
-            fic_mis_date__gte=start_date,
-            fic_mis_date__lte=end_date,
-            v_credit_risk_basis_cd__in=band_codes
-        ).delete()
-
-
-        # Load and merge data.
-        stage_data_df = load_stage_data()
+        if full_rebuild:
+            # Then, clear only the records within that date range:
+            FSITransitionMatrix.objects.filter(
+                fic_mis_date__gte=start_date,
+                fic_mis_date__lte=end_date,
+                v_credit_risk_basis_cd_from__in=band_codes
+            ).delete()
+            FSIFlowRateHistory.objects.filter(
+                fic_mis_date__gte=start_date,
+                fic_mis_date__lte=end_date,
+                v_credit_risk_basis_cd_from__in=band_codes
+            ).delete()
+            FSICUMULATIVEPD.objects.filter(
+                fic_mis_date__gte=start_date,
+                fic_mis_date__lte=end_date,
+                v_credit_risk_basis_cd__in=band_codes
+            ).delete()
+            FSITransitionCount.objects.filter(
+                v_transition_basis='D',
+                current_period__gte=start_date,
+                current_period__lte=end_date
+            ).delete()
+
+        # Plan the period pairs from fingerprints of the stage data, aggregated in the database.
+        dpd_segments = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_type='D').values_list('v_pd_term_structure_id', flat=True)
+        partitions_df = get_partition_fingerprints('n_delq_band_code', dpd_segments, start_date, min(end_date, final_reporting_date))
+        planned_df = plan_transition_pairs(merge_product_segments(partitions_df), band_codes)
+        stale_df, obsolete = get_stale_pairs('D', planned_df, full_rebuild)
+        save_log("provision_matrix", "INFO", f"Counting {len(stale_df)} of {len(planned_df)} period pairs ({'full rebuild' if full_rebuild else 'incremental'}).")
+
+        # Drop the history of pairs whose stage data is gone.
+        transition_dates = set()
+        for group, current_period in obsolete:
+            transition_date = pd.Period(current_period, 'M').strftime('%Y-%m-%d')
+            clear_transition_history(group, transition_date, band_codes)
+            transition_dates.add(transition_date)
+        delete_transition_counts('D', obsolete)
+
+        # Load and merge the stage data of the periods to count.
+        stage_data_df = load_stage_data(None if full_rebuild else get_pair_periods(stale_df))
         stage_data_df = merge_product_segments(stage_data_df)
         stage_data_df = stage_data_df.sort_values(by='fic_mis_date', ascending=True)
         if 'v_combined_group' not in stage_data_df.columns:
@@ -627,27 +662,26 @@ def provision_matrix(fic_mis_date):
         band_order = get_band_order()
 
         # Process transitions for each group between adjacent periods.
-        pd_results_list = []
-        for group, group_df in stage_data_df.groupby('v_combined_group'):
-            periods = sorted(group_df['period'].unique())
-            if len(periods) < 2:
-                continue
-            for i in range(1, len(periods)):
-                previous_period = periods[i - 1]
-                current_period = periods[i]
-                counts_df = compute_transition_counts_by_period(group_df, previous_period, current_period, band_order)
-                if counts_df.empty:
-                    save_log("provision_matrix", "WARNING", f"No transitions for group {group} between {previous_period} and {current_period}.")
-                    continue
-                # Use current period as transition_date.
-                transition_date = current_period.strftime('%Y-%m-%d')
-                counts_df['transition_date'] = transition_date
-                save_log("provision_matrix", "INFO", f"Transitions for group {group} between {previous_period} and {current_period}: shape {counts_df.shape}")
-                save_flow_rates_to_history(counts_df, transition_date)
-                save_transition_matrix(counts_df, transition_date, group_prod_type)
-                compute_and_save_cumulative_pd(transition_date)
-               
-                save_log("provision_matrix", "INFO", f"Cumulative PD computed for group {group} between {previous_period} and {current_period}.")
+        flow_rates_df = compute_transition_counts(stage_data_df, band_order, stale_df)
+        save_log("provision_matrix", "INFO", f"Computed {len(flow_rates_df)} transition counts.")
+        for (group, previous_period, current_period), counts_df in flow_rates_df.groupby(
+            ['v_combined_group', 'previous_period', 'current_period'], sort=False
+        ):
+            counts_df = counts_df.drop(columns=['previous_period', 'current_period'])
+            # Use current period as transition_date.
+            transition_date = current_period.strftime('%Y-%m-%d')
+            counts_df['transition_date'] = transition_date
+            save_log("provision_matrix", "INFO", f"Transitions for group {group} between {previous_period} and {current_period}: shape {counts_df.shape}")
+            clear_transition_history(group, transition_date, band_codes)
+            save_flow_rates_to_history(counts_df, transition_date)
+            save_transition_matrix(counts_df, transition_date, group_prod_type)
+            transition_dates.add(transition_date)
+
+        # Cumulative PD of every transition date touched, from the flow rates of all its groups.
+        for transition_date in sorted(transition_dates):
+            FSICUMULATIVEPD.objects.filter(fic_mis_date=transition_date, v_credit_risk_basis_cd__in=band_codes).delete()
+            compute_and_save_cumulative_pd(transition_date)
+            save_log("provision_matrix", "INFO", f"Cumulative PD computed for transition date {transition_date}.")
         # After cumulative PD has been saved, compute annual PD from cumulative PD.
         annual_pd_df = compute_annual_pd_from_cumulative(fic_mis_date, frequency_unit='M')
         
@@ -14,16 +14,38 @@ from IFRS9.models import (
     FSITransitionMatrix,      # New model for raw transition counts.
     Ldn_PD_Term_Structure_Dtl,
     FSICUMULATIVEPD,
+    FSITransitionCount,
     Ldn_PD_Term_Structure,    # Used to retrieve frequency unit and structure type.
     HistoricalDateRange
 )
 
 # Import the logging function.
 from .save_log import save_log
+from .reference_data import get_run_context
+from .absorbing_markov import CUMULATIVE_PD_HORIZON, absorption_probabilities, build_transition_matrices
+from .transition_counts import adjacent_flow_rates_from_counts
+from .transition_history import (
+    TRANSITION_HISTORY_INCREMENTAL,
+    count_and_save_transitions,
+    delete_transition_counts,
+    get_pair_periods,
+    get_partition_fingerprints,
+    get_stale_pairs,
+    period_filter,
+    plan_transition_pairs,
+)
 
 EPSILON = 1e-6  # Small value to avoid division by zero
 MIN_TRANSITION_PROB = 0.001  # Smoothing threshold for zero transition probability
 
+# Pinned cumulative PDs of a rating chain aaa -> aa -> a -> bbb -> d, checked by check_cumulative_rating_pd:
+# (rating order, adjacent flow rates, expected cumulative PD of every rating)
+CUMULATIVE_RATING_PD_FIXTURE = (
+    ['aaa', 'aa', 'a', 'bbb', 'd'],
+    [0.1, 0.2, 0.3, 0.4],
+    [0.0024, 0.024, 0.12, 0.4, 1.0],
+)
+
 # ---------------------------------------------------------------------
 # Decorator to log entry, exit, and errors for each function.
 # ---------------------------------------------------------------------
@@ -63,12 +85,13 @@ def get_rating_order():
     return [band.v_rating_code.lower() for band in bands]
 
 @log_function
-def load_stage_data():
+def load_stage_data(periods=None):
     """
     Load raw data from FCT_Stage_Determination into a DataFrame.
     Filters records whose n_segment_skey appears in Ldn_PD_Term_Structure (v_pd_term_structure_type = 'R').
     Fields: fic_mis_date, n_segment_skey, n_prod_type, n_credit_rating_code, v_amrt_term_unit, n_account_number.
     Data is filtered by the date range specified in HistoricalDateRange.
+    With periods (monthly Periods), only the rows of those periods are loaded.
     """
     rating_segments = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_type='R').values_list('v_pd_term_structure_id', flat=True)
     date_range = HistoricalDateRange.objects.first()
@@ -78,7 +101,10 @@ def load_stage_data():
         n_segment_skey__in=list(rating_segments),
         fic_mis_date__gte=date_range.start_date,
         fic_mis_date__lte=date_range.end_date
-    ).values(
+    )
+    if periods is not None:
+        qs = qs.filter(period_filter(periods))
+    qs = qs.values(
         'fic_mis_date', 
         'n_segment_skey', 
         'n_prod_type', 
@@ -176,48 +202,38 @@ def build_group_default_rating_mapping(stage_data_df):
     return mapping
 
 @log_function
-def compute_rating_transition_counts_by_period(df_group, previous_period, current_period, rating_order):
+def compute_rating_transition_counts(stage_data_df, rating_order, pairs_df):
     """
-    For a given group and adjacent periods (previous_period and current_period),
-    compute transition counts for rating codes for accounts common to both periods.
-    
+    Compute the rating transition counts of the period pairs in pairs_df (see transition_history) in one
+    pass, only for accounts common to both periods, and store them in FSITransitionCount.
+
     For each adjacent pair in rating_order, count:
       - n_prev_period_accounts: unique accounts in previous_period for that rating (also present in current_period)
       - n_next_period_accounts: unique accounts in current_period for the adjacent rating (common accounts)
       - transition_prob = n_next_period_accounts / (n_prev_period_accounts + EPSILON)
-    
+
     Returns a DataFrame with columns:
-      v_combined_group, prev_rating, next_rating, n_prev_period_accounts, n_next_period_accounts, transition_prob.
+      v_combined_group, previous_period, current_period, prev_rating, next_rating,
+      n_prev_period_accounts, n_next_period_accounts, transition_prob.
     """
-    df_prev = df_group[df_group['period'] == previous_period].copy()
-    df_curr = df_group[df_group['period'] == current_period].copy()
-    
-    # Standardize rating codes to lowercase.
-    df_prev['n_credit_rating_code'] = df_prev['n_credit_rating_code'].str.lower()
-    df_curr['n_credit_rating_code'] = df_curr['n_credit_rating_code'].str.lower()
-    
-    common_accounts = set(df_prev['n_account_number'].unique()).intersection(set(df_curr['n_account_number'].unique()))
-    
-    records = []
-    for i in range(len(rating_order) - 1):
-        prev_rating = rating_order[i]
-        next_rating = rating_order[i + 1]
-        accounts_prev = set(df_prev[df_prev['n_credit_rating_code'] == prev_rating]['n_account_number'].unique())
-        common_prev = accounts_prev.intersection(common_accounts)
-        accounts_next = set(df_curr[df_curr['n_credit_rating_code'] == next_rating]['n_account_number'].unique())
-        common_transition = common_prev.intersection(accounts_next)
-        n_prev = len(common_prev)
-        n_next = len(common_transition)
-        prob = n_next / (n_prev + EPSILON) if n_prev > 0 else 0.0
-        records.append({
-            'v_combined_group': df_group['v_combined_group'].iloc[0],
-            'prev_rating': prev_rating,
-            'next_rating': next_rating,
-            'n_prev_period_accounts': n_prev,
-            'n_next_period_accounts': n_next,
-            'transition_prob': prob
-        })
-    return pd.DataFrame(records)
+    pairs, counts, totals = count_and_save_transitions('R', stage_data_df, 'n_credit_rating_code', rating_order, pairs_df)
+    return adjacent_flow_rates_from_counts(pairs, counts, totals, rating_order, 'prev_rating', 'next_rating')
+
+@log_function
+def clear_rating_transition_history(group, transition_date, rating_codes):
+    """
+    Delete the rating flow rates and transition counts of a group for one transition date before they are recomputed.
+    """
+    FSITransitionMatrix.objects.filter(
+        fic_mis_date=transition_date,
+        v_combined_group=group,
+        v_credit_risk_basis_cd_from__in=rating_codes
+    ).delete()
+    FSIFlowRateHistory.objects.filter(
+        fic_mis_date=transition_date,
+        v_combined_group=group,
+        v_credit_risk_basis_cd_from__in=rating_codes
+    ).delete()
 
 @log_function
 def save_rating_flow_rates_to_history(flow_rates_df, transition_date):
@@ -227,11 +243,12 @@ def save_rating_flow_rates_to_history(flow_rates_df, transition_date):
     """
     records = []
     group_to_seg = get_group_to_segments_mapping()
+    context = get_run_context()
     for _, row in flow_rates_df.iterrows():
         group = row['v_combined_group']
         seg_list = group_to_seg.get(group, [])
         segment_key = seg_list[0] if seg_list else group
-        instance = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_id=segment_key).first()
+        instance = context.get_pd_term_structure(segment_key)
         if not instance:
             raise ValueError(f"No instance for segment key {segment_key} on {transition_date}")
         record = FSIFlowRateHistory(
@@ -257,11 +274,12 @@ def save_rating_transition_matrix(counts_df, transition_date, group_prod_type):
     """
     records = []
     group_to_seg = get_group_to_segments_mapping()
+    context = get_run_context()
     for _, row in counts_df.iterrows():
         group = row['v_combined_group']
         seg_list = group_to_seg.get(group, [])
         segment_key = seg_list[0] if seg_list else group
-        instance = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_id=segment_key).first()
+        instance = context.get_pd_term_structure(segment_key)
         if not instance:
             raise ValueError(f"No instance for segment key {segment_key} on {transition_date}")
         record = FSITransitionMatrix(
@@ -322,14 +340,63 @@ def build_group_frequency_mapping(reporting_date):
     save_log("build_group_frequency_mapping", "INFO", f"Group frequency: {group_frequency}")
     return group_frequency
 
+def cumulative_rating_pd(flow_rates_df, rating_order, horizon=None):
+    """
+    Cumulative PD of every rating for each (transition date, group) of flow_rates_df.
+
+    The flow rates of every (transition date, group) form a transition matrix with the worst rating absorbing;
+    the cumulative PD of a rating is its probability of absorption into the worst rating (within
+    horizon periods when set), solved for all groups at once.
+
+    :return: (keys, cumulative_pd, observed) as returned by build_transition_matrices and
+             absorption_probabilities.
+    """
+    keys, matrices, observed = build_transition_matrices(
+        flow_rates_df, ['transition_date', 'v_combined_group'], rating_order, MIN_TRANSITION_PROB
+    )
+    return keys, absorption_probabilities(matrices, len(rating_order) - 1, horizon), observed
+
+
+def check_cumulative_rating_pd():
+    """
+    Check cumulative_rating_pd against CUMULATIVE_RATING_PD_FIXTURE (without horizon).
+
+    :return: List of (rating, expected, computed) for the ratings that differ; empty when all match.
+    """
+    rating_order, flow_rates, expected = CUMULATIVE_RATING_PD_FIXTURE
+    flow_rates_df = pd.DataFrame({
+        'transition_date': 1,
+        'v_combined_group': 'fixture',
+        'v_credit_risk_basis_cd_from': rating_order[:-1],
+        'v_credit_risk_basis_cd_to': rating_order[1:],
+        'n_transition_prob': flow_rates,
+    })
+    _, cumulative_pd, _ = cumulative_rating_pd(flow_rates_df, rating_order)
+    return [
+        (rating, expected_pd, round(float(computed_pd), 6))
+        for rating, expected_pd, computed_pd in zip(rating_order, expected, cumulative_pd[0])
+        if round(float(computed_pd), 6) != expected_pd
+    ]
+
+
 @log_function
 def compute_and_save_cumulative_rating_pd(fic_mis_date):
     """
     Computes cumulative PD per transition date for each rating and saves it into FSICUMULATIVEPD.
-    Applies smoothing for zero probabilities.
+    Applies smoothing for zero probabilities. See cumulative_rating_pd.
+
+    Unlike the former per-rating recursion, which walked the ratings best first and so gave 0 to
+    every rating not next to the worst one, each rating now gets the chained probability of
+    reaching the worst rating: for aaa -> aa -> a -> bbb -> d with flow rates 0.1, 0.2, 0.3 and
+    0.4, 0.0024 / 0.024 / 0.12 / 0.4 instead of 0 / 0 / 0 / 0.4 (pinned by
+    check_cumulative_rating_pd).
     """
     try:
-        flow_rates_qs = FSIFlowRateHistory.objects.filter(fic_mis_date=fic_mis_date)
+        rating_order = get_rating_order()
+        if not rating_order:
+            save_log("compute_and_save_cumulative_rating_pd", "WARNING", "No rating codes defined.")
+            return 0
+        flow_rates_qs = FSIFlowRateHistory.objects.filter(fic_mis_date=fic_mis_date, v_credit_risk_basis_cd_from__in=rating_order)
         if not flow_rates_qs.exists():
             save_log("compute_and_save_cumulative_rating_pd", "WARNING", f"No transition data for {fic_mis_date}")
             return 0
@@ -341,45 +408,38 @@ def compute_and_save_cumulative_rating_pd(fic_mis_date):
         if flow_rates_df.empty:
             save_log("compute_and_save_cumulative_rating_pd", "WARNING", "No valid flow rate data available.")
             return 0
-        flow_rates_df['n_transition_prob'] = flow_rates_df['n_transition_prob'].astype(float)
+
+        # Set worst rating cumulative PD to 1.
+        default_index = len(rating_order) - 1
+        keys, cumulative_pd, observed = cumulative_rating_pd(flow_rates_df, rating_order, CUMULATIVE_PD_HORIZON)
+
+        # Segment and product type of the first flow of every group; the segments come from the run context.
+        firsts = {
+            (row.transition_date, row.v_combined_group): (row.n_segment_skey, row.n_prod_type)
+            for row in flow_rates_df.drop_duplicates(['transition_date', 'v_combined_group']).itertuples(index=False)
+        }
+        context = get_run_context()
+
         records = []
-        for transition_date in sorted(flow_rates_df['transition_date'].unique()):
-            transition_df = flow_rates_df[flow_rates_df['transition_date'] == transition_date]
-            cumulative_pd = {}
-            for group in transition_df['v_combined_group'].unique():
-                group_df = transition_df[transition_df['v_combined_group'] == group]
-                rating_order = get_rating_order()
-                # Order ratings by natural order.
-                sorted_ratings = sorted(group_df['v_credit_risk_basis_cd_from'].unique(), key=lambda x: rating_order.index(x.lower()))
-                cumulative_pd[group] = {}
-                # Set worst rating cumulative PD to 1.
-                cumulative_pd[group][rating_order[-1]] = 1.0
-                for rating in sorted_ratings:
-                    if rating.lower() == rating_order[-1]:
-                        continue
-                    transitions = group_df[group_df['v_credit_risk_basis_cd_from'] == rating]
-                    adjusted_probs = transitions['n_transition_prob'].apply(lambda p: p if p > 0 else MIN_TRANSITION_PROB)
-                    pd_value = sum(adjusted_probs * transitions['v_credit_risk_basis_cd_to'].map(lambda x: cumulative_pd[group].get(x.lower(), 0)))
-                    cumulative_pd[group][rating.lower()] = round(pd_value, 6)
-            for group, rating_pd in cumulative_pd.items():
-                for rating, pd_value in rating_pd.items():
-                    segment_instance = Ldn_PD_Term_Structure.objects.filter(
-                        v_pd_term_structure_id=transition_df[transition_df['v_combined_group'] == group]['n_segment_skey'].iloc[0]
-                    ).first()
-                    if segment_instance:
-                        records.append(FSICUMULATIVEPD(
-                            fic_mis_date=fic_mis_date,
-                            transition_date=transition_date,
-                            n_segment_skey=segment_instance,
-                            n_prod_type=transition_df[transition_df['v_combined_group'] == group]['n_prod_type'].iloc[0],
-                            v_combined_group=group,
-                            v_credit_risk_basis_cd=rating,
-                            n_cumulative_pd=pd_value
-                        ))
+        for k, (transition_date, group) in enumerate(keys.itertuples(index=False, name=None)):
+            segment_key, prod_type = firsts[(transition_date, group)]
+            segment_instance = context.get_pd_term_structure(segment_key)
+            if not segment_instance:
+                continue
+            # The worst rating, then every rating with flow rates.
+            for index in [default_index] + [i for i in np.flatnonzero(observed[k]) if i != default_index]:
+                records.append(FSICUMULATIVEPD(
+                    fic_mis_date=fic_mis_date,
+                    transition_date=transition_date,
+                    n_segment_skey=segment_instance,
+                    n_prod_type=prod_type,
+                    v_combined_group=group,
+                    v_credit_risk_basis_cd=rating_order[index],
+                    n_cumulative_pd=round(float(cumulative_pd[k, index]), 6)
+                ))
         with transaction.atomic():
-          
-            FSICUMULATIVEPD.objects.bulk_create(records)
-        save_log("compute_and_save_cumulative_rating_pd", "INFO", f"Cumulative PD successfully computed for {fic_mis_date}.")
+            FSICUMULATIVEPD.objects.bulk_create(records, batch_size=1000)
+        save_log("compute_and_save_cumulative_rating_pd", "INFO", f"Cumulative PD successfully computed for {fic_mis_date} ({len(keys)} groups).")
         return 1
     except Exception as e:
         save_log("compute_and_save_cumulative_rating_pd", "ERROR", f"Error computing cumulative PD: {e}")
@@ -458,6 +518,7 @@ def save_ttc_pd(ttc_pd_df, reporting_date, group_prod_type):
     """
     records = []
     group_to_segments = get_group_to_segments_mapping()
+    context = get_run_context()
     save_log("save_ttc_pd", "INFO", f"Group to segments mapping: {group_to_segments}")
 
     # Group the PD data by v_combined_group.
@@ -480,7 +541,7 @@ def save_ttc_pd(ttc_pd_df, reporting_date, group_prod_type):
                     continue
 
                 # Look up the instance for the segment in Ldn_PD_Term_Structure.
-                instance = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_id=seg_int).first()
+                instance = context.get_pd_term_structure(seg_int)
                 if not instance:
                     save_log("save_ttc_pd", "WARNING", f"No instance found for segment {seg_int} on {reporting_date}")
                     continue
@@ -500,7 +561,7 @@ def save_ttc_pd(ttc_pd_df, reporting_date, group_prod_type):
                 save_log("save_ttc_pd", "INFO", f"Processed all records for segment {seg_int} under group {group_key}.")
 
         # Now, also create records for the group itself.
-        instance = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_id=group_key).first()
+        instance = context.get_pd_term_structure(group_key)
         if not instance:
             save_log("save_ttc_pd", "WARNING", f"No instance found for group {group_key} on {reporting_date}")
         else:
@@ -526,23 +587,28 @@ def save_ttc_pd(ttc_pd_df, reporting_date, group_prod_type):
 # Main function renamed to provision_matrix_w_ratings.
 # ---------------------------------------------------------------------
 @log_function
-def provision_matrix_w_ratings(fic_mis_date):
+def provision_matrix_w_ratings(fic_mis_date, full_rebuild=None):
     """
     Main function to compute PDs using cumulative PD values and credit ratings.
     
-    1. Derives a monthly period column.
-    2. For each group, loops over adjacent periods and computes transitions between adjacent rating codes,
-       using only accounts common to both periods (new accounts are excluded).
-    3. Saves the computed rating flow rates and transition counts.
-    4. Computes and saves cumulative PD.
+    1. Plans the pairs of adjacent monthly periods of every group from fingerprints of the stage data.
+       Incrementally, only the pairs that are not counted yet or whose stage data changed are processed
+       (usually the newest month); with full_rebuild the whole history window is cleared and recounted.
+    2. Loads the stage data of those periods and computes the transitions between adjacent rating codes in one pass,
+       using only accounts common to both periods (new accounts are excluded). The counts are stored in FSITransitionCount.
+    3. Saves the computed rating flow rates and transition counts of those pairs.
+    4. Computes and saves cumulative PD for their transition dates.
     5. Annualizes the cumulative PD using:
          Annual PD = 1 - (1 - cum_PD)^(# periods per year)
     6. Saves the final annual PD into Ldn_PD_Term_Structure_Dtl and exports the result as CSV.
     
+    full_rebuild defaults to the opposite of TRANSITION_HISTORY_INCREMENTAL.
     Returns 1 if successful, or 0 if an exception occurs.
     """
     try:
         final_reporting_date = pd.to_datetime(fic_mis_date).date()
+        if full_rebuild is None:
+            full_rebuild = not TRANSITION_HISTORY_INCREMENTAL
         print("Starting PD computation process (annual PD from cumulative PD using ratings)...")
         print(f"Using final reporting date: {final_reporting_date}")
 
@@ -553,26 +619,47 @@ def provision_matrix_w_ratings(fic_mis_date):
         else:
             raise ValueError("No historical date range defined.")
         
-        # Clear existing records only for rating-related entries within the date range.
         rating_codes = get_rating_order()  # List of valid rating codes (in lowercase)
-        FSITransitionMatrix.objects.filter(
-            fic_mis_date__gte=start_date,
-            fic_mis_date__lte=end_date,
-            v_credit_risk_basis_cd_from__in=rating_codes
-        ).delete()
-        FSIFlowRateHistory.objects.filter(
-            fic_mis_date__gte=start_date,
-            fic_mis_date__lte=end_date,
-            v_credit_risk_basis_cd_from__in=rating_codes
-        ).delete()
-        FSICUMULATIVEPD.objects.filter(
-            fic_mis_date__gte=start_date,
-            fic_mis_date__lte=end_date,
-            v_credit_risk_basis_cd__in=rating_codes  # If your model uses this field; adjust as needed.
-        ).delete()
-
-        # Load and merge data.
-        stage_data_df = load_stage_data()
+        if full_rebuild:
+            # Clear existing records only for rating-related entries within the date range.
+            FSITransitionMatrix.objects.filter(
+                fic_mis_date__gte=start_date,
+                fic_mis_date__lte=end_date,
+                v_credit_risk_basis_cd_from__in=rating_codes
+            ).delete()
+            FSIFlowRateHistory.objects.filter(
+                fic_mis_date__gte=start_date,
+                fic_mis_date__lte=end_date,
+                v_credit_risk_basis_cd_from__in=rating_codes
+            ).delete()
+            FSICUMULATIVEPD.objects.filter(
+                fic_mis_date__gte=start_date,
+                fic_mis_date__lte=end_date,
+                v_credit_risk_basis_cd__in=rating_codes  # If your model uses this field; adjust as needed.
+            ).delete()
+            FSITransitionCount.objects.filter(
+                v_transition_basis='R',
+                current_period__gte=start_date,
+                current_period__lte=end_date
+            ).delete()
+
+        # Plan the period pairs from fingerprints of the stage data, aggregated in the database.
+        rating_segments = Ldn_PD_Term_Structure.objects.filter(v_pd_term_structure_type='R').values_list('v_pd_term_structure_id', flat=True)
+        partitions_df = get_partition_fingerprints('n_credit_rating_code', rating_segments, start_date, min(end_date, final_reporting_date))
+        planned_df = plan_transition_pairs(merge_product_segments(partitions_df), rating_codes)
+        stale_df, obsolete = get_stale_pairs('R', planned_df, full_rebuild)
+        save_log("provision_matrix_w_ratings", "INFO", f"Counting {len(stale_df)} of {len(planned_df)} period pairs ({'full rebuild' if full_rebuild else 'incremental'}).")
+
+        # Drop the history of pairs whose stage data is gone.
+        transition_dates = set()
+        for group, current_period in obsolete:
+            transition_date = pd.Period(current_period, 'M').strftime('%Y-%m-%d')
+            clear_rating_transition_history(group, transition_date, rating_codes)
+            transition_dates.add(transition_date)
+        delete_transition_counts('R', obsolete)
+
+        # Load and merge the stage data of the periods to count.
+        stage_data_df = load_stage_data(None if full_rebuild else get_pair_periods(stale_df))
         stage_data_df = merge_product_segments(stage_data_df)
         stage_data_df = stage_data_df.sort_values(by='fic_mis_date', ascending=True)
         if 'v_combined_group' not in stage_data_df.columns:
@@ -618,27 +705,26 @@ def provision_matrix_w_ratings(fic_mis_date):
         rating_order = get_rating_order()
 
         # Process transitions for each group between adjacent periods.
-        pd_results_list = []
-        for group, group_df in stage_data_df.groupby('v_combined_group'):
-            periods = sorted(group_df['period'].unique())
-            if len(periods) < 2:
-                continue
-            for i in range(1, len(periods)):
-                previous_period = periods[i - 1]
-                current_period = periods[i]
-                counts_df = compute_rating_transition_counts_by_period(group_df, previous_period, current_period, rating_order)
-                if counts_df.empty:
-                    save_log("provision_matrix_w_ratings", "WARNING", f"No transitions for group {group} between {previous_period} and {current_period}.")
-                    continue
-                # Use current period as transition_date.
-                transition_date = current_period.strftime('%Y-%m-%d')
-                counts_df['transition_date'] = transition_date
-                save_log("provision_matrix_w_ratings", "INFO", f"Transitions for group {group} between {previous_period} and {current_period}: shape {counts_df.shape}")
-                save_rating_flow_rates_to_history(counts_df, transition_date)
-                save_rating_transition_matrix(counts_df, transition_date, group_prod_type)
-                compute_and_save_cumulative_rating_pd(transition_date)
-               
-                save_log("provision_matrix_w_ratings", "INFO", f"Cumulative PD computed for group {group} between {previous_period} and {current_period}.")
+        flow_rates_df = compute_rating_transition_counts(stage_data_df, rating_order, stale_df)
+        save_log("provision_matrix_w_ratings", "INFO", f"Computed {len(flow_rates_df)} rating transition counts.")
+        for (group, previous_period, current_period), counts_df in flow_rates_df.groupby(
+            ['v_combined_group', 'previous_period', 'current_period'], sort=False
+        ):
+            counts_df = counts_df.drop(columns=['previous_period', 'current_period'])
+            # Use current period as transition_date.
+            transition_date = current_period.strftime('%Y-%m-%d')
+            counts_df['transition_date'] = transition_date
+            save_log("provision_matrix_w_ratings", "INFO", f"Transitions for group {group} between {previous_period} and {current_period}: shape {counts_df.shape}")
+            clear_rating_transition_history(group, transition_date, rating_codes)
+            save_rating_flow_rates_to_history(counts_df, transition_date)
+            save_rating_transition_matrix(counts_df, transition_date, group_prod_type)
+            transition_dates.add(transition_date)
+
+        # Cumulative PD of every transition date touched, from the flow rates of all its groups.
+        for transition_date in sorted(transition_dates):
+            FSICUMULATIVEPD.objects.filter(fic_mis_date=transition_date, v_credit_risk_basis_cd__in=rating_codes).delete()
+            compute_and_save_cumulative_rating_pd(transition_date)
+            save_log("provision_matrix_w_ratings", "INFO", f"Cumulative PD computed for transition date {transition_date}.")
         # Compute annual PD from cumulative PD.
         annual_pd_df = compute_annual_pd_from_cumulative(fic_mis_date, frequency_unit='M')
        
@@ -4,22 +4,14 @@ from django.db import connection, transaction, DatabaseError
 from django.db.models import Sum
 from django.utils import timezone
 from decimal import Decimal
-from IFRS9.models import DimExchangeRateConf, Ldn_Exchange_Rate, FCT_Reporting_Lines, ReportingCurrency, Dim_Run
+from IFRS9.models import DimExchangeRateConf, Ldn_Exchange_Rate, FCT_Reporting_Lines, ReportingCurrency
 from .save_log import save_log
+from .reference_data import get_latest_run_skey
+from .ecl_summary_cube import refresh_ecl_summary_cube_safely
+from .report_snapshot_cache import invalidate_report_snapshots
 
 EXCHANGE_RATE_API_URL = 'https://v6.exchangerate-api.com/v6/'
 
-def get_latest_run_skey():
-    """Retrieve the latest_run_skey from Dim_Run table."""
-    try:
-        run_record = Dim_Run.objects.first()
-        if not run_record:
-            save_log('get_latest_run_skey', 'ERROR', "No run key available in Dim_Run table.")
-            return None
-        return run_record.latest_run_skey
-    except Dim_Run.DoesNotExist:
-        save_log('get_latest_run_skey', 'ERROR', "Dim_Run table is missing.")
-        return None
 
 def get_exchange_rates_from_api(base_currency, date=None, use_latest=False):
     """Fetch exchange rates for a base currency either for the latest or for a specific date (historical)."""
@@ -177,6 +169,10 @@ def update_reporting_lines_with_exchange_rate(fic_mis_date):
             return 0
 
         update_result = update_reporting_lines(fic_mis_date, exchange_rate_dict, target_currency_code)
+
+        # Reporting currency amounts changed; rebuild the summary cube for the run
+        refresh_ecl_summary_cube_safely(fic_mis_date, get_latest_run_skey())
+        invalidate_report_snapshots(fic_mis_date)
         return 1 
 
     except ValueError as ve:
@@ -1,21 +1,8 @@
 from decimal import Decimal
 from django.db import connection, transaction
-from IFRS9.models import Dim_Run
 from .save_log import save_log
+from .reference_data import get_latest_run_skey
 
-def get_latest_run_skey():
-    """
-    Retrieve the latest_run_skey from Dim_Run table.
-    """
-    try:
-        run_record = Dim_Run.objects.first()
-        if not run_record:
-            save_log('get_latest_run_skey', 'ERROR', "No run key is available in Dim_Run table.")
-            return None
-        return run_record.latest_run_skey
-    except Exception as e:
-        save_log('get_latest_run_skey', 'ERROR', f"Error retrieving latest run key: {e}")
-        return None
 
 def calculate_expected_cash_flow(fic_mis_date):
     """
@@ -1,66 +1,57 @@
 from django.db import connection, transaction
-from IFRS9.models import Dim_Run
 from .save_log import save_log
+from .reference_data import get_latest_run_skey
+from .batching import shard_filter
+from .ecl_summary_cube import refresh_ecl_summary_cube_safely
+from .report_snapshot_cache import invalidate_report_snapshots
 
 # ------------------------------------------------------------------------
-# 1) Retrieve Latest Run Key
+# 1) Latest Run Key: get_latest_run_skey, from the run context (reference_data)
 # ------------------------------------------------------------------------
-def get_latest_run_skey():
-    """
-    Retrieve the latest_run_skey from Dim_Run table.
-    """
-    try:
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT latest_run_skey FROM dim_run LIMIT 1;")
-            result = cursor.fetchone()
-            if result:
-                return result[0]
-            save_log('get_latest_run_skey', 'ERROR', "No run key is available in the Dim_Run table.")
-            return None
-    except Exception as e:
-        save_log('get_latest_run_skey', 'ERROR', f"Error fetching run key: {e}")
-        return None
 
 # ------------------------------------------------------------------------
 # 2) ECL Calculation: Cash Shortfall
 # ------------------------------------------------------------------------
-def update_ecl_based_on_cash_shortfall_sql(n_run_key, fic_mis_date, uses_discounting):
+def update_ecl_based_on_cash_shortfall_sql(n_run_key, fic_mis_date, uses_discounting, shard=None):
     """
     Optimized SQL-based update of ECL based on cash shortfall or present value.
+    With shard = (index, count), only the accounts of that hash shard are updated.
     """
+    cf_shard, shard_params = shard_filter('v_account_number', shard)
+    rl_shard, _ = shard_filter('rl.n_account_number', shard)
     try:
         with transaction.atomic(), connection.cursor() as cursor:
             # Preload data into a temporary table
             cursor.execute("DROP TABLE IF EXISTS temp_cash_shortfall;")
             if uses_discounting:
-                cursor.execute("""
+                cursor.execute(f"""
                     CREATE TEMP TABLE temp_cash_shortfall AS
                     SELECT
                         v_account_number,
                         SUM(n_cash_shortfall_pv) AS total_cash_shortfall_pv,
                         SUM(n_12m_cash_shortfall_pv) AS total_12m_cash_shortfall_pv
                     FROM fsi_financial_cash_flow_cal
-                    WHERE n_run_skey = %s AND fic_mis_date = %s
+                    WHERE n_run_skey = %s AND fic_mis_date = %s{cf_shard}
                     GROUP BY v_account_number;
-                """, [n_run_key, fic_mis_date])
+                """, [n_run_key, fic_mis_date] + shard_params)
             else:
-                cursor.execute("""
+                cursor.execute(f"""
                     CREATE TEMP TABLE temp_cash_shortfall AS
                     SELECT
                         v_account_number,
                         SUM(n_cash_shortfall) AS total_cash_shortfall,
                         SUM(n_12m_cash_shortfall) AS total_12m_cash_shortfall
                     FROM fsi_financial_cash_flow_cal
-                    WHERE n_run_skey = %s AND fic_mis_date = %s
+                    WHERE n_run_skey = %s AND fic_mis_date = %s{cf_shard}
                     GROUP BY v_account_number;
-                """, [n_run_key, fic_mis_date])
+                """, [n_run_key, fic_mis_date] + shard_params)
 
             # Index the temporary table for faster joins
             cursor.execute("CREATE INDEX idx_temp_cash_shortfall ON temp_cash_shortfall(v_account_number);")
 
             # Perform the update using the temporary table
             if uses_discounting:
-                cursor.execute("""
+                cursor.execute(f"""
                     UPDATE fct_reporting_lines AS rl
                     SET
                         n_lifetime_ecl_ncy = COALESCE(cf.total_cash_shortfall_pv, 0),
@@ -68,10 +59,10 @@ def update_ecl_based_on_cash_shortfall_sql(n_run_key, fic_mis_date, uses_discoun
                     FROM temp_cash_shortfall cf
                     WHERE rl.n_account_number = cf.v_account_number
                       AND rl.n_run_key = %s
-                      AND rl.fic_mis_date = %s;
-                """, [n_run_key, fic_mis_date])
+                      AND rl.fic_mis_date = %s{rl_shard};
+                """, [n_run_key, fic_mis_date] + shard_params)
             else:
-                cursor.execute("""
+                cursor.execute(f"""
                     UPDATE fct_reporting_lines AS rl
                     SET
                         n_lifetime_ecl_ncy = COALESCE(cf.total_cash_shortfall, 0),
@@ -79,57 +70,62 @@ def update_ecl_based_on_cash_shortfall_sql(n_run_key, fic_mis_date, uses_discoun
                     FROM temp_cash_shortfall cf
                     WHERE rl.n_account_number = cf.v_account_number
                       AND rl.n_run_key = %s
-                      AND rl.fic_mis_date = %s;
-                """, [n_run_key, fic_mis_date])
+                      AND rl.fic_mis_date = %s{rl_shard};
+                """, [n_run_key, fic_mis_date] + shard_params)
 
         save_log(
             'update_ecl_based_on_cash_shortfall_sql',
             'INFO',
             f"Successfully updated ECL based on cash shortfall for run key {n_run_key}, date {fic_mis_date}."
         )
+        return True
     except Exception as e:
         save_log('update_ecl_based_on_cash_shortfall_sql', 'ERROR', f"Error: {e}")
+        return False
 
 # ------------------------------------------------------------------------
 # 3) ECL Calculation: Forward Loss
 # ------------------------------------------------------------------------
-def update_ecl_based_on_forward_loss_sql(n_run_key, fic_mis_date, uses_discounting):
+def update_ecl_based_on_forward_loss_sql(n_run_key, fic_mis_date, uses_discounting, shard=None):
     """
     Optimized SQL-based update of ECL based on forward loss or present value.
+    With shard = (index, count), only the accounts of that hash shard are updated.
     """
+    cf_shard, shard_params = shard_filter('v_account_number', shard)
+    rl_shard, _ = shard_filter('rl.n_account_number', shard)
     try:
         with transaction.atomic(), connection.cursor() as cursor:
             # Preload data into a temporary table
             cursor.execute("DROP TABLE IF EXISTS temp_forward_loss;")
             if uses_discounting:
-                cursor.execute("""
+                cursor.execute(f"""
                     CREATE TEMP TABLE temp_forward_loss AS
                     SELECT
                         v_account_number,
                         SUM(n_forward_expected_loss_pv) AS total_fwd_loss_pv,
                         SUM(n_12m_fwd_expected_loss_pv) AS total_12m_fwd_loss_pv
                     FROM fsi_financial_cash_flow_cal
-                    WHERE n_run_skey = %s AND fic_mis_date = %s
+                    WHERE n_run_skey = %s AND fic_mis_date = %s{cf_shard}
                     GROUP BY v_account_number;
-                """, [n_run_key, fic_mis_date])
+                """, [n_run_key, fic_mis_date] + shard_params)
             else:
-                cursor.execute("""
+                cursor.execute(f"""
                     CREATE TEMP TABLE temp_forward_loss AS
                     SELECT
                         v_account_number,
                         SUM(n_forward_expected_loss) AS total_fwd_loss,
                         SUM(n_12m_fwd_expected_loss) AS total_12m_fwd_loss
                     FROM fsi_financial_cash_flow_cal
-                    WHERE n_run_skey = %s AND fic_mis_date = %s
+                    WHERE n_run_skey = %s AND fic_mis_date = %s{cf_shard}
                     GROUP BY v_account_number;
-                """, [n_run_key, fic_mis_date])
+                """, [n_run_key, fic_mis_date] + shard_params)
 
             # Index the temporary table for faster joins
             cursor.execute("CREATE INDEX idx_temp_forward_loss ON temp_forward_loss(v_account_number);")
 
             # Perform the update using the temporary table
             if uses_discounting:
-                cursor.execute("""
+                cursor.execute(f"""
                     UPDATE fct_reporting_lines AS rl
                     SET
                         n_lifetime_ecl_ncy = COALESCE(fwd.total_fwd_loss_pv, 0),
@@ -137,10 +133,10 @@ def update_ecl_based_on_forward_loss_sql(n_run_key, fic_mis_date, uses_discounti
                     FROM temp_forward_loss fwd
                     WHERE rl.n_account_number = fwd.v_account_number
                       AND rl.n_run_key = %s
-                      AND rl.fic_mis_date = %s;
-                """, [n_run_key, fic_mis_date])
+                      AND rl.fic_mis_date = %s{rl_shard};
+                """, [n_run_key, fic_mis_date] + shard_params)
             else:
-                cursor.execute("""
+                cursor.execute(f"""
                     UPDATE fct_reporting_lines AS rl
                     SET
                         n_lifetime_ecl_ncy = COALESCE(fwd.total_fwd_loss, 0),
@@ -148,47 +144,72 @@ def update_ecl_based_on_forward_loss_sql(n_run_key, fic_mis_date, uses_discounti
                     FROM temp_forward_loss fwd
                     WHERE rl.n_account_number = fwd.v_account_number
                       AND rl.n_run_key = %s
-                      AND rl.fic_mis_date = %s;
-                """, [n_run_key, fic_mis_date])
+                      AND rl.fic_mis_date = %s{rl_shard};
+                """, [n_run_key, fic_mis_date] + shard_params)
 
         save_log(
             'update_ecl_based_on_forward_loss_sql',
             'INFO',
             f"Successfully updated ECL based on forward loss for run key {n_run_key}, date {fic_mis_date}."
         )
+        return True
     except Exception as e:
         save_log('update_ecl_based_on_forward_loss_sql', 'ERROR', f"Error: {e}")
+        return False
 
 
 # ------------------------------------------------------------------------
 # 5) ECL Calculation: Internal Formula
 # ------------------------------------------------------------------------
-def update_ecl_based_on_internal_calculations_sql(n_run_key, fic_mis_date):
+def update_ecl_based_on_internal_calculations_sql(n_run_key, fic_mis_date, shard=None):
     """
     SQL-based update of ECL using internal formula: EAD * PD * LGD.
+    With shard = (index, count), only the accounts of that hash shard are updated.
     """
+    rl_shard, shard_params = shard_filter('n_account_number', shard)
     try:
         with transaction.atomic(), connection.cursor() as cursor:
-            cursor.execute("""
+            cursor.execute(f"""
                 UPDATE fct_reporting_lines
                 SET
                     n_lifetime_ecl_ncy = COALESCE(n_exposure_at_default_ncy, 0) * COALESCE(n_lifetime_pd, 0) * COALESCE(n_lgd_percent, 0),
                     n_12m_ecl_ncy = COALESCE(n_exposure_at_default_ncy, 0) * COALESCE(n_twelve_months_pd, 0) * COALESCE(n_lgd_percent, 0)
-                WHERE n_run_key = %s AND fic_mis_date = %s;
-            """, [n_run_key, fic_mis_date])
+                WHERE n_run_key = %s AND fic_mis_date = %s{rl_shard};
+            """, [n_run_key, fic_mis_date] + shard_params)
 
         save_log(
             'update_ecl_based_on_internal_calculations_sql',
             'INFO',
             f"Successfully updated ECL using internal formula for run key {n_run_key}, date {fic_mis_date}."
         )
+        return True
     except Exception as e:
         save_log('update_ecl_based_on_internal_calculations_sql', 'ERROR', f"Error: {e}")
+        return False
 
 
 # ------------------------------------------------------------------------
 # 4) Dispatcher for ECL Calculation
 # ------------------------------------------------------------------------
+ECL_METHODS = ('forward_exposure', 'cash_flow', 'simple_ead')
+
+
+def get_ecl_method():
+    """Return (method_name, uses_discounting) of the configured ECL method, or None."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT method_name, uses_discounting FROM dim_ecl_method LIMIT 1;")
+        return cursor.fetchone()
+
+
+def update_ecl_for_method(method_name, n_run_key, fic_mis_date, uses_discounting, shard=None):
+    """Run the ECL update of method_name, for one account shard if given. Returns True on success."""
+    if method_name == 'forward_exposure':
+        return update_ecl_based_on_forward_loss_sql(n_run_key, fic_mis_date, uses_discounting, shard)
+    if method_name == 'cash_flow':
+        return update_ecl_based_on_cash_shortfall_sql(n_run_key, fic_mis_date, uses_discounting, shard)
+    return update_ecl_based_on_internal_calculations_sql(n_run_key, fic_mis_date, shard)
+
+
 def calculate_ecl_based_on_method(fic_mis_date):
     """
     Dispatch to the correct SQL-based ECL calculation method.
@@ -200,32 +221,29 @@ def calculate_ecl_based_on_method(fic_mis_date):
             return '0'
 
         # Fetch the ECL method
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT method_name, uses_discounting FROM dim_ecl_method LIMIT 1;")
-            result = cursor.fetchone()
-            if not result:
-                save_log('calculate_ecl_based_on_method', 'ERROR', "No ECL method is defined in the dim_ecl_method table.")
-                return '0'
-
-            method_name, uses_discounting = result
-            save_log(
-                'calculate_ecl_based_on_method',
-                'INFO',
-                f"Using ECL Method: {method_name}, Discounting: {uses_discounting}, Run Key: {n_run_key}"
-            )
+        result = get_ecl_method()
+        if not result:
+            save_log('calculate_ecl_based_on_method', 'ERROR', "No ECL method is defined in the dim_ecl_method table.")
+            return '0'
+
+        method_name, uses_discounting = result
+        save_log(
+            'calculate_ecl_based_on_method',
+            'INFO',
+            f"Using ECL Method: {method_name}, Discounting: {uses_discounting}, Run Key: {n_run_key}"
+        )
 
         # Dispatch to the correct method
-        if method_name == 'forward_exposure':
-            update_ecl_based_on_forward_loss_sql(n_run_key, fic_mis_date, uses_discounting)
-        elif method_name == 'cash_flow':
-            update_ecl_based_on_cash_shortfall_sql(n_run_key, fic_mis_date, uses_discounting)
-        elif method_name == 'simple_ead':
-            update_ecl_based_on_internal_calculations_sql(n_run_key, fic_mis_date)
-        else:
+        if method_name not in ECL_METHODS:
             save_log('calculate_ecl_based_on_method', 'ERROR', f"Unknown ECL method: {method_name}")
             return '0'
+        update_ecl_for_method(method_name, n_run_key, fic_mis_date, uses_discounting)
 
         save_log('calculate_ecl_based_on_method', 'INFO', "ECL calculation completed successfully.")
+
+        # Keep the ECL summary report in step with the reporting lines
+        refresh_ecl_summary_cube_safely(fic_mis_date, n_run_key)
+        invalidate_report_snapshots(fic_mis_date)
         return '1'
 
     except Exception as e:
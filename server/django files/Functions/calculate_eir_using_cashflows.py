@@ -1,127 +1,190 @@
 # your_app/management/commands/update_eir_parallel.py
 
-import numpy_financial as nf
+import numpy as np
 from decimal import Decimal, ROUND_HALF_UP
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import connection
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import math
+from django.db import connection, transaction
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import brentq
 from datetime import datetime
 
 # Import your logging utility
 from .save_log import save_log  # Adjust the import path as necessary
+from .bulk_copy import update_from_rows
 
 # Define EIR boundaries (as decimal fractions)
 MAX_EIR = Decimal('9.9999999999999')  # Max value as decimal fraction (999.99999999999%)
 MIN_EIR = Decimal('0')                # Minimum EIR value (0%)
 
-def process_chunk(rows):
+# Periods per year used to annualize the periodic IRR
+PERIODS_PER_YEAR = {'M': 12, 'Q': 4, 'H': 2, 'W': 52, 'D': 365, 'Y': 1}
+
+# Accounts solved together in one padded (accounts x periods) matrix
+ACCOUNT_CHUNK_SIZE = 20000
+
+# Newton iterations run on the whole chunk before falling back to bracketing
+NEWTON_MAX_ITER = 50
+NEWTON_TOLERANCE = 1e-12
+
+# Periodic rates scanned for a sign change when Newton does not converge
+BRACKET_RATES = np.concatenate([
+    [-0.9999, -0.999, -0.99],
+    np.linspace(-0.95, -0.05, 19),
+    np.linspace(-0.04, 0.04, 81),
+    np.linspace(0.05, 1.0, 20),
+    [1.5, 2.0, 5.0, 10.0, 100.0],
+])
+
+# Worker processes used to solve the chunks; 1 solves them in the calling process
+EIR_PROCESS_WORKERS = getattr(settings, 'EIR_PROCESS_WORKERS', 1)
+
+
+def build_cash_flow_matrix(carrying_amounts, cash_flow_lists):
+    """
+    Build the padded cash flow matrix of a chunk: column 0 holds -carrying_amount and the
+    following columns the future cash flows (NULL flows dropped). Zero padding leaves the NPV unchanged.
     """
-    Process a chunk of rows to compute EIR and update the database.
+    cash_flow_lists = [[float(x) for x in flows if x is not None] for flows in cash_flow_lists]
+    matrix = np.zeros((len(cash_flow_lists), 1 + max(len(flows) for flows in cash_flow_lists)))
+    matrix[:, 0] = -np.asarray(carrying_amounts, dtype=float)
+    for row, flows in enumerate(cash_flow_lists):
+        matrix[row, 1:len(flows) + 1] = flows
+    return matrix
 
-    Parameters:
-    - rows: List of tuples in the format (id, account_number, carrying_amount, term_unit, [future_cash_flows])
+
+def npv_and_derivative(matrix, rates):
     """
-    with connection.cursor() as cursor:
-        for record in rows:
-            stage_id = record[0]
-            account_number = record[1]
-            carrying_amount = record[2]
-            term_unit = record[3]
-            future_cf_list = record[4]
-
-            # Skip if no carrying amount or no future cash flows
-            if carrying_amount is None or not future_cf_list:
-                save_log(
-                    'process_chunk',
-                    'WARNING',
-                    f"Skipping account_number={account_number} (stage_id={stage_id}) due to missing carrying amount or cash flows."
-                )
-                continue
+    NPV of each row of matrix at its periodic rate, and the derivative of the NPV with respect to
+    the rate, evaluated with Horner's scheme in v = 1 / (1 + rate).
+    """
+    v = 1.0 / (1.0 + rates)
+    npv = np.zeros(len(matrix))
+    dnpv_dv = np.zeros(len(matrix))
+    # Rates close to -1 overflow to inf; callers treat non-finite values as a breakdown
+    with np.errstate(over='ignore', invalid='ignore'):
+        for column in range(matrix.shape[1] - 1, -1, -1):
+            dnpv_dv = dnpv_dv * v + npv
+            npv = npv * v + matrix[:, column]
+        return npv, -v * v * dnpv_dv
 
-            # Build the cash flow list (time 0 = -carrying_amount)
-            try:
-                cash_flows = [-float(carrying_amount)]
-                cash_flows.extend(float(x) for x in future_cf_list if x is not None)
-            except (ValueError, TypeError) as e:
-                save_log(
-                    'process_chunk',
-                    'ERROR',
-                    f"Invalid cash flow data for account_number={account_number} (stage_id={stage_id}): {e}"
-                )
-                continue
 
-            # Compute periodic IRR
-            try:
-                periodic_irr = nf.irr(cash_flows)
-                if periodic_irr is None:
-                    raise ValueError("IRR computation returned None.")
-            except Exception as e:
-                save_log(
-                    'process_chunk',
-                    'ERROR',
-                    f"IRR computation failed for account_number={account_number} (stage_id={stage_id}): {e}"
-                )
-                continue
+def solve_irr_newton(matrix):
+    """
+    Newton iterations from a zero rate on all rows at once. Rows leave the active set when their step
+    falls below NEWTON_TOLERANCE, or when the iteration breaks down (zero derivative, rate <= -1).
 
-            # Convert periodic IRR to annual EIR based on term_unit
-            if term_unit == 'M':  # Monthly
-                annual_eir = (1 + periodic_irr) ** 12 - 1
-            elif term_unit == 'Q':  # Quarterly
-                annual_eir = (1 + periodic_irr) ** 4 - 1
-            elif term_unit == 'H':  # Half-yearly
-                annual_eir = (1 + periodic_irr) ** 2 - 1
-            elif term_unit == 'W':  # Weekly
-                annual_eir = (1 + periodic_irr) ** 52 - 1
-            elif term_unit == 'D':  # Daily
-                annual_eir = (1 + periodic_irr) ** 365 - 1
-            elif term_unit == 'Y':  # Annual
-                annual_eir = periodic_irr
-            else:
-                # Default to periodic IRR if term unit is unknown
-                save_log(
-                    'process_chunk',
-                    'WARNING',
-                    f"Unknown term_unit='{term_unit}' for account_number={account_number} (stage_id={stage_id}). Using periodic IRR without annualization."
-                )
-                annual_eir = periodic_irr
-
-            # Convert EIR to decimal fraction and round appropriately
-            annual_eir_decimal = Decimal(annual_eir).quantize(Decimal('0.0000000000'), rounding=ROUND_HALF_UP)
-
-            # Clamp the EIR to [MIN_EIR, MAX_EIR]
-            annual_eir_decimal = max(min(annual_eir_decimal, MAX_EIR), MIN_EIR)
-
-            # Update the database
-            try:
-                cursor.execute("""
-                    UPDATE fct_stage_determination
-                       SET n_effective_interest_rate = %s
-                     WHERE id = %s
-                """, [annual_eir_decimal, stage_id])
-                save_log(
-                    'process_chunk',
-                    'INFO',
-                    f"Updated EIR for account_number={account_number} (stage_id={stage_id}): {annual_eir_decimal}"
-                )
-            except Exception as e:
-                save_log(
-                    'process_chunk',
-                    'ERROR',
-                    f"Database update failed for account_number={account_number} (stage_id={stage_id}): {e}"
-                )
-                continue
+    :return: (rates, converged mask)
+    """
+    rates = np.zeros(len(matrix))
+    converged = np.zeros(len(matrix), dtype=bool)
+    active = np.arange(len(matrix))
+
+    for _ in range(NEWTON_MAX_ITER):
+        if not len(active):
+            break
+        npv, dnpv = npv_and_derivative(matrix[active], rates[active])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = npv / dnpv
+        new_rates = rates[active] - step
+
+        broken = ~np.isfinite(new_rates) | (new_rates <= -1)
+        done = ~broken & (np.abs(step) <= NEWTON_TOLERANCE * np.maximum(1.0, np.abs(new_rates)))
+
+        rates[active[~broken]] = new_rates[~broken]
+        converged[active[done]] = True
+        active = active[~broken & ~done]
+
+    return rates, converged
+
+
+def solve_irr_bracketed(cash_flows):
+    """
+    Fallback for a single account: scan BRACKET_RATES for sign changes of the NPV and solve the one
+    closest to a zero rate with Brent's method.
+
+    :return: Periodic IRR, or NaN when the NPV never changes sign.
+    """
+    npv, _ = npv_and_derivative(np.tile(cash_flows, (len(BRACKET_RATES), 1)), BRACKET_RATES)
+    sign_changes = np.nonzero(np.sign(npv[:-1]) * np.sign(npv[1:]) <= 0)[0]
+    if not len(sign_changes):
+        return np.nan
+
+    def npv_at(rate):
+        return npv_and_derivative(cash_flows[np.newaxis, :], np.array([rate]))[0][0]
+
+    for index in sorted(sign_changes, key=lambda i: min(abs(BRACKET_RATES[i]), abs(BRACKET_RATES[i + 1]))):
+        low, high = BRACKET_RATES[index], BRACKET_RATES[index + 1]
+        if npv[index] == 0:
+            return low
+        if npv[index + 1] == 0:
+            return high
+        try:
+            return brentq(npv_at, low, high, xtol=1e-15, rtol=1e-15, maxiter=200)
+        except (ValueError, RuntimeError):
+            continue
+    return np.nan
+
+
+def count_sign_changes(matrix):
+    """Number of sign changes along each row of matrix, ignoring zeros."""
+    signs = np.sign(matrix)
+    last_nonzero = np.maximum.accumulate(
+        np.where(signs != 0, np.arange(matrix.shape[1]), 0), axis=1
+    )
+    filled = np.take_along_axis(signs, last_nonzero, axis=1)
+    return (filled[:, 1:] * filled[:, :-1] < 0).sum(axis=1)
+
+
+def solve_irr_chunk(chunk):
+    """
+    Periodic IRR of every account of a chunk. Top-level so it can run in a worker process.
 
-def update_eir_using_cashflows(fic_mis_date):
+    With one sign change in the cash flows the IRR is unique and Newton finds it. Accounts with
+    several sign changes may have several IRRs; like numpy_financial.irr the one closest to zero is
+    wanted, so they go straight to the bracketing fallback.
+
+    :param chunk: (carrying_amounts, cash_flow_lists)
+    :return: (periodic IRRs with NaN where no IRR exists, number of accounts solved by bracketing)
+    """
+    matrix = build_cash_flow_matrix(*chunk)
+    single_root = count_sign_changes(matrix) <= 1
+    rates = np.full(len(matrix), np.nan)
+    converged = np.zeros(len(matrix), dtype=bool)
+    rates[single_root], converged[single_root] = solve_irr_newton(matrix[single_root])
+    fallback = np.nonzero(~converged)[0]
+    for row in fallback:
+        rates[row] = solve_irr_bracketed(matrix[row])
+    return rates, len(fallback)
+
+
+def annualize_eir(periodic_irr, term_unit):
+    """
+    Convert a periodic IRR to the annual EIR stored in fct_stage_determination, rounded to 10
+    decimals and clamped to [MIN_EIR, MAX_EIR].
     """
-    Main function to update EIR for all accounts on a given fic_mis_date using parallel processing.
+    periods = PERIODS_PER_YEAR.get(term_unit, 1)
+    annual_eir = periodic_irr if periods == 1 else (1 + periodic_irr) ** periods - 1
+    annual_eir_decimal = Decimal(annual_eir).quantize(Decimal('0.0000000000'), rounding=ROUND_HALF_UP)
+    return max(min(annual_eir_decimal, MAX_EIR), MIN_EIR)
+
+
+def update_eir_using_cashflows(fic_mis_date, max_workers=None):
+    """
+    Main function to update EIR for all accounts on a given fic_mis_date.
+
+    IRRs are solved chunk by chunk on padded cash flow matrices (Newton on the whole chunk, Brent
+    bracketing for accounts that do not converge), optionally across EIR_PROCESS_WORKERS processes,
+    and written back with a single temp-table UPDATE.
 
     Parameters:
     - fic_mis_date: The reporting date (datetime.date) for which to update EIR.
-    
+    - max_workers: Worker processes (default EIR_PROCESS_WORKERS).
+
     Returns:
     - bool: True if successful, False otherwise.
     """
+    max_workers = max_workers or EIR_PROCESS_WORKERS
     try:
         # Step 1: Fetch all relevant records with aggregated future cash flows
         with connection.cursor() as cursor:
@@ -160,48 +223,76 @@ def update_eir_using_cashflows(fic_mis_date):
             f"Fetched {total_rows} records for fic_mis_date={fic_mis_date}."
         )
 
-        # Step 2: Determine batch size (~5% each, resulting in ~20 batches)
-        batch_count = 20
-        batch_size = math.ceil(total_rows / batch_count)
-        batches = [rows[i:i + batch_size] for i in range(0, total_rows, batch_size)]
-        actual_batch_count = len(batches)
+        # Step 2: Skip accounts without a carrying amount or cash flows
+        valid = [row for row in rows if row[2] is not None and any(x is not None for x in row[4] or [])]
+        skipped = total_rows - len(valid)
+        if skipped:
+            save_log(
+                'update_eir_parallel',
+                'WARNING',
+                f"Skipped {skipped} accounts due to missing carrying amount or cash flows."
+            )
 
-        save_log(
-            'update_eir_parallel',
-            'INFO',
-            f"Partitioned data into {actual_batch_count} batches (each ~{batch_size} records)."
-        )
+        # Step 3: Solve the periodic IRRs chunk by chunk, in worker processes if configured
+        chunks = [
+            ([row[2] for row in valid[i:i + ACCOUNT_CHUNK_SIZE]], [row[4] for row in valid[i:i + ACCOUNT_CHUNK_SIZE]])
+            for i in range(0, len(valid), ACCOUNT_CHUNK_SIZE)
+        ]
+        if max_workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(solve_irr_chunk, chunks))
+        else:
+            results = [solve_irr_chunk(chunk) for chunk in chunks]
 
-        # Step 3: Process each batch in parallel using ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=actual_batch_count) as executor:
-            futures = [executor.submit(process_chunk, batch) for batch in batches]
-
-            # Monitor progress and handle exceptions
-            for future in as_completed(futures):
-                try:
-                    future.result()  # If process_chunk raises, re-raise here
-                except Exception as exc:
-                    save_log(
-                        'update_eir_parallel',
-                        'ERROR',
-                        f"Error in processing a batch: {exc}"
-                    )
-
-        # Step 4: Clamp the EIR values to [MIN_EIR, MAX_EIR] as an extra safety measure
-        # Note: This step might be redundant as clamping is done per row
-        # But included here for extra safety
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                UPDATE fct_stage_determination
-                SET n_effective_interest_rate = LEAST(GREATEST(n_effective_interest_rate, %s), %s)
-                WHERE fic_mis_date = %s
-                  AND n_effective_interest_rate IS NOT NULL;
-            """, [MIN_EIR, MAX_EIR, fic_mis_date])
+        periodic_irrs = np.concatenate([rates for rates, _ in results]) if results else np.array([])
+        bracketed_count = sum(count for _, count in results)
+
+        # Step 4: Annualize and write back with one UPDATE
+        updates = []
+        failed = []
+        unknown_units = set()
+        for row, periodic_irr in zip(valid, periodic_irrs):
+            if not np.isfinite(periodic_irr):
+                failed.append(row[1])
+                continue
+            if row[3] not in PERIODS_PER_YEAR:
+                unknown_units.add(row[3])
+            updates.append((row[0], annualize_eir(float(periodic_irr), row[3])))
+
+        if failed:
+            save_log(
+                'update_eir_parallel',
+                'ERROR',
+                f"IRR computation failed for {len(failed)} accounts (no rate where the NPV changes sign), "
+                f"e.g. account_number={', '.join(map(str, failed[:10]))}."
+            )
+        if unknown_units:
+            save_log(
+                'update_eir_parallel',
+                'WARNING',
+                f"Unknown term_unit values {sorted(map(str, unknown_units))}. Using periodic IRR without annualization."
+            )
+
+        with transaction.atomic():
+            updated_count = update_from_rows(
+                'fct_stage_determination', 'id', 'BIGINT', ['n_effective_interest_rate'], 'NUMERIC', updates
+            )
+
+            # Step 5: Clamp the EIR values to [MIN_EIR, MAX_EIR] as an extra safety measure
+            # Note: Rows written above are already clamped; only out-of-range rows are touched
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE fct_stage_determination
+                    SET n_effective_interest_rate = LEAST(GREATEST(n_effective_interest_rate, %s), %s)
+                    WHERE fic_mis_date = %s
+                      AND (n_effective_interest_rate < %s OR n_effective_interest_rate > %s);
+                """, [MIN_EIR, MAX_EIR, fic_mis_date, MIN_EIR, MAX_EIR])
 
         save_log(
             'update_eir_parallel',
             'INFO',
-            f"Successfully updated EIR for {total_rows} records on fic_mis_date={fic_mis_date}."
+            f"Successfully updated EIR for {updated_count} of {total_rows} records on fic_mis_date={fic_mis_date} "
+            f"({bracketed_count} solved by bracketing)."
         )
 
         return True
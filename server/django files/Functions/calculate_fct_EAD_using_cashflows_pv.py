@@ -1,6 +1,7 @@
 from django.db import connection, transaction
 from IFRS9.models import FCT_Stage_Determination
 from .save_log import save_log
+from .reference_data import get_latest_run_skey
 
 def update_stage_determination_ead_with_cashflow_pv(fic_mis_date):
     """
@@ -8,21 +9,17 @@ def update_stage_determination_ead_with_cashflow_pv(fic_mis_date):
     based on the sum of discounted cash flows from fsi_financial_cash_flow_cal.
     """
     try:
-        with transaction.atomic(), connection.cursor() as cursor:
-            # Step 1: Fetch the latest run key
-            cursor.execute("""
-                SELECT latest_run_skey FROM dim_run LIMIT 1
-            """)
-            result = cursor.fetchone()
-            if not result:
-                save_log(
-                    'update_stage_determination_ead_with_cashflow_pv',
-                    'ERROR',
-                    "No latest run key found in Dim_Run table."
-                )
-                return 0
-            run_skey = result[0]
+        # Step 1: Fetch the latest run key
+        run_skey = get_latest_run_skey()
+        if not run_skey:
+            save_log(
+                'update_stage_determination_ead_with_cashflow_pv',
+                'ERROR',
+                "No latest run key found in Dim_Run table."
+            )
+            return 0
 
+        with transaction.atomic(), connection.cursor() as cursor:
             # Step 2: Compute and update n_exposure_at_default
             cursor.execute("""
                 UPDATE fct_stage_determination
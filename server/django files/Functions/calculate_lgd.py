@@ -1,14 +1,13 @@
 from django.db import connection, transaction
 from .save_log import save_log
+from .reference_data import get_run_context
 
 def get_latest_run_skey_sql():
-    """Retrieve the latest_run_skey from Dim_Run table using raw SQL."""
-    with connection.cursor() as cursor:
-        cursor.execute("SELECT latest_run_skey FROM dim_run LIMIT 1;")
-        row = cursor.fetchone()
-        if not row:
-            raise ValueError("No run key available in Dim_Run table.")
-        return row[0]
+    """Retrieve the latest_run_skey from Dim_Run table through the run context."""
+    run_skey = get_run_context().get_latest_run_skey()
+    if run_skey is None:
+        raise ValueError("No run key available in Dim_Run table.")
+    return run_skey
 
 
 def update_lgd_for_stage_determination_term_structure(mis_date):
@@ -1,12 +1,31 @@
-import concurrent.futures
-from decimal import Decimal
-from math import pow
+from calendar import monthrange
+from collections import Counter
+from datetime import date
 
-from django.db.models import F
-from django.db import transaction
+from django.db import connection, transaction
 
 from IFRS9.models import CoolingPeriodDefinition, FCT_Stage_Determination
 from .save_log import save_log
+from .reference_data import get_run_context, run_context
+
+# Columns of fct_stage_determination set by the cooling period logic
+COOLING_FIELDS = [
+    'n_curr_ifrs_stage_skey', 'n_stage_descr', 'n_in_cooling_period_flag',
+    'd_cooling_start_date', 'n_cooling_period_duration', 'n_target_ifrs_stage_skey',
+]
+
+# Determined stage of each fixture account of compare_cooling_period_engines, one per month
+COOLING_FIXTURE = {
+    'NORMAL': [1, 1, 2, 2, 3, 3],
+    'START_HOLD': [3, 2, 2, 2, 2, 2],
+    'START_EXIT': [2, 1, 2, 1, 1, 3],
+    'DOUBLE_DROP': [3, 1, 1, 2, 1, 1],
+    'FLAP': [1, 2, 1, 2, 1, 2],
+}
+
+# Account number prefix and first month of the fixture; the year keeps it clear of real data
+COOLING_FIXTURE_PREFIX = 'COOLING-CHECK-'
+COOLING_FIXTURE_START = date(1900, 1, 31)
 
 
 def get_previous_stage_and_cooling_status(account_number, fic_mis_date):
@@ -45,7 +64,7 @@ def start_cooling_period(account, previous_stage, current_stage):
     """
     try:
         # Attempt to fetch CoolingPeriodDefinition for the account’s amortization unit
-        cooling_def = CoolingPeriodDefinition.objects.get(v_amrt_term_unit=account.v_amrt_term_unit)
+        cooling_def = get_run_context().get_cooling_period_definition(account.v_amrt_term_unit)
     except CoolingPeriodDefinition.DoesNotExist:
         save_log(
             'start_cooling_period',
@@ -126,15 +145,17 @@ def process_single_account(account):
         return None
 
 
-def process_cooling_period_for_accounts(fic_mis_date, num_threads=4, batch_size=2000, update_batch_size=5000):
+def process_cooling_period_for_accounts(fic_mis_date):
     """
-    Process cooling period logic for accounts based on a given fic_mis_date using multi-threading.
-    Leverages chunking, parallel execution, and optional sub-batch updates for performance.
+    Process cooling period logic for all accounts of fic_mis_date in a single set-based UPDATE.
+
+    The previous stage and cooling flag of every account are read with one DISTINCT ON query, and
+    the state machine of process_single_account is applied as a CASE expression:
+    EXIT (stage back to or above the previous one), EXPIRED (cooling period elapsed), HOLD (still
+    cooling), START (stage decreased) and NORMAL. Accounts without a previous stage, or whose
+    amortization unit has no single cooling definition, are left unchanged.
 
     :param fic_mis_date:      MIS date
-    :param num_threads:       Parallel threads for processing
-    :param batch_size:        Number of records processed in each thread
-    :param update_batch_size: Number of records to update in each bulk update sub-batch
     :return:                  1 if success, 0 otherwise
     """
     try:
@@ -148,23 +169,11 @@ def process_cooling_period_for_accounts(fic_mis_date, num_threads=4, batch_size=
             )
             return 0
 
-        # We only need columns used in the logic
-        accounts_qs = (
+        total_accounts = (
             FCT_Stage_Determination.objects
             .filter(fic_mis_date=fic_mis_date, v_amrt_term_unit__in=valid_amrt_units)
-            .only(
-                'n_account_number',
-                'fic_mis_date',
-                'n_curr_ifrs_stage_skey',
-                'n_in_cooling_period_flag',
-                'd_cooling_start_date',
-                'n_cooling_period_duration',
-                'n_target_ifrs_stage_skey',
-                'n_stage_descr',
-                'v_amrt_term_unit',
-            )
+            .count()
         )
-        total_accounts = accounts_qs.count()
         if total_accounts == 0:
             save_log(
                 'process_cooling_period_for_accounts',
@@ -179,72 +188,103 @@ def process_cooling_period_for_accounts(fic_mis_date, num_threads=4, batch_size=
             f"Processing {total_accounts} accounts for fic_mis_date={fic_mis_date}..."
         )
 
-        # Convert to list for parallel processing
-        accounts_list = list(accounts_qs)
-
-        def chunker(seq, size):
-            for pos in range(0, len(seq), size):
-                yield seq[pos:pos + size]
-
-        # Parallel processing of accounts
-        updated_accounts = []
-        error_occurred = False
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-            futures = []
-            for batch in chunker(accounts_list, batch_size):
-                futures.append(
-                    executor.submit(process_batch_of_accounts, batch)
+        cooling_table = connection.ops.quote_name(CoolingPeriodDefinition._meta.db_table)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH previous_state AS (
+                    SELECT DISTINCT ON (p.n_account_number)
+                        p.n_account_number,
+                        p.n_curr_ifrs_stage_skey AS previous_stage,
+                        COALESCE(p.n_in_cooling_period_flag, FALSE) AS was_in_cooling_period
+                    FROM fct_stage_determination p
+                    WHERE p.fic_mis_date < %s
+                      AND p.n_account_number IN (
+                          SELECT n_account_number FROM fct_stage_determination WHERE fic_mis_date = %s
+                      )
+                    ORDER BY p.n_account_number, p.fic_mis_date DESC
+                ),
+                cooling_definition AS (
+                    -- A unit defined more than once cannot start a cooling period
+                    SELECT v_amrt_term_unit, MIN(n_cooling_period_days) AS n_cooling_period_days
+                    FROM {cooling_table}
+                    GROUP BY v_amrt_term_unit
+                    HAVING COUNT(*) = 1
+                ),
+                transition AS (
+                    SELECT
+                        sd.id,
+                        ps.previous_stage,
+                        cd.n_cooling_period_days,
+                        CASE
+                            WHEN ps.was_in_cooling_period
+                                 AND sd.n_curr_ifrs_stage_skey >= ps.previous_stage THEN 'EXIT'
+                            WHEN ps.was_in_cooling_period
+                                 AND sd.d_cooling_start_date IS NOT NULL
+                                 AND sd.fic_mis_date - sd.d_cooling_start_date >= COALESCE(sd.n_cooling_period_duration, 0)
+                                 THEN 'EXPIRED'
+                            WHEN ps.was_in_cooling_period THEN 'HOLD'
+                            WHEN sd.n_curr_ifrs_stage_skey < ps.previous_stage
+                                 AND cd.v_amrt_term_unit IS NOT NULL THEN 'START'
+                            WHEN sd.n_curr_ifrs_stage_skey < ps.previous_stage THEN NULL
+                            ELSE 'NORMAL'
+                        END AS v_transition
+                    FROM fct_stage_determination sd
+                    JOIN previous_state ps
+                      ON ps.n_account_number = sd.n_account_number
+                     AND ps.previous_stage IS NOT NULL
+                    LEFT JOIN cooling_definition cd
+                      ON cd.v_amrt_term_unit = sd.v_amrt_term_unit
+                    WHERE sd.fic_mis_date = %s
+                      AND sd.v_amrt_term_unit = ANY(%s)
+                      AND sd.n_curr_ifrs_stage_skey IS NOT NULL
                 )
-
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    batch_result = future.result()
-                    if batch_result is None:
-                        error_occurred = True
-                    else:
-                        updated_accounts.extend(batch_result)
-                except Exception as exc:
-                    save_log(
-                        'process_cooling_period_for_accounts',
-                        'ERROR',
-                        f"Thread batch processing error: {exc}"
-                    )
-                    error_occurred = True
-
-        if error_occurred:
-            # Return early if there's a major failure
-            return 0
-
-        # Bulk update all changes in sub-batches
-        total_updates = len(updated_accounts)
-        if total_updates == 0:
-            save_log(
-                'process_cooling_period_for_accounts',
-                'INFO',
-                "No records needed updating after processing logic."
-            )
-            return 0
-
-        with transaction.atomic():
-            for start in range(0, total_updates, update_batch_size):
-                end = start + update_batch_size
-                FCT_Stage_Determination.objects.bulk_update(
-                    updated_accounts[start:end],
-                    [
-                        'n_in_cooling_period_flag',
-                        'd_cooling_start_date',
-                        'n_cooling_period_duration',
-                        'n_target_ifrs_stage_skey',
-                        'n_curr_ifrs_stage_skey',
-                        'n_stage_descr',
-                    ]
-                )
-
+                UPDATE fct_stage_determination sd
+                SET
+                    n_in_cooling_period_flag = CASE t.v_transition
+                        WHEN 'EXIT' THEN FALSE
+                        WHEN 'EXPIRED' THEN FALSE
+                        WHEN 'START' THEN TRUE
+                        ELSE sd.n_in_cooling_period_flag
+                    END,
+                    d_cooling_start_date = CASE t.v_transition
+                        WHEN 'EXIT' THEN NULL
+                        WHEN 'START' THEN sd.fic_mis_date
+                        ELSE sd.d_cooling_start_date
+                    END,
+                    n_cooling_period_duration = CASE t.v_transition
+                        WHEN 'EXIT' THEN NULL
+                        WHEN 'START' THEN t.n_cooling_period_days
+                        ELSE sd.n_cooling_period_duration
+                    END,
+                    n_target_ifrs_stage_skey = CASE t.v_transition
+                        WHEN 'EXIT' THEN NULL
+                        WHEN 'EXPIRED' THEN NULL
+                        WHEN 'START' THEN sd.n_curr_ifrs_stage_skey
+                        ELSE sd.n_target_ifrs_stage_skey
+                    END,
+                    n_curr_ifrs_stage_skey = CASE
+                        WHEN t.v_transition IN ('HOLD', 'START') THEN t.previous_stage
+                        ELSE sd.n_curr_ifrs_stage_skey
+                    END,
+                    n_stage_descr = 'Stage ' || CASE
+                        WHEN t.v_transition IN ('HOLD', 'START') THEN t.previous_stage
+                        ELSE sd.n_curr_ifrs_stage_skey
+                    END
+                FROM transition t
+                WHERE sd.id = t.id
+                  AND t.v_transition IS NOT NULL
+                RETURNING t.v_transition;
+            """, [fic_mis_date, fic_mis_date, fic_mis_date, valid_amrt_units])
+            transitions = Counter(row[0] for row in cursor.fetchall())
+
+        updated_count = sum(transitions.values())
         save_log(
             'process_cooling_period_for_accounts',
             'INFO',
-            f"Successfully processed cooling periods for {total_updates} accounts on fic_mis_date={fic_mis_date}."
+            f"Successfully processed cooling periods for {total_accounts} accounts on fic_mis_date={fic_mis_date}: "
+            f"{updated_count} with a previous stage ("
+            + ', '.join(f"{name}={count}" for name, count in sorted(transitions.items()))
+            + f"), {total_accounts - updated_count} unchanged."
         )
         return 1
 
@@ -257,16 +297,104 @@ def process_cooling_period_for_accounts(fic_mis_date, num_threads=4, batch_size=
         return 0
 
 
-def process_batch_of_accounts(batch):
+def get_cooling_fixture_dates():
+    """Month-end reporting dates of the cooling period fixture."""
+    months = len(next(iter(COOLING_FIXTURE.values())))
+    dates = []
+    for offset in range(months):
+        year, month = divmod(COOLING_FIXTURE_START.month - 1 + offset, 12)
+        year += COOLING_FIXTURE_START.year
+        dates.append(date(year, month + 1, monthrange(year, month + 1)[1]))
+    return dates
+
+
+def run_cooling_fixture(dates, set_based):
+    """
+    Load the COOLING_FIXTURE accounts month by month and apply one cooling period engine after
+    each month. Every account is loaded twice: once as a fresh row each month, and once
+    (suffix -CARRY) with the cooling fields of its previous month carried over, so the expiry of
+    a cooling period is exercised too.
+
+    :param set_based: Use process_cooling_period_for_accounts, else process_single_account.
+    :return: {(account number, fic_mis_date): tuple of the COOLING_FIELDS values}.
+    """
+    previous = {}
+    for month, fic_mis_date in enumerate(dates):
+        rows = []
+        for name, stages in COOLING_FIXTURE.items():
+            for carry in (False, True):
+                account_number = f"{COOLING_FIXTURE_PREFIX}{name}{'-CARRY' if carry else ''}"
+                row = FCT_Stage_Determination(
+                    fic_mis_date=fic_mis_date,
+                    n_account_number=account_number,
+                    v_amrt_term_unit='M',
+                    n_curr_ifrs_stage_skey=stages[month],
+                    n_stage_descr=f"Stage {stages[month]}",
+                )
+                if carry and account_number in previous:
+                    for field in COOLING_FIELDS[2:]:
+                        setattr(row, field, getattr(previous[account_number], field))
+                rows.append(row)
+        FCT_Stage_Determination.objects.bulk_create(rows)
+
+        accounts = FCT_Stage_Determination.objects.filter(
+            fic_mis_date=fic_mis_date, n_account_number__startswith=COOLING_FIXTURE_PREFIX
+        )
+        if set_based:
+            process_cooling_period_for_accounts(fic_mis_date)
+        else:
+            for account in accounts:
+                account = process_single_account(account)
+                if account is not None:
+                    account.save(update_fields=COOLING_FIELDS)
+
+        previous = {account.n_account_number: account for account in accounts.all()}
+
+    return {
+        (row[0], row[1]): row[2:]
+        for row in FCT_Stage_Determination.objects.filter(
+            fic_mis_date__in=dates, n_account_number__startswith=COOLING_FIXTURE_PREFIX
+        ).values_list('n_account_number', 'fic_mis_date', *COOLING_FIELDS)
+    }
+
+
+def compare_cooling_period_engines(cooling_period_days=60):
     """
-    Helper function to process a list (batch) of accounts and return updated accounts.
+    Regression check of the set-based cooling period UPDATE against process_single_account on a
+    multi-month fixture (COOLING_FIXTURE). The fixture uses a single monthly cooling period
+    definition of cooling_period_days and runs in a transaction that is always rolled back, so
+    neither fct_stage_determination nor the cooling period definitions are changed.
+
+    :return: List of differences as (account number, fic_mis_date, field, set-based value,
+             per-account value); empty when both engines agree.
     """
-    updated_local = []
-    for account in batch:
-        updated_acc = process_single_account(account)
-        if updated_acc:
-            updated_local.append(updated_acc)
-    return updated_local
+    dates = get_cooling_fixture_dates()
+
+    # A run context of its own, so the fixture definition is not cached beyond the check
+    with run_context(), transaction.atomic():
+        if FCT_Stage_Determination.objects.filter(fic_mis_date__in=dates).exists():
+            raise ValueError(f"fct_stage_determination already holds data between {dates[0]} and {dates[-1]}.")
+
+        CoolingPeriodDefinition.objects.all().delete()
+        CoolingPeriodDefinition.objects.create(v_amrt_term_unit='M', n_cooling_period_days=cooling_period_days)
+
+        results = []
+        for set_based in (True, False):
+            with transaction.atomic():
+                results.append(run_cooling_fixture(dates, set_based))
+                transaction.set_rollback(True)
+
+        transaction.set_rollback(True)
+
+    set_based_result, per_account_result = results
+    differences = []
+    for key in sorted(set(set_based_result) | set(per_account_result)):
+        set_based_values = set_based_result.get(key, (None,) * len(COOLING_FIELDS))
+        per_account_values = per_account_result.get(key, (None,) * len(COOLING_FIELDS))
+        for field, set_based_value, per_account_value in zip(COOLING_FIELDS, set_based_values, per_account_values):
+            if set_based_value != per_account_value:
+                differences.append((*key, field, set_based_value, per_account_value))
+    return differences
 
 
 # import concurrent.futures
@@ -0,0 +1,199 @@
+import csv
+import datetime
+import io
+import os
+import tempfile
+import threading
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from openpyxl import Workbook
+from IFRS9.models import ExportJob
+from .save_log import save_log
+
+# Rows fetched per round-trip from the server-side cursor
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 5000)
+
+# Extracts above this many rows are written by a background job instead of the request
+EXPORT_BACKGROUND_ROW_THRESHOLD = getattr(settings, 'EXPORT_BACKGROUND_ROW_THRESHOLD', 500000)
+
+# Directory holding the files produced by background export jobs
+EXPORT_DIR = getattr(settings, 'EXPORT_DIR', os.path.join(os.getcwd(), 'exports'))
+
+# A job's rows_written is updated every this many rows
+EXPORT_PROGRESS_INTERVAL = 50000
+
+
+def build_export_queryset(model_class, parameters):
+    """
+    Apply the filters of the view-data and report pages to model_class.
+
+    :param parameters: dict with optional fic_mis_date, filter_column, filter_values (comma
+        separated, "None" selects NULLs), sort_order ('asc'/'desc') and columns.
+    :return: (queryset, columns)
+    """
+    data = model_class.objects.all()
+
+    fic_mis_date = parameters.get('fic_mis_date')
+    if fic_mis_date:
+        data = data.filter(fic_mis_date=fic_mis_date)
+
+    filter_column = parameters.get('filter_column')
+    filter_values = parameters.get('filter_values')
+    if filter_column and filter_values:
+        filter_values_list = [value for value in filter_values.split(',') if value not in ["on", "(Select All)"]]
+
+        filters = Q()
+        if "None" in filter_values_list:
+            filter_values_list.remove("None")
+            filters |= Q(**{f"{filter_column}__isnull": True})
+        if filter_values_list:
+            filters |= Q(**{f"{filter_column}__in": filter_values_list})
+        data = data.filter(filters)
+
+    sort_order = parameters.get('sort_order')
+    if filter_column and sort_order in ('asc', 'desc'):
+        data = data.order_by(filter_column if sort_order == 'asc' else f'-{filter_column}')
+
+    columns = parameters.get('columns') or [field.name for field in model_class._meta.fields]
+    return data, columns
+
+
+def iter_export_rows(queryset, columns, chunk_size=None):
+    """Yield value tuples through a server-side cursor, never loading the whole result."""
+    return queryset.values_list(*columns).iterator(chunk_size=chunk_size or EXPORT_CHUNK_SIZE)
+
+
+def stream_csv(headers, rows, chunk_size=None):
+    """
+    Generator of CSV text for StreamingHttpResponse. Rows are written in blocks of chunk_size so
+    the response is sent in a few large pieces rather than one per row.
+    """
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue()
+
+
+def to_excel_value(value):
+    """openpyxl rejects timezone-aware datetimes; write them in the current timezone."""
+    if isinstance(value, datetime.datetime) and timezone.is_aware(value):
+        return timezone.make_naive(value)
+    return value
+
+
+def write_xlsx(file, headers, rows, sheet_title='Data', progress=None):
+    """
+    Write rows to file with an openpyxl write-only workbook, which streams rows to disk instead
+    of keeping every cell in memory.
+
+    :param file: Path or binary file object.
+    :param progress: Optional callable receiving the number of rows written so far.
+    :return: Number of rows written.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=sheet_title[:31])
+    sheet.append(headers)
+
+    written = 0
+    for row in rows:
+        sheet.append([to_excel_value(value) for value in row])
+        written += 1
+        if progress and written % EXPORT_PROGRESS_INTERVAL == 0:
+            progress(written)
+
+    workbook.save(file)
+    return written
+
+
+def write_csv(path, headers, rows, progress=None):
+    """Write rows to a CSV file at path. Same contract as write_xlsx."""
+    written = 0
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow(row)
+            written += 1
+            if progress and written % EXPORT_PROGRESS_INTERVAL == 0:
+                progress(written)
+    return written
+
+
+def xlsx_temp_file(headers, rows, sheet_title='Data'):
+    """
+    Build a workbook in an anonymous temporary file and return it rewound, ready for a
+    FileResponse. The file disappears when the response closes it.
+    """
+    file = tempfile.TemporaryFile()
+    write_xlsx(file, headers, rows, sheet_title)
+    file.seek(0)
+    return file
+
+
+def run_export_job(job_id):
+    """
+    Write the extract described by an ExportJob to EXPORT_DIR, updating rows_written as it goes.
+    Runs in a background thread started by start_export_job.
+    """
+    job = ExportJob.objects.get(id=job_id)
+    try:
+        ExportJob.objects.filter(id=job_id).update(status='Ongoing')
+
+        model_class = apps.get_model('IFRS9', job.table_name)
+        queryset, columns = build_export_queryset(model_class, job.parameters)
+        ExportJob.objects.filter(id=job_id).update(total_rows=queryset.count())
+
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        file_path = os.path.join(EXPORT_DIR, f"{job.table_name}_{job.id}.{job.export_format}")
+
+        def progress(written):
+            ExportJob.objects.filter(id=job_id).update(rows_written=written)
+
+        rows = iter_export_rows(queryset, columns)
+        if job.export_format == 'xlsx':
+            written = write_xlsx(file_path, columns, rows, job.table_name, progress)
+        else:
+            written = write_csv(file_path, columns, rows, progress)
+
+        ExportJob.objects.filter(id=job_id).update(
+            status='Success', rows_written=written, file_path=file_path, completed_at=timezone.now()
+        )
+        save_log('run_export_job', 'INFO', f"Export job {job_id} wrote {written} rows of {job.table_name} to {file_path}.")
+
+    except Exception as e:
+        ExportJob.objects.filter(id=job_id).update(status='Failed', error_message=str(e), completed_at=timezone.now())
+        save_log('run_export_job', 'ERROR', f"Export job {job_id} for {job.table_name} failed: {e}")
+
+    finally:
+        # The thread opened its own connection; do not leave it to the garbage collector
+        connection.close()
+
+
+def start_export_job(table_name, export_format, parameters, user=None):
+    """
+    Record an ExportJob and run it in a background thread.
+
+    :return: The ExportJob; poll its status and rows_written for progress.
+    """
+    job = ExportJob.objects.create(
+        table_name=table_name,
+        export_format=export_format,
+        parameters=parameters,
+        created_by=user,
+    )
+    threading.Thread(target=run_export_job, args=(job.id,), daemon=True).start()
+    return job
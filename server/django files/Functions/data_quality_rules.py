@@ -0,0 +1,229 @@
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from IFRS9.models import (
+    DataQualityCheckRun,
+    DataQualityViolation,
+    Ldn_Bank_Product_Info,
+    Ldn_Customer_Info,
+    Ldn_Financial_Instrument,
+)
+from .save_log import save_log
+
+# Each rule is one SQL predicate over a row `t` of its table. The message and reference are only
+# built for violating rows. lookup_tables lists the other tables the predicate reads, so an upload
+# to one of them re-evaluates the rule.
+DATA_QUALITY_RULES = [
+    {
+        'code': 'rule1',
+        'table': 'ldn_financial_instrument',
+        'predicate': "t.d_maturity_date < t.d_next_payment_date",
+        'message': "format('Maturity date %s must be greater than or equal to the next payment date %s.', t.d_maturity_date, t.d_next_payment_date)",
+    },
+    {
+        'code': 'rule2',
+        'table': 'ldn_financial_instrument',
+        'predicate': "t.d_next_payment_date > t.d_maturity_date",
+        'message': "format('Next payment date %s must be less than or equal to maturity date %s.', t.d_next_payment_date, t.d_maturity_date)",
+    },
+    {
+        'code': 'rule3',
+        'table': 'ldn_financial_instrument',
+        'predicate': "t.fic_mis_date >= t.d_maturity_date OR t.fic_mis_date >= t.d_next_payment_date",
+        'message': "format('Reporting Date %s must be less than maturity date %s and next payment date %s.', t.fic_mis_date, t.d_maturity_date, t.d_next_payment_date)",
+    },
+    {
+        'code': 'rule4',
+        'table': 'ldn_financial_instrument',
+        'predicate': "t.d_maturity_date = t.d_next_payment_date AND t.n_curr_payment_recd < t.n_eop_bal",
+        'message': "format('IF %s=%s then Current payment %s must be greater than or equal to end-of-period balance %s.', t.d_maturity_date, t.d_next_payment_date, t.n_curr_payment_recd, t.n_eop_bal)",
+    },
+    {
+        'code': 'rule5',
+        'table': 'ldn_financial_instrument',
+        'predicate': "t.d_maturity_date > t.d_next_payment_date AND t.n_curr_payment_recd >= t.n_eop_bal",
+        'message': "format('IF %s>%s then Current payment %s must be less than end-of-period balance %s.', t.d_maturity_date, t.d_next_payment_date, t.n_curr_payment_recd, t.n_eop_bal)",
+    },
+    {
+        'code': 'rule6',
+        'table': 'ldn_financial_instrument',
+        'predicate': "t.v_amrt_repayment_type IS NULL OR t.v_amrt_repayment_type NOT IN ('BULLET', 'AMORTIZED')",
+        'message': "format('Repayment type must be ''BULLET'' or ''AMORTIZED'' but found ''%s''.', t.v_amrt_repayment_type)",
+    },
+    {
+        'code': 'missing_customer',
+        'table': 'ldn_financial_instrument',
+        'lookup_tables': ['ldn_customer_info'],
+        'predicate': "NOT EXISTS (SELECT 1 FROM ldn_customer_info c WHERE c.v_party_id = t.v_cust_ref_code)",
+        'message': "format('Customer %s is not defined in the customer information.', t.v_cust_ref_code)",
+        'reference': "t.v_cust_ref_code",
+    },
+    {
+        'code': 'missing_product',
+        'table': 'ldn_financial_instrument',
+        'lookup_tables': ['ldn_bank_product_info'],
+        'predicate': "NOT EXISTS (SELECT 1 FROM ldn_bank_product_info p WHERE p.v_prod_code = t.v_prod_code)",
+        'message': "format('Product %s is not defined in the bank product information.', t.v_prod_code)",
+        'reference': "t.v_prod_code",
+    },
+]
+
+# Column identifying the record of each checked table in the results
+DATA_QUALITY_TABLE_KEYS = {
+    'ldn_financial_instrument': 'v_account_number',
+}
+
+# Models of the checked and looked-up tables; saving or deleting a row through the ORM (edit_row,
+# delete_row, admin) invalidates the stored results it affects
+DATA_QUALITY_MODELS = [Ldn_Financial_Instrument, Ldn_Customer_Info, Ldn_Bank_Product_Info]
+
+
+def get_rules(table_name):
+    return [rule for rule in DATA_QUALITY_RULES if rule['table'] == table_name]
+
+
+def build_rule_scan_sql(table_name, rules):
+    """
+    One INSERT ... SELECT evaluating every rule of table_name in a single scan of the date's rows:
+    each row is crossed with one (rule, predicate) entry per rule, and messages are only built for
+    the entries that are violated. Literal % in the rules is escaped for the query parameters.
+    """
+    def sql(fragment):
+        return fragment.replace('%', '%%')
+
+    key_column = DATA_QUALITY_TABLE_KEYS[table_name]
+    rule_values = ',\n                '.join(f"('{rule['code']}', ({sql(rule['predicate'])}))" for rule in rules)
+    messages = '\n                '.join(f"WHEN '{rule['code']}' THEN {sql(rule['message'])}" for rule in rules)
+    references = '\n                '.join(
+        f"WHEN '{rule['code']}' THEN ({sql(rule['reference'])})::text" for rule in rules if rule.get('reference')
+    )
+    return f"""
+        INSERT INTO {connection.ops.quote_name(DataQualityViolation._meta.db_table)} (
+            fic_mis_date, rule_code, table_name, v_account_number, v_reference_code, message
+        )
+        SELECT
+            t.fic_mis_date,
+            r.rule_code,
+            %s,
+            t.{key_column},
+            {f"CASE r.rule_code {references} END" if references else "NULL"},
+            CASE r.rule_code
+                {messages}
+            END
+        FROM {table_name} t
+        CROSS JOIN LATERAL (VALUES
+                {rule_values}
+        ) AS r (rule_code, violated)
+        WHERE t.fic_mis_date = %s
+          AND r.violated;
+    """
+
+
+def run_data_quality_rules(fic_mis_date, table_name='ldn_financial_instrument'):
+    """
+    Evaluate every rule of table_name for fic_mis_date and replace the date's violations in
+    fct_data_quality_violation.
+
+    :return: Number of violations recorded.
+    """
+    rules = get_rules(table_name)
+    if not rules:
+        return 0
+
+    violation_table = connection.ops.quote_name(DataQualityViolation._meta.db_table)
+    with connection.cursor() as cursor, transaction.atomic():
+        cursor.execute(
+            f"DELETE FROM {violation_table} WHERE fic_mis_date = %s AND table_name = %s;",
+            [fic_mis_date, table_name]
+        )
+        cursor.execute(build_rule_scan_sql(table_name, rules), [table_name, fic_mis_date])
+        violation_count = cursor.rowcount
+
+        DataQualityCheckRun.objects.update_or_create(
+            fic_mis_date=fic_mis_date, table_name=table_name,
+            defaults={'violation_count': violation_count},
+        )
+
+    save_log(
+        'run_data_quality_rules',
+        'INFO',
+        f"Evaluated {len(rules)} data quality rules on {table_name} for fic_mis_date={fic_mis_date}: {violation_count} violations."
+    )
+    return violation_count
+
+
+def ensure_data_quality_rules(fic_mis_date, table_name='ldn_financial_instrument', refresh=False):
+    """
+    Evaluate the rules of table_name for fic_mis_date unless they already were.
+
+    :param refresh: Evaluate them again anyway, e.g. after ETL loads or SQL writes, which do not
+                    invalidate the stored results.
+    """
+    if refresh or not DataQualityCheckRun.objects.filter(fic_mis_date=fic_mis_date, table_name=table_name).exists():
+        run_data_quality_rules(fic_mis_date, table_name)
+
+
+def invalidate_data_quality_checks(table_name, fic_mis_dates=None):
+    """
+    Forget the evaluations affected by a change to table_name, so the next read evaluates the
+    rules again: those of table_name for fic_mis_dates (every date when None), and those of every
+    date of the tables whose rules look table_name up. Errors are logged and swallowed.
+    """
+    try:
+        checks = DataQualityCheckRun.objects.filter(table_name=table_name)
+        if fic_mis_dates is not None:
+            checks = checks.filter(fic_mis_date__in=list(fic_mis_dates))
+        checks.delete()
+
+        lookup_tables = {
+            rule['table'] for rule in DATA_QUALITY_RULES if table_name in rule.get('lookup_tables', [])
+        }
+        if lookup_tables:
+            DataQualityCheckRun.objects.filter(table_name__in=lookup_tables).delete()
+    except Exception as e:
+        save_log('invalidate_data_quality_checks', 'ERROR', f"Error invalidating data quality checks of {table_name}: {e}")
+
+
+def _on_data_change(sender, instance, **kwargs):
+    fic_mis_date = getattr(instance, 'fic_mis_date', None)
+    invalidate_data_quality_checks(sender._meta.model_name, None if fic_mis_date is None else [fic_mis_date])
+
+
+def run_data_quality_rules_after_upload(table_name, fic_mis_dates):
+    """
+    Post-upload hook: re-evaluate the rules affected by a load into table_name.
+
+    Rules scanning table_name are evaluated for the uploaded dates. Rules that only look up
+    table_name (e.g. missing customers after a customer upload) are re-evaluated for every date
+    already checked. Errors are logged and swallowed so they never fail the upload.
+    """
+    try:
+        checked_tables = {rule['table'] for rule in DATA_QUALITY_RULES}
+        if table_name in checked_tables:
+            for fic_mis_date in fic_mis_dates:
+                run_data_quality_rules(fic_mis_date, table_name)
+
+        for checked_table in checked_tables - {table_name}:
+            if not any(table_name in rule.get('lookup_tables', []) for rule in get_rules(checked_table)):
+                continue
+            checked_dates = DataQualityCheckRun.objects.filter(table_name=checked_table).values_list('fic_mis_date', flat=True)
+            for fic_mis_date in checked_dates:
+                run_data_quality_rules(fic_mis_date, checked_table)
+    except Exception as e:
+        save_log('run_data_quality_rules_after_upload', 'ERROR', f"Error evaluating data quality rules after upload to {table_name}: {e}")
+
+
+def get_violations(fic_mis_date, rule_code, table_name='ldn_financial_instrument', refresh=False):
+    """
+    Violations of rule_code for fic_mis_date, evaluating the table's rules first if the date was
+    never checked (or when refresh). Pagination and downloads read from here instead of
+    re-running the rule.
+    """
+    ensure_data_quality_rules(fic_mis_date, table_name, refresh)
+    return DataQualityViolation.objects.filter(
+        fic_mis_date=fic_mis_date, table_name=table_name, rule_code=rule_code
+    ).order_by('id')
+
+
+for _model in DATA_QUALITY_MODELS:
+    post_save.connect(_on_data_change, sender=_model, dispatch_uid=f'data_quality_{_model.__name__}_save')
+    post_delete.connect(_on_data_change, sender=_model, dispatch_uid=f'data_quality_{_model.__name__}_delete')
@@ -0,0 +1,68 @@
+from django.db import connection, transaction
+from IFRS9.models import FCT_ECL_Summary_Cube, FCT_Reporting_Lines
+from .save_log import save_log
+
+# Dimensions the cube is grouped by (besides fic_mis_date and n_run_key)
+CUBE_DIMENSIONS = ['n_stage_descr', 'n_prod_segment', 'n_prod_type', 'n_loan_type', 'v_ccy_code']
+
+# Amount columns of FCT_Reporting_Lines summed into the cube
+CUBE_MEASURES = ['n_exposure_at_default_ncy', 'n_exposure_at_default_rcy', 'n_12m_ecl_rcy', 'n_lifetime_ecl_rcy']
+
+
+def refresh_ecl_summary_cube(fic_mis_date, n_run_key=None):
+    """
+    Rebuild the summary cube rows of fic_mis_date from FCT_Reporting_Lines.
+
+    Accounts are unique per (date, run), so the distinct account count of each cell can be summed
+    across cells of the same run. Only n_run_key is rebuilt when it is given, otherwise every run
+    of the date.
+
+    :return: Number of cube rows written.
+    """
+    cube_table = connection.ops.quote_name(FCT_ECL_Summary_Cube._meta.db_table)
+    source_table = connection.ops.quote_name(FCT_Reporting_Lines._meta.db_table)
+
+    run_filter = ''
+    params = [fic_mis_date]
+    if n_run_key is not None:
+        run_filter = ' AND n_run_key = %s'
+        params.append(n_run_key)
+
+    dimensions = ', '.join(CUBE_DIMENSIONS)
+    with connection.cursor() as cursor, transaction.atomic():
+        cursor.execute(f"DELETE FROM {cube_table} WHERE fic_mis_date = %s{run_filter};", params)
+        cursor.execute(f"""
+            INSERT INTO {cube_table} (
+                fic_mis_date, n_run_key, {dimensions},
+                {', '.join(CUBE_MEASURES)}, n_account_count
+            )
+            SELECT
+                fic_mis_date, n_run_key, {dimensions},
+                {', '.join(f'SUM({measure})' for measure in CUBE_MEASURES)},
+                COUNT(DISTINCT n_account_number)
+            FROM {source_table}
+            WHERE fic_mis_date = %s{run_filter}
+            GROUP BY fic_mis_date, n_run_key, {dimensions};
+        """, params)
+        row_count = cursor.rowcount
+
+    save_log(
+        'refresh_ecl_summary_cube',
+        'INFO',
+        f"Refreshed ECL summary cube for fic_mis_date={fic_mis_date}"
+        f"{'' if n_run_key is None else f', run key {n_run_key}'}: {row_count} rows."
+    )
+    return row_count
+
+
+def refresh_ecl_summary_cube_safely(fic_mis_date, n_run_key=None):
+    """
+    Pipeline hook: refresh the cube after the reporting lines changed. Errors are logged and
+    swallowed so a failed refresh never fails the calculation step; the report views rebuild a
+    missing date on demand.
+    """
+    try:
+        return refresh_ecl_summary_cube(fic_mis_date, n_run_key)
+    except Exception as e:
+        save_log('refresh_ecl_summary_cube', 'ERROR', f"Error refreshing ECL summary cube for fic_mis_date={fic_mis_date}: {e}")
+        return 0
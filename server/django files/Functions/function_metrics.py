@@ -0,0 +1,166 @@
+import os
+import re
+import threading
+import time
+from django.db import connection
+from django.db.models import Avg
+from IFRS9.models import FunctionExecutionMetric
+from .save_log import save_log
+from .query_recorder import set_current_recorder
+
+# Statements whose rowcount is counted as rows affected
+DML_PATTERN = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE)\b', re.IGNORECASE)
+
+# Number of earlier runs a function's metrics are compared with on the monitoring page
+METRIC_TREND_RUNS = 10
+
+# Seconds between two samples of the resident memory while a function runs
+RSS_SAMPLE_INTERVAL = 0.2
+
+
+class FunctionMetricsRecorder:
+    """
+    Context manager measuring one pipeline function: wall time, CPU time of the current thread,
+    peak RSS while it runs (see RssSampler), and through a connection execute_wrapper the number of queries, database time and
+    rows affected. Connections are per thread, so functions running in parallel on the process
+    scheduler's pool are measured separately.
+    """
+
+    def __init__(self):
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_mb = None
+        self.query_count = 0
+        self.db_seconds = 0.0
+        self.rows_affected = 0
+
+    def record_query(self, seconds, rows=0):
+        self.query_count += 1
+        self.db_seconds += seconds
+        self.rows_affected += max(rows, 0)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            rows = 0
+            if sql.lstrip()[:6].upper() != 'SELECT' and DML_PATTERN.search(sql):
+                rows = context['cursor'].rowcount
+            self.record_query(time.perf_counter() - started, rows)
+
+    def __enter__(self):
+        set_current_recorder(self)
+        self._rss_sampler = RssSampler()
+        self._rss_sampler.start()
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        self._wall_started = time.perf_counter()
+        self._cpu_started = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_seconds = time.perf_counter() - self._wall_started
+        self.cpu_seconds = time.thread_time() - self._cpu_started
+        self.peak_rss_mb = self._rss_sampler.stop()
+        self._wrapper.__exit__(exc_type, exc_value, traceback)
+        set_current_recorder(None)
+        return False
+
+
+def get_rss_mb():
+    """Current resident memory of this process in MB, read from /proc; None where unavailable."""
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class RssSampler:
+    """
+    Highest resident memory of the process between start() and stop(), sampled every
+    RSS_SAMPLE_INTERVAL seconds by a background thread. Unlike ru_maxrss, which only grows over
+    the lifetime of a long-lived worker, this is the peak of one function's run.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak_rss_mb = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = get_rss_mb()
+        if rss is not None and (self.peak_rss_mb is None or rss > self.peak_rss_mb):
+            self.peak_rss_mb = rss
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._sample()
+        if self.peak_rss_mb is not None:
+            self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop sampling and return the peak in MB (None where memory cannot be read)."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._sample()
+        return self.peak_rss_mb
+
+
+def save_function_metrics(status_entry, recorder):
+    """Store the measurements of a FunctionExecutionStatus entry; a re-run replaces them."""
+    try:
+        FunctionExecutionMetric.objects.update_or_create(
+            process_run_id=status_entry.process_run_id,
+            function=status_entry.function,
+            defaults={
+                'process': status_entry.process,
+                'fic_mis_date': status_entry.reporting_date,
+                'status': status_entry.status,
+                'wall_seconds': recorder.wall_seconds,
+                'cpu_seconds': recorder.cpu_seconds,
+                'peak_rss_mb': recorder.peak_rss_mb,
+                'query_count': recorder.query_count,
+                'db_seconds': recorder.db_seconds,
+                'rows_affected': recorder.rows_affected,
+            },
+        )
+    except Exception as e:
+        # Metrics must never fail the run
+        save_log('save_function_metrics', 'ERROR', f"Failed to save metrics of {status_entry.function.function_name}: {e}")
+
+
+def get_function_trend(function_id, runs=None):
+    """Metrics of the last runs of a function, oldest first."""
+    metrics = (
+        FunctionExecutionMetric.objects.filter(function_id=function_id, status='Success')
+        .order_by('-recorded_at')[:runs or METRIC_TREND_RUNS]
+    )
+    return list(reversed(metrics))
+
+
+def compare_with_previous_runs(metrics, runs=None):
+    """
+    Annotate each metric with the average wall time of the same function over its previous
+    successful runs (previous_wall_seconds) and the relative change (wall_change_percent).
+    """
+    for metric in metrics:
+        previous = (
+            FunctionExecutionMetric.objects.filter(
+                function_id=metric.function_id, status='Success', recorded_at__lt=metric.recorded_at
+            )
+            .order_by('-recorded_at')
+            .values_list('id', flat=True)[:runs or METRIC_TREND_RUNS]
+        )
+        average = FunctionExecutionMetric.objects.filter(id__in=list(previous)).aggregate(wall=Avg('wall_seconds'))['wall']
+        metric.previous_wall_seconds = average
+        metric.wall_change_percent = (metric.wall_seconds - average) / average * 100 if average else None
+    return metrics
@@ -0,0 +1,376 @@
+from django.conf import settings
+from django.db import connection, transaction
+from IFRS9.models import fsi_Financial_Cash_Flow_Cal
+from .save_log import save_log
+from .populate_cashflows import get_next_run_skey
+from .run_partitions import prepare_run_partition, prune_old_run_partitions
+from .pd_cumulative_term_str import get_buckets_for_12_months
+from .batching import hash_bucket_condition
+
+# 'stepwise' runs every fsi_financial_cash_flow_cal step as its own UPDATE; 'fused' computes the
+# final column values while the run's rows are inserted (see insert_cash_flow_data_fused);
+# 'sharded' runs the fused insert and the ECL update per account shard in separate processes
+# (see sharded_cash_flow_chain)
+CASH_FLOW_CHAIN_MODE = getattr(settings, 'CASH_FLOW_CHAIN_MODE', 'stepwise')
+
+# Columns written by the fused INSERT, in table order
+CASH_FLOW_COLUMNS = [
+    'v_account_number', 'd_cash_flow_date', 'n_run_skey', 'fic_mis_date',
+    'n_principal_run_off', 'n_interest_run_off', 'n_cash_flow_bucket_id', 'n_cash_flow_amount',
+    'n_cumulative_loss_rate', 'n_expected_cash_flow_rate', 'n_discount_rate', 'n_discount_factor',
+    'n_expected_cash_flow', 'n_effective_interest_rate', 'n_lgd_percent', 'n_expected_cash_flow_pv',
+    'n_exposure_at_default', 'n_forward_expected_loss', 'n_forward_expected_loss_pv', 'v_ccy_code',
+    'n_cash_shortfall', 'n_cash_shortfall_pv', 'n_per_period_impaired_prob', 'n_cumulative_impaired_prob',
+    'n_12m_per_period_pd', 'n_12m_cumulative_pd', 'n_12m_exp_cash_flow', 'n_12m_exp_cash_flow_pv',
+    'n_12m_cash_shortfall', 'n_12m_cash_shortfall_pv', 'n_12m_fwd_expected_loss', 'n_12m_fwd_expected_loss_pv',
+]
+
+# Columns copied from fsi_expected_cashflow by insert_cash_flow_data; everything else starts NULL
+EXPECTED_CASHFLOW_SOURCE = {
+    'v_account_number': 'ec.v_account_number',
+    'd_cash_flow_date': 'ec.d_cash_flow_date',
+    'n_run_skey': '%s',
+    'fic_mis_date': 'ec.fic_mis_date',
+    'n_principal_run_off': 'ec.n_principal_payment',
+    'n_interest_run_off': 'ec.n_interest_payment',
+    'n_cash_flow_bucket_id': 'ec.n_cash_flow_bucket',
+    'n_cash_flow_amount': 'ec.n_cash_flow_amount',
+    'v_ccy_code': 'ec.v_ccy_code',
+    'n_exposure_at_default': 'ec.n_exposure_at_default',
+}
+
+# Stage determination and PD lookups carried through every layer for the steps that need them
+LOOKUP_COLUMNS = [
+    'sd_account_number', 'sd_effective_interest_rate', 'sd_lgd_percent', 'sd_amrt_term_unit',
+    'sd_collateral_amount', 'pd_rating_found', 'pd_rating_cumulative', 'pd_delq_found',
+    'pd_delq_cumulative', 'pd_12m_found', 'pd_12m_cumulative',
+]
+
+ACCOUNT_WINDOW = "PARTITION BY v_account_number ORDER BY n_cash_flow_bucket_id"
+
+# Each step of the stepwise chain, as the layers of column expressions it applies. A layer sees the
+# values written by the previous layer, exactly like consecutive UPDATE statements; columns a layer
+# does not mention keep their previous value.
+FUSED_CASH_FLOW_STEPS = {
+    # update_fin_cashflw.update_financial_cash_flow
+    'update_financial_cash_flow': [{
+        'n_effective_interest_rate': "CASE WHEN sd_account_number IS NOT NULL THEN sd_effective_interest_rate ELSE n_effective_interest_rate END",
+        'n_lgd_percent': "CASE WHEN sd_account_number IS NOT NULL THEN sd_lgd_percent ELSE n_lgd_percent END",
+    }],
+    # cal_periodic_discount_Rate2.calculate_discount_factors
+    'calculate_discount_factors': [{
+        'n_discount_rate': "CASE WHEN sd_account_number IS NOT NULL THEN COALESCE(n_effective_interest_rate, n_discount_rate) ELSE n_discount_rate END",
+        'n_discount_factor': """
+            CASE
+                WHEN sd_account_number IS NOT NULL
+                     AND COALESCE(n_effective_interest_rate, n_discount_rate) IS NOT NULL
+                     AND n_cash_flow_bucket_id IS NOT NULL
+                THEN 1 / POWER(
+                    1 + COALESCE(n_effective_interest_rate, n_discount_rate),
+                    (n_cash_flow_bucket_id::FLOAT /
+                        CASE sd_amrt_term_unit
+                            WHEN 'D' THEN 365
+                            WHEN 'W' THEN 52
+                            WHEN 'M' THEN 12
+                            WHEN 'Q' THEN 4
+                            WHEN 'H' THEN 2
+                            WHEN 'Y' THEN 1
+                            ELSE 12
+                        END)
+                    )
+                ELSE n_discount_factor
+            END""",
+    }],
+    # calculate_cash_flows_exposure.calculate_ead_by_buckets
+    'calculate_ead_by_buckets': [{
+        'n_exposure_at_default': f"SUM(n_cash_flow_amount * n_discount_factor) OVER ({ACCOUNT_WINDOW} ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING)",
+    }],
+    # pd_cumulative_term_str.update_cash_flow_with_pd_buckets (delinquency matches are applied after ratings)
+    'update_cash_flow_with_pd_buckets': [{
+        'n_cumulative_loss_rate': """
+            CASE
+                WHEN pd_delq_found THEN pd_delq_cumulative * sd_lgd_percent
+                WHEN pd_rating_found THEN pd_rating_cumulative * sd_lgd_percent
+                ELSE n_cumulative_loss_rate
+            END""",
+        'n_cumulative_impaired_prob': """
+            CASE
+                WHEN pd_delq_found THEN pd_delq_cumulative
+                WHEN pd_rating_found THEN pd_rating_cumulative
+                ELSE n_cumulative_impaired_prob
+            END""",
+        'n_12m_cumulative_pd': "CASE WHEN pd_12m_found THEN pd_12m_cumulative ELSE n_12m_cumulative_pd END",
+    }],
+    # calculate_marginal_pd.update_marginal_pd
+    'update_marginal_pd': [{
+        'n_per_period_impaired_prob': f"ABS(n_cumulative_impaired_prob - COALESCE(LAG(n_cumulative_impaired_prob) OVER ({ACCOUNT_WINDOW}), 0))",
+        'n_12m_per_period_pd': f"ABS(n_12m_cumulative_pd - COALESCE(LAG(n_12m_cumulative_pd) OVER ({ACCOUNT_WINDOW}), 0))",
+    }],
+    # cal_cf_lgd_using_collateral.cal_lgd_and_loss_rate_for_cash_flows_using_collateral
+    'cal_lgd_and_loss_rate_for_cash_flows_using_collateral': [
+        {
+            'n_lgd_percent': """
+                CASE
+                    WHEN sd_account_number IS NOT NULL
+                         AND n_exposure_at_default > 0
+                         AND sd_collateral_amount IS NOT NULL
+                    THEN GREATEST(0, LEAST(0.65, 1 - (sd_collateral_amount / n_exposure_at_default)))
+                    ELSE n_lgd_percent
+                END""",
+        },
+        {
+            'n_cumulative_loss_rate': "n_cumulative_impaired_prob * n_lgd_percent",
+        },
+    ],
+    # calculate_cash_flow_rate_and_amount1.calculate_expected_cash_flow
+    'calculate_expected_cash_flow': [
+        {
+            'n_expected_cash_flow_rate': "CASE WHEN n_cumulative_loss_rate IS NOT NULL THEN 1 - n_cumulative_loss_rate ELSE n_expected_cash_flow_rate END",
+            'n_12m_exp_cash_flow': """
+                CASE
+                    WHEN n_12m_cumulative_pd IS NOT NULL AND n_lgd_percent IS NOT NULL
+                    THEN COALESCE(n_cash_flow_amount, 0) * (1 - (n_12m_cumulative_pd * n_lgd_percent))
+                    ELSE n_12m_exp_cash_flow
+                END""",
+        },
+        {
+            'n_expected_cash_flow': "CASE WHEN n_expected_cash_flow_rate IS NOT NULL THEN COALESCE(n_cash_flow_amount, 0) * n_expected_cash_flow_rate ELSE n_expected_cash_flow END",
+        },
+    ],
+    # cal_forward_exposure4.calculate_forward_loss_fields
+    'calculate_forward_loss_fields': [{
+        'n_12m_fwd_expected_loss': "n_exposure_at_default * n_12m_per_period_pd * n_lgd_percent",
+        'n_12m_fwd_expected_loss_pv': "n_discount_factor * (n_exposure_at_default * n_12m_per_period_pd * n_lgd_percent)",
+        'n_forward_expected_loss': "n_exposure_at_default * n_per_period_impaired_prob * n_lgd_percent",
+        'n_forward_expected_loss_pv': "n_discount_factor * (n_exposure_at_default * n_per_period_impaired_prob * n_lgd_percent)",
+    }],
+    # cal_exp_cash_n_cash_shortfall3.calculate_cashflow_fields
+    'calculate_cashflow_fields': [{
+        'n_expected_cash_flow_pv': "CASE WHEN n_discount_factor IS NOT NULL AND n_expected_cash_flow IS NOT NULL THEN n_discount_factor * n_expected_cash_flow ELSE n_expected_cash_flow_pv END",
+        'n_12m_exp_cash_flow_pv': "CASE WHEN n_discount_factor IS NOT NULL AND n_12m_exp_cash_flow IS NOT NULL THEN n_discount_factor * n_12m_exp_cash_flow ELSE n_12m_exp_cash_flow_pv END",
+        'n_cash_shortfall': "CASE WHEN n_cash_flow_amount IS NOT NULL AND n_expected_cash_flow IS NOT NULL THEN (n_cash_flow_amount - n_expected_cash_flow) ELSE n_cash_shortfall END",
+        'n_12m_cash_shortfall': "CASE WHEN n_cash_flow_amount IS NOT NULL AND n_12m_exp_cash_flow IS NOT NULL THEN (n_cash_flow_amount - n_12m_exp_cash_flow) ELSE n_12m_cash_shortfall END",
+        'n_cash_shortfall_pv': "CASE WHEN n_discount_factor IS NOT NULL AND n_cash_flow_amount IS NOT NULL AND n_expected_cash_flow IS NOT NULL THEN n_discount_factor * (n_cash_flow_amount - n_expected_cash_flow) ELSE n_cash_shortfall_pv END",
+        'n_12m_cash_shortfall_pv': "CASE WHEN n_discount_factor IS NOT NULL AND n_cash_flow_amount IS NOT NULL AND n_12m_exp_cash_flow IS NOT NULL THEN n_discount_factor * (n_cash_flow_amount - n_12m_exp_cash_flow) ELSE n_12m_cash_shortfall_pv END",
+    }],
+}
+
+# Steps that may sit between the folded steps without breaking the fusion: they only read
+# fsi_financial_cash_flow_cal and write nothing the folded steps read
+FUSED_CASH_FLOW_PASSTHROUGH = {'update_stage_determination_ead_with_cashflow_pv'}
+
+# Steps folded when insert_cash_flow_data_fused is run on its own as a process function
+DEFAULT_FUSED_STEPS = [
+    'update_financial_cash_flow',
+    'calculate_discount_factors',
+    'calculate_ead_by_buckets',
+    'update_cash_flow_with_pd_buckets',
+    'update_marginal_pd',
+    'calculate_expected_cash_flow',
+    'calculate_forward_loss_fields',
+    'calculate_cashflow_fields',
+]
+
+
+def get_column_type(column):
+    """
+    SQL type of a fsi_financial_cash_flow_cal column, used to round every layer exactly as the
+    stepwise UPDATEs do when they store intermediate values.
+    """
+    field = fsi_Financial_Cash_Flow_Cal._meta.get_field(column)
+    if field.get_internal_type() == 'DecimalField':
+        return f"NUMERIC({field.max_digits},{field.decimal_places})"
+    return field.db_type(connection)
+
+
+def get_fused_cash_flow_steps(function_names):
+    """
+    Return the steps that follow insert_cash_flow_data in a process and can be folded into it.
+
+    Folding stops at the first step that is neither a fused step nor a passthrough, so any step that
+    may change the inputs of the chain still runs, and everything after it runs stepwise.
+
+    :param function_names: Function names of the process, in execution order.
+    :return: List of step names, in execution order.
+    """
+    if 'insert_cash_flow_data' not in function_names:
+        return []
+
+    steps = []
+    for function_name in function_names[function_names.index('insert_cash_flow_data') + 1:]:
+        if function_name in FUSED_CASH_FLOW_STEPS:
+            if function_name not in steps:
+                steps.append(function_name)
+        elif function_name not in FUSED_CASH_FLOW_PASSTHROUGH:
+            break
+    return steps
+
+
+def build_fused_cash_flow_sql(steps, shard_count=None):
+    """
+    Build the INSERT ... SELECT that materialises the run's rows with every step in steps applied.
+
+    The base CTE reproduces insert_cash_flow_data plus the stage determination and PD lookups; each
+    step layer is one CTE over the previous one.
+
+    :param shard_count: Only insert the accounts of one of shard_count hash shards (see
+        batching.hash_bucket_condition). Every step works account by account, so the shards
+        together produce the unsharded rows.
+    :return: (sql, parameter names) where the names are 'run_skey', 'fic_mis_date', 'months_to_12m'
+        and, with shard_count, 'shard'.
+    """
+    base_select = []
+    for column in CASH_FLOW_COLUMNS:
+        source = EXPECTED_CASHFLOW_SOURCE.get(column, 'NULL')
+        if column.startswith('n_') and column not in ('n_run_skey', 'n_cash_flow_bucket_id'):
+            source = f"CAST({source} AS {get_column_type(column)})"
+        base_select.append(f"{source} AS {column}")
+
+    with_pd_lookups = 'update_cash_flow_with_pd_buckets' in steps
+    if with_pd_lookups:
+        base_select += [
+            "pd_r.v_found AS pd_rating_found",
+            "pd_r.n_cumulative_default_prob AS pd_rating_cumulative",
+            "pd_d.v_found AS pd_delq_found",
+            "pd_d.n_cumulative_default_prob AS pd_delq_cumulative",
+            "pd_12m.v_found AS pd_12m_found",
+            "pd_12m.n_cumulative_default_prob AS pd_12m_cumulative",
+        ]
+        # Latest interpolated curve on or before the reporting date, per matching rule of
+        # process_account_range (12-month PD is read from delinquency curves only)
+        pd_joins = """
+            LEFT JOIN LATERAL (
+                SELECT TRUE AS v_found, pd.n_cumulative_default_prob
+                FROM fsi_pd_interpolated pd
+                WHERE pd.fic_mis_date <= sd.fic_mis_date
+                  AND pd.v_pd_term_structure_id = sd.n_pd_term_structure_skey
+                  AND pd.v_pd_term_structure_type = 'R'
+                  AND pd.v_int_rating_code = sd.n_credit_rating_code
+                  AND pd.v_cash_flow_bucket_id = ec.n_cash_flow_bucket
+                ORDER BY pd.fic_mis_date DESC
+                LIMIT 1
+            ) pd_r ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT TRUE AS v_found, pd.n_cumulative_default_prob
+                FROM fsi_pd_interpolated pd
+                WHERE pd.fic_mis_date <= sd.fic_mis_date
+                  AND pd.v_pd_term_structure_id = sd.n_pd_term_structure_skey
+                  AND pd.v_pd_term_structure_type = 'D'
+                  AND pd.v_delq_band_code = sd.n_delq_band_code
+                  AND pd.v_cash_flow_bucket_id = ec.n_cash_flow_bucket
+                ORDER BY pd.fic_mis_date DESC
+                LIMIT 1
+            ) pd_d ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT TRUE AS v_found, pd.n_cumulative_default_prob
+                FROM fsi_pd_interpolated pd
+                WHERE pd.fic_mis_date <= sd.fic_mis_date
+                  AND pd.v_pd_term_structure_id = sd.n_pd_term_structure_skey
+                  AND pd.v_pd_term_structure_type = 'D'
+                  AND pd.v_delq_band_code = sd.n_delq_band_code
+                  AND pd.v_cash_flow_bucket_id = LEAST(ec.n_cash_flow_bucket, %s)
+                ORDER BY pd.fic_mis_date DESC
+                LIMIT 1
+            ) pd_12m ON TRUE"""
+    else:
+        base_select += [
+            "FALSE AS pd_rating_found", "NULL::NUMERIC AS pd_rating_cumulative",
+            "FALSE AS pd_delq_found", "NULL::NUMERIC AS pd_delq_cumulative",
+            "FALSE AS pd_12m_found", "NULL::NUMERIC AS pd_12m_cumulative",
+        ]
+        pd_joins = ""
+
+    base_select += [
+        "sd.n_account_number AS sd_account_number",
+        "sd.n_effective_interest_rate AS sd_effective_interest_rate",
+        "sd.n_lgd_percent AS sd_lgd_percent",
+        "sd.v_amrt_term_unit AS sd_amrt_term_unit",
+        "sd.n_collateral_amount AS sd_collateral_amount",
+    ]
+
+    shard_condition = f" AND {hash_bucket_condition('ec.v_account_number', shard_count)}" if shard_count else ''
+
+    ctes = [f"""
+        layer_0 AS (
+            SELECT {', '.join(base_select)}
+            FROM fsi_expected_cashflow ec
+            LEFT JOIN fct_stage_determination sd
+              ON sd.fic_mis_date = ec.fic_mis_date
+             AND sd.n_account_number = ec.v_account_number{pd_joins}
+            WHERE ec.fic_mis_date = %s{shard_condition}
+        )"""]
+    parameters = ['run_skey'] + (['months_to_12m'] if with_pd_lookups else []) + ['fic_mis_date']
+    if shard_count:
+        parameters.append('shard')
+
+    layer_index = 0
+    for step in steps:
+        for layer in FUSED_CASH_FLOW_STEPS[step]:
+            select = [
+                f"CAST({layer[column]} AS {get_column_type(column)}) AS {column}" if column in layer else column
+                for column in CASH_FLOW_COLUMNS
+            ]
+            ctes.append(f"""
+        layer_{layer_index + 1} AS (
+            SELECT {', '.join(select + LOOKUP_COLUMNS)}
+            FROM layer_{layer_index}
+        )""")
+            layer_index += 1
+
+    sql = f"""
+        WITH {','.join(ctes)}
+        INSERT INTO fsi_financial_cash_flow_cal ({', '.join(CASH_FLOW_COLUMNS)})
+        SELECT {', '.join(CASH_FLOW_COLUMNS)}
+        FROM layer_{layer_index};
+    """
+    return sql, parameters
+
+
+def insert_cash_flow_data_fused(fic_mis_date, steps=None):
+    """
+    Insert the run's rows into fsi_financial_cash_flow_cal with the final values of the calculation
+    chain, instead of inserting them with insert_cash_flow_data and rewriting every row in each step.
+
+    Each row is written once, so the run leaves no dead tuples behind. The stepwise functions stay
+    available and produce the same values; use them to debug a single step.
+
+    :param fic_mis_date: Reporting date.
+    :param steps: Steps to fold, in execution order (default DEFAULT_FUSED_STEPS).
+    :return: '1' on success, '0' on failure.
+    """
+    steps = DEFAULT_FUSED_STEPS if steps is None else steps
+    try:
+        unknown = [step for step in steps if step not in FUSED_CASH_FLOW_STEPS]
+        if unknown:
+            save_log('insert_cash_flow_data_fused', 'ERROR', f"Steps cannot be fused: {', '.join(unknown)}.")
+            return '0'
+
+        next_run_skey = get_next_run_skey()
+        if not next_run_skey:
+            return '0'
+
+        prepare_run_partition('fsi_financial_cash_flow_cal', fic_mis_date, next_run_skey)
+
+        sql, parameters = build_fused_cash_flow_sql(steps)
+        values = {
+            'run_skey': next_run_skey,
+            'fic_mis_date': fic_mis_date,
+            'months_to_12m': get_buckets_for_12_months('M'),
+        }
+
+        with connection.cursor() as cursor, transaction.atomic():
+            cursor.execute(sql, [values[name] for name in parameters])
+            inserted_count = cursor.rowcount
+
+        save_log(
+            'insert_cash_flow_data_fused',
+            'INFO',
+            f"Inserted {inserted_count} records for fic_mis_date {fic_mis_date} with run key {next_run_skey}, "
+            f"fused steps: {', '.join(steps) or 'none'}."
+        )
+        prune_old_run_partitions('fsi_financial_cash_flow_cal', fic_mis_date, next_run_skey)
+        return '1'
+
+    except Exception as e:
+        save_log('insert_cash_flow_data_fused', 'ERROR', f"Error during fused cash flow insertion: {e}")
+        return '0'
@@ -1,22 +1,10 @@
 import time
-from concurrent.futures import ThreadPoolExecutor
 from django.db import connection, transaction, DatabaseError
-from IFRS9.models import Dim_Run
+from .batching import get_key_ranges, run_batches
 from .save_log import save_log
+from .reference_data import get_latest_run_skey
 
 
-def get_latest_run_skey():
-    """Retrieve the latest_run_skey from Dim_Run table."""
-    try:
-        run_record = Dim_Run.objects.only('latest_run_skey').first()
-        if not run_record:
-            save_log('get_latest_run_skey', 'ERROR', "No run key is available in the Dim_Run table.")
-            return None
-        return run_record.latest_run_skey
-    except Exception as e:
-        save_log('get_latest_run_skey', 'ERROR', str(e))
-        return None
-
 
 def get_buckets_for_12_months(v_amrt_term_unit):
     """Returns the number of buckets required to reach 12 months based on the amortization term unit."""
@@ -29,18 +17,16 @@ def get_buckets_for_12_months(v_amrt_term_unit):
     return term_unit_to_buckets.get(v_amrt_term_unit, 12)
 
 
-def process_batch_for_term_structure(
-    amrt_unit,
+def process_account_range(
     fic_mis_date,
     run_skey,
     months_to_12m,
-    bucket_limit,
-    term_structure_id,
-    batch_accounts,
+    first_account,
+    last_account,
     retries=3,
     retry_delay=5
 ):
-    """Process a single batch of accounts for a specific term structure with retry logic."""
+    """Process the accounts between first_account and last_account (inclusive) with retry logic."""
     attempt = 0
     while attempt < retries:
         try:
@@ -64,8 +50,7 @@ def process_batch_for_term_structure(
                          AND pd.v_cash_flow_bucket_id = cf.n_cash_flow_bucket_id
                         WHERE cf.fic_mis_date = %s
                           AND cf.n_run_skey = %s
-                          AND sd.n_pd_term_structure_skey = %s
-                          AND sd.n_account_number = ANY(%s)
+                          AND sd.n_account_number BETWEEN %s AND %s
                     )
                     UPDATE fsi_financial_cash_flow_cal cf
                     SET 
@@ -73,7 +58,7 @@ def process_batch_for_term_structure(
                         n_cumulative_impaired_prob = r.n_cumulative_impaired_prob
                     FROM rating_subquery r
                     WHERE cf.id = r.cf_id;
-                """, [fic_mis_date, run_skey, term_structure_id, batch_accounts])
+                """, [fic_mis_date, run_skey, first_account, last_account])
 
                 # Delinquency-based update
                 cursor.execute("""
@@ -94,8 +79,7 @@ def process_batch_for_term_structure(
                          AND pd.v_cash_flow_bucket_id = cf.n_cash_flow_bucket_id
                         WHERE cf.fic_mis_date = %s
                           AND cf.n_run_skey = %s
-                          AND sd.n_pd_term_structure_skey = %s
-                          AND sd.n_account_number = ANY(%s)
+                          AND sd.n_account_number BETWEEN %s AND %s
                     )
                     UPDATE fsi_financial_cash_flow_cal cf
                     SET 
@@ -103,7 +87,7 @@ def process_batch_for_term_structure(
                         n_cumulative_impaired_prob = d.n_cumulative_impaired_prob
                     FROM delinquency_subquery d
                     WHERE cf.id = d.cf_id;
-                """, [fic_mis_date, run_skey, term_structure_id, batch_accounts])
+                """, [fic_mis_date, run_skey, first_account, last_account])
 
                 # 12-Month PD Update For Delinquency-base
                 cursor.execute("""
@@ -123,8 +107,7 @@ def process_batch_for_term_structure(
                          AND pd.v_delq_band_code = sd.n_delq_band_code
                         WHERE cf.fic_mis_date = %s
                           AND cf.n_run_skey = %s
-                          AND sd.n_pd_term_structure_skey = %s
-                          AND sd.n_account_number = ANY(%s)
+                          AND sd.n_account_number BETWEEN %s AND %s
                         AND pd.v_pd_term_structure_id = sd.n_pd_term_structure_skey
                           
                     )
@@ -132,7 +115,7 @@ def process_batch_for_term_structure(
                     SET n_12m_cumulative_pd = p.n_12m_cumulative_pd
                     FROM pd_12_months_subquery p
                     WHERE cf.id = p.cf_id;
-                """, [months_to_12m, fic_mis_date, run_skey, term_structure_id, batch_accounts])
+                """, [months_to_12m, fic_mis_date, run_skey, first_account, last_account])
 
                 # 12-Month PD Update FOR RATING
                 cursor.execute("""
@@ -152,8 +135,7 @@ def process_batch_for_term_structure(
                          AND pd.v_int_rating_code = sd.n_credit_rating_code
                         WHERE cf.fic_mis_date = %s
                           AND cf.n_run_skey = %s
-                          AND sd.n_pd_term_structure_skey = %s
-                          AND sd.n_account_number = ANY(%s)
+                          AND sd.n_account_number BETWEEN %s AND %s
                         AND pd.v_pd_term_structure_id = sd.n_pd_term_structure_skey
                          AND pd.v_pd_term_structure_type = 'D'
                          AND pd.v_delq_band_code = sd.n_delq_band_code 
@@ -162,7 +144,7 @@ def process_batch_for_term_structure(
                     SET n_12m_cumulative_pd = p.n_12m_cumulative_pd
                     FROM pd_12_months_subquery p
                     WHERE cf.id = p.cf_id;
-                """, [months_to_12m, fic_mis_date, run_skey, term_structure_id, batch_accounts])
+                """, [months_to_12m, fic_mis_date, run_skey, first_account, last_account])
 
 
             return  # Successful execution
@@ -177,7 +159,8 @@ def process_batch_for_term_structure(
 
 def update_cash_flow_with_pd_buckets(fic_mis_date, batch_size=5000, max_workers=4):
     """
-    Updates cash flow records with PD bucket information in batches of accounts using multithreading.
+    Updates cash flow records with PD bucket information in disjoint account-number ranges of
+    batch_size accounts, processed in parallel threads.
     """
     try:
         run_skey = get_latest_run_skey()
@@ -188,46 +171,16 @@ def update_cash_flow_with_pd_buckets(fic_mis_date, batch_size=5000, max_workers=
         amrt_unit = 'M'
         months_to_12m = get_buckets_for_12_months(amrt_unit)
 
-        # Retrieve distinct account numbers and their term structures
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                SELECT DISTINCT n_account_number, n_pd_term_structure_skey 
-                FROM fct_stage_determination 
-                WHERE fic_mis_date = %s;
-            """, [fic_mis_date])
-            rows = cursor.fetchall()
-
-        # Group accounts by term_structure_id
-        term_structure_map = {}
-        for account, term_structure_id in rows:
-            term_structure_map.setdefault(term_structure_id, []).append(account)
-
-        futures = []
-        executor = ThreadPoolExecutor(max_workers=max_workers)
-
-        # Schedule tasks for each term structure in batches
-        for term_structure_id, accounts in term_structure_map.items():
-            for i in range(0, len(accounts), batch_size):
-                batch_accounts = accounts[i:i + batch_size]
-                if not batch_accounts:
-                    continue
-                futures.append(
-                    executor.submit(
-                        process_batch_for_term_structure,
-                        amrt_unit,
-                        fic_mis_date,
-                        run_skey,
-                        months_to_12m,
-                        batch_size,
-                        term_structure_id,
-                        batch_accounts
-                    )
-                )
-
-        for future in futures:
-            future.result()  # Reraise exceptions from threads
+        # Split the date's accounts into ranges; each range holds every cash flow of its accounts
+        account_ranges = get_key_ranges(
+            'fct_stage_determination', 'n_account_number', 'fic_mis_date = %s', [fic_mis_date], batch_size
+        )
 
-        executor.shutdown()
+        run_batches(
+            account_ranges,
+            lambda account_range: process_account_range(fic_mis_date, run_skey, months_to_12m, *account_range),
+            max_workers=max_workers,
+        )
 
         save_log('update_cash_flow_with_pd_buckets', 'INFO',
                  f"Set-based PD updates completed for fic_mis_date={fic_mis_date}, run_skey={run_skey}.")
@@ -1,10 +1,31 @@
-import math
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 from IFRS9.models import *
 from .save_log import save_log
-from django.db import transaction
+from .reference_data import get_run_context
+from .bulk_copy import copy_rows
+from django.db import connection, transaction
 from dateutil.relativedelta import relativedelta
 
+# Buckets per year and months per bucket for each cash flow bucket unit
+BUCKET_FREQUENCY = {'M': 12, 'Q': 4, 'H': 2, 'Y': 1}
+MONTHS_PER_BUCKET = {'M': 1, 'Q': 3, 'H': 6, 'Y': 12}
+
+PD_INTERPOLATED_COLUMNS = [
+    'v_pd_term_structure_id', 'fic_mis_date', 'projection_year', 'v_int_rating_code',
+    'v_delq_band_code', 'v_pd_term_structure_type', 'n_pd_percent', 'n_per_period_default_prob',
+    'n_cumulative_default_prob', 'n_cumulative_default_prob_base', 'v_cash_flow_bucket_id',
+    'v_cash_flow_bucket_unit',
+]
+
+PD_ACCOUNT_INTERPOLATED_COLUMNS = [
+    'fic_mis_date', 'projection_year', 'v_account_number', 'n_pd_percent', 'n_per_period_default_prob',
+    'n_cumulative_default_prob', 'n_cumulative_default_prob_base', 'v_cash_flow_bucket_id',
+    'v_cash_flow_bucket_unit',
+]
+
+# Number of accounts interpolated together at the account level
+ACCOUNT_CHUNK_SIZE = 20000
+
 def get_projection_year(start_date, bucket, bucket_unit):
     """
     Calculate the projection year for a given bucket.
@@ -26,438 +47,246 @@ def get_projection_year(start_date, bucket, bucket_unit):
         bucket_date = start_date
     return bucket_date.year
 
+def get_cash_flow_bucket_unit(frequency_unit):
+    """
+    Map a term structure or interest frequency unit to the bucket unit used for interpolation.
+    Anything other than monthly, quarterly or half-yearly is interpolated yearly.
+    """
+    return frequency_unit if frequency_unit in ('M', 'Q', 'H') else 'Y'
+
+def get_projection_years(start_dates, periods, bucket_unit):
+    """
+    Projection years for buckets 1..periods of every start date, as a (dates x periods) matrix.
+
+    Adding whole months never changes the year through day-of-month clamping, so the year of
+    start_date + relativedelta(months=n) is read from a month-offset table instead.
+    """
+    start_months = np.array([d.year * 12 + d.month - 1 for d in start_dates], dtype=np.int64)
+    month_offsets = np.arange(1, periods + 1, dtype=np.int64) * MONTHS_PER_BUCKET[bucket_unit]
+    return (start_months[:, None] + month_offsets[None, :]) // 12
+
+def interpolate_pd_curves(pd_percent, bucket_frequency, periods, pd_interpolation_method, clamp_poisson=True):
+    """
+    Build marginal and cumulative PD curves for many PDs at once.
+
+    :param pd_percent: 1-D array of annual PDs.
+    :param bucket_frequency: Number of buckets per year.
+    :param periods: Number of buckets to generate.
+    :param pd_interpolation_method: NL-POISSON, NL-GEOMETRIC, NL-ARITHMETIC or EXPONENTIAL_DECAY.
+    :param clamp_poisson: Keep Poisson PDs inside (0, 1) before taking the logarithm.
+    :return: (marginal, cumulative, emitted) matrices of shape (len(pd_percent), periods), or None
+             for an unknown method. emitted is False for buckets after an exponential decay curve
+             has run out of population.
+    """
+    pd_percent = np.asarray(pd_percent, dtype=float)
+    buckets = np.arange(1, periods + 1)
+    emitted = np.ones((len(pd_percent), periods), dtype=bool)
+
+    if pd_interpolation_method in ('NL-POISSON', 'NL-GEOMETRIC', 'NL-ARITHMETIC'):
+        if pd_interpolation_method == 'NL-POISSON':
+            if clamp_poisson:
+                epsilon = 1e-6
+                pd_percent = np.clip(pd_percent, epsilon, 1 - epsilon)
+            marginal_pd = 1 - np.exp(np.log(1 - pd_percent) / bucket_frequency)
+        elif pd_interpolation_method == 'NL-GEOMETRIC':
+            marginal_pd = (1 + pd_percent) ** (1 / bucket_frequency) - 1
+        else:
+            marginal_pd = pd_percent / bucket_frequency
+
+        # Constant marginal PD: survival after k buckets is (1 - marginal) ** k
+        marginal = np.repeat(marginal_pd[:, None], periods, axis=1)
+        cumulative = 1 - np.power.outer(1 - marginal_pd, buckets)
+        return marginal, cumulative, emitted
+
+    if pd_interpolation_method == 'EXPONENTIAL_DECAY':
+        if bucket_frequency > 1:
+            pd_percent = 1 - (1 - pd_percent) ** (1 / bucket_frequency)
+
+        # Each bucket is rounded to 4 decimals, so the curve is stepped bucket by bucket across all rows
+        marginal = np.zeros((len(pd_percent), periods))
+        cumulative = np.zeros((len(pd_percent), periods))
+        population_remaining = np.ones(len(pd_percent))
+        cumulative_pd = np.zeros(len(pd_percent))
+        running = np.ones(len(pd_percent), dtype=bool)
+        for k in range(periods):
+            emitted[:, k] = running
+            marginal_pd = np.round(population_remaining * pd_percent, 4)
+            population_remaining = np.round(population_remaining - marginal_pd, 4)
+            cumulative_pd = np.round(cumulative_pd + marginal_pd, 4)
+            marginal[:, k] = marginal_pd
+            cumulative[:, k] = cumulative_pd
+            # Stop the curve once the population reaches 0
+            running &= population_remaining > 0
+        return marginal, cumulative, emitted
+
+    return None
+
 # -------------------------
 # Term structure interpolation functions
 # -------------------------
 def perform_interpolation(mis_date):
     """
-    Perform PD interpolation based on the term structure details and preferences,
-    processing items in batches of 5, with database consistency and thread safety.
+    Perform PD interpolation for every term structure detail on the MIS date.
+
+    Details sharing a bucket unit are interpolated together as (details x buckets) matrices and
+    the results are written to fsi_pd_interpolated with a single COPY.
     """
     try:
-        preferences = FSI_LLFP_APP_PREFERENCES.objects.first()
+        preferences = get_run_context().get_app_preferences()
         pd_interpolation_method = preferences.pd_interpolation_method or 'NL-POISSON'
         pd_model_proj_cap = preferences.n_pd_model_proj_cap
 
-        # Clear previous interpolated results for the given date to ensure consistency
-        FSI_PD_Interpolated.objects.filter(fic_mis_date=mis_date).delete()
-
-        # Fetch term structure details and process in batches of 5
-        term_structure_details = list(Ldn_PD_Term_Structure_Dtl.objects.filter(fic_mis_date=mis_date))
-        batch_size = 5
-        
-        for i in range(0, len(term_structure_details), batch_size):
-            batch = term_structure_details[i:i + batch_size]
-            save_log('perform_interpolation', 'INFO', f"Processing batch {i // batch_size + 1} with {len(batch)} items")
-
-            # Atomic transaction to ensure batch consistency
-            with transaction.atomic():
-                with ThreadPoolExecutor(max_workers=batch_size) as executor:
-                    futures = {
-                        executor.submit(process_interpolation, detail, pd_model_proj_cap, pd_interpolation_method): detail.id
-                        for detail in batch
-                    }
-                    
-                    for future in as_completed(futures):
-                        detail_id = futures[future]
-                        try:
-                            future.result()  # Wait for the thread to complete
-                            save_log('perform_interpolation', 'INFO', f"Interpolation completed for detail ID {detail_id}")
-                        except Exception as e:
-                            save_log('perform_interpolation', 'ERROR', f"Interpolation failed for detail ID {detail_id} with error: {e}")
-                            raise  # Rollback if an error occurs in the batch
-
-        save_log('perform_interpolation', 'INFO', "Term structure interpolation completed for all batches.")
+        details = list(
+            Ldn_PD_Term_Structure_Dtl.objects.filter(fic_mis_date=mis_date).values_list(
+                'v_pd_term_structure_id__v_pd_term_structure_id',
+                'v_pd_term_structure_id__fic_mis_date',
+                'v_pd_term_structure_id__v_pd_term_frequency_unit',
+                'v_pd_term_structure_id__v_pd_term_structure_type',
+                'v_credit_risk_basis_cd',
+                'n_pd_percent',
+            )
+        )
+
+        groups = {}
+        for detail in details:
+            groups.setdefault(get_cash_flow_bucket_unit(detail[2]), []).append(detail)
+
+        def generate_rows():
+            for cash_flow_bucket_unit, group in groups.items():
+                bucket_frequency = BUCKET_FREQUENCY[cash_flow_bucket_unit]
+                periods = bucket_frequency * pd_model_proj_cap
+                save_log('perform_interpolation', 'INFO', f"Interpolating {len(group)} details over {periods} '{cash_flow_bucket_unit}' buckets")
+
+                curves = interpolate_pd_curves([float(d[5]) for d in group], bucket_frequency, periods, pd_interpolation_method)
+                if curves is None:
+                    raise ValueError(f"Unknown PD interpolation method '{pd_interpolation_method}'")
+                marginal, cumulative, emitted = curves
+                projection_years = get_projection_years([d[1] for d in group], periods, cash_flow_bucket_unit)
+
+                for i, (term_structure_id, ts_mis_date, _, term_structure_type, credit_risk_basis_cd, pd_percent) in enumerate(group):
+                    rating_code = credit_risk_basis_cd if term_structure_type == 'R' else None
+                    delq_band_code = credit_risk_basis_cd if term_structure_type == 'D' else None
+                    for k, (is_emitted, proj_year, marginal_pd, cumulative_pd) in enumerate(zip(
+                        emitted[i].tolist(), projection_years[i].tolist(), marginal[i].tolist(), cumulative[i].tolist()
+                    )):
+                        if not is_emitted:
+                            break
+                        yield (
+                            term_structure_id, ts_mis_date, proj_year, rating_code, delq_band_code,
+                            term_structure_type, pd_percent, marginal_pd, cumulative_pd, cumulative_pd,
+                            k + 1, cash_flow_bucket_unit,
+                        )
+
+        with transaction.atomic():
+            # Clear previous interpolated results for the given date to ensure consistency
+            FSI_PD_Interpolated.objects.filter(fic_mis_date=mis_date).delete()
+            inserted = copy_rows('fsi_pd_interpolated', PD_INTERPOLATED_COLUMNS, generate_rows(), significant_digits=15)
+
+        save_log('perform_interpolation', 'INFO', f"Term structure interpolation completed: {inserted} rows for {len(details)} details.")
         return '1'
 
     except Exception as e:
         save_log('perform_interpolation', 'ERROR', f"Error during interpolation: {e}")
         return '0'
 
-def process_interpolation(detail, pd_model_proj_cap, pd_interpolation_method):
-    """
-    Process PD interpolation for a given term structure detail.
-    """
-    credit_risk_band = detail.v_credit_risk_basis_cd
-    save_log('process_interpolation', 'INFO', f"Processing interpolation for credit risk band: {credit_risk_band}")
-
-    bucket_length = detail.v_pd_term_structure_id.v_pd_term_frequency_unit
-
-    if bucket_length == 'M':
-        bucket_frequency = 12
-        cash_flow_bucket_unit = 'M'
-    elif bucket_length == 'H':
-        bucket_frequency = 2
-        cash_flow_bucket_unit = 'H'
-    elif bucket_length == 'Q':
-        bucket_frequency = 4
-        cash_flow_bucket_unit = 'Q'
-    else:
-        bucket_frequency = 1
-        cash_flow_bucket_unit = 'Y'
-
-    if pd_interpolation_method == 'NL-POISSON':
-        interpolate_poisson(detail, bucket_frequency, pd_model_proj_cap, cash_flow_bucket_unit)
-    elif pd_interpolation_method == 'NL-GEOMETRIC':
-        interpolate_geometric(detail, bucket_frequency, pd_model_proj_cap, cash_flow_bucket_unit)
-    elif pd_interpolation_method == 'NL-ARITHMETIC':
-        interpolate_arithmetic(detail, bucket_frequency, pd_model_proj_cap, cash_flow_bucket_unit)
-    elif pd_interpolation_method == 'EXPONENTIAL_DECAY':
-        interpolate_exponential_decay(detail, bucket_frequency, pd_model_proj_cap, cash_flow_bucket_unit)
-
-def interpolate_poisson(detail, bucket_frequency, pd_model_proj_cap, cash_flow_bucket_unit):
-    periods = bucket_frequency * pd_model_proj_cap
-    pd_percent = float(detail.n_pd_percent)
-    cumulative_pd = 0
-    epsilon = 1e-6  # Small value to adjust pd_percent
-
-    pd_percent = min(max(pd_percent, epsilon), 1 - epsilon)
-    records = []
-    for bucket in range(1, periods + 1):
-        try:
-            marginal_pd = 1 - math.exp(math.log(1 - pd_percent) / bucket_frequency)
-        except ValueError as e:
-            save_log('interpolate_poisson', 'ERROR', f"Error calculating marginal_pd: {e}")
-            return
-        cumulative_pd = 1 - (1 - cumulative_pd) * (1 - marginal_pd)
-
-        # Calculate projection_year based on the MIS date and bucket index
-        proj_year = get_projection_year(detail.v_pd_term_structure_id.fic_mis_date, bucket, cash_flow_bucket_unit)
-
-        records.append(FSI_PD_Interpolated(
-            v_pd_term_structure_id=detail.v_pd_term_structure_id.v_pd_term_structure_id,
-            fic_mis_date=detail.v_pd_term_structure_id.fic_mis_date,
-            projection_year=proj_year,
-            v_int_rating_code=detail.v_credit_risk_basis_cd if detail.v_pd_term_structure_id.v_pd_term_structure_type == 'R' else None,
-            v_delq_band_code=detail.v_credit_risk_basis_cd if detail.v_pd_term_structure_id.v_pd_term_structure_type == 'D' else None,
-            v_pd_term_structure_type=detail.v_pd_term_structure_id.v_pd_term_structure_type,
-            n_pd_percent=detail.n_pd_percent,
-            n_per_period_default_prob=marginal_pd,
-            n_cumulative_default_prob=cumulative_pd,
-            n_cumulative_default_prob_base=cumulative_pd,
-            v_cash_flow_bucket_id=bucket,
-            v_cash_flow_bucket_unit=cash_flow_bucket_unit
-        ))
-    try:
-        FSI_PD_Interpolated.objects.bulk_create(records)
-        save_log('interpolation', 'INFO', f"Successfully saved records for credit risk band: {detail.v_credit_risk_basis_cd}")
-    except Exception as e:
-        save_log('interpolation', 'ERROR', f"Failed to save records for credit risk band {detail.v_credit_risk_basis_cd}: {e}")
-
-def interpolate_geometric(detail, bucket_frequency, pd_model_proj_cap, cash_flow_bucket_unit):
-    """
-    Perform Geometric interpolation for a given term structure detail.
-    """
-    periods = bucket_frequency * pd_model_proj_cap
-    pd_percent = float(detail.n_pd_percent)
-    cumulative_pd = 0
-    records = []
-    for bucket in range(1, periods + 1):
-        marginal_pd = (1 + pd_percent) ** (1 / bucket_frequency) - 1
-        cumulative_pd = 1 - (1 - cumulative_pd) * (1 - marginal_pd)
-
-        proj_year = get_projection_year(detail.v_pd_term_structure_id.fic_mis_date, bucket, cash_flow_bucket_unit)
-
-        records.append(FSI_PD_Interpolated(
-            v_pd_term_structure_id=detail.v_pd_term_structure_id.v_pd_term_structure_id,
-            fic_mis_date=detail.v_pd_term_structure_id.fic_mis_date,
-            projection_year=proj_year,
-            v_int_rating_code=detail.v_credit_risk_basis_cd if detail.v_pd_term_structure_id.v_pd_term_structure_type == 'R' else None,
-            v_delq_band_code=detail.v_credit_risk_basis_cd if detail.v_pd_term_structure_id.v_pd_term_structure_type == 'D' else None,
-            v_pd_term_structure_type=detail.v_pd_term_structure_id.v_pd_term_structure_type,
-            n_pd_percent=detail.n_pd_percent,
-            n_per_period_default_prob=marginal_pd,
-            n_cumulative_default_prob=cumulative_pd,
-            n_cumulative_default_prob_base=cumulative_pd,
-            v_cash_flow_bucket_id=bucket,
-            v_cash_flow_bucket_unit=cash_flow_bucket_unit
-        ))
-    try:
-        FSI_PD_Interpolated.objects.bulk_create(records)
-        save_log('interpolation', 'INFO', f"Successfully saved records for credit risk band: {detail.v_credit_risk_basis_cd}")
-    except Exception as e:
-        save_log('interpolation', 'ERROR', f"Failed to save records for credit risk band {detail.v_credit_risk_basis_cd}: {e}")
-
-def interpolate_arithmetic(detail, bucket_frequency, pd_model_proj_cap, cash_flow_bucket_unit):
+# -------------------------
+# Account-level interpolation functions
+# -------------------------
+def fetch_account_pd_inputs(mis_date):
     """
-    Perform Arithmetic interpolation for a given term structure detail.
+    Fetch PD, interest frequency and the last cash flow bucket of every account in one query.
     """
-    periods = bucket_frequency * pd_model_proj_cap
-    pd_percent = float(detail.n_pd_percent)
-    cumulative_pd = 0
-    marginal_pd = pd_percent / bucket_frequency
-    records = []
-    for bucket in range(1, periods + 1):
-        cumulative_pd = 1 - (1 - cumulative_pd) * (1 - marginal_pd)
-
-        proj_year = get_projection_year(detail.v_pd_term_structure_id.fic_mis_date, bucket, cash_flow_bucket_unit)
-
-        records.append(FSI_PD_Interpolated(
-            v_pd_term_structure_id=detail.v_pd_term_structure_id.v_pd_term_structure_id,
-            fic_mis_date=detail.v_pd_term_structure_id.fic_mis_date,
-            projection_year=proj_year,
-            v_int_rating_code=detail.v_credit_risk_basis_cd if detail.v_pd_term_structure_id.v_pd_term_structure_type == 'R' else None,
-            v_delq_band_code=detail.v_credit_risk_basis_cd if detail.v_pd_term_structure_id.v_pd_term_structure_type == 'D' else None,
-            v_pd_term_structure_type=detail.v_pd_term_structure_id.v_pd_term_structure_type,
-            n_pd_percent=detail.n_pd_percent,
-            n_per_period_default_prob=marginal_pd,
-            n_cumulative_default_prob=cumulative_pd,
-            n_cumulative_default_prob_base=cumulative_pd,
-            v_cash_flow_bucket_id=bucket,
-            v_cash_flow_bucket_unit=cash_flow_bucket_unit
-        ))
-    try:
-        FSI_PD_Interpolated.objects.bulk_create(records)
-        save_log('interpolation', 'INFO', f"Successfully saved records for credit risk band: {detail.v_credit_risk_basis_cd}")
-    except Exception as e:
-        save_log('interpolation', 'ERROR', f"Failed to save records for credit risk band {detail.v_credit_risk_basis_cd}: {e}")
-
-def interpolate_exponential_decay(detail, bucket_frequency, pd_model_proj_cap, cash_flow_bucket_unit):
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT fi.v_account_number, fi.fic_mis_date, fi.n_pd_percent, fi.v_interest_freq_unit, cf.max_bucket
+            FROM ldn_financial_instrument fi
+            JOIN (
+                SELECT v_account_number, MAX(n_cash_flow_bucket) AS max_bucket
+                FROM fsi_expected_cashflow
+                WHERE fic_mis_date = %s
+                GROUP BY v_account_number
+            ) cf ON cf.v_account_number = fi.v_account_number
+            WHERE fi.fic_mis_date = %s
+        """, [mis_date, mis_date])
+        return cursor.fetchall()
+
+def generate_account_interpolation_rows(accounts, pd_interpolation_method):
     """
-    Perform Exponential Decay interpolation for a given term structure detail.
+    Yield fsi_pd_account_interpolated rows for accounts sharing one bucket unit, interpolating
+    ACCOUNT_CHUNK_SIZE accounts at a time as (accounts x buckets) matrices.
     """
-    periods = bucket_frequency * pd_model_proj_cap
-    pd_percent = float(detail.n_pd_percent)
-
-    if cash_flow_bucket_unit == 'Q':
-        pd_percent = 1 - (1 - pd_percent) ** (1 / 4)
-    elif cash_flow_bucket_unit == 'H':
-        pd_percent = 1 - (1 - pd_percent) ** (1 / 2)
-    elif cash_flow_bucket_unit == 'M':
-        pd_percent = 1 - (1 - pd_percent) ** (1 / 12)
-
-    cumulative_pd = 0
-    population_remaining = 1
-    records = []
-    for bucket in range(1, periods + 1):
-        marginal_pd = round(population_remaining * pd_percent, 4)
-        population_remaining = round(population_remaining - marginal_pd, 4)
-        cumulative_pd = round(cumulative_pd + marginal_pd, 4)
-
-        proj_year = get_projection_year(detail.v_pd_term_structure_id.fic_mis_date, bucket, cash_flow_bucket_unit)
-
-        records.append(FSI_PD_Interpolated(
-            v_pd_term_structure_id=detail.v_pd_term_structure_id.v_pd_term_structure_id,
-            fic_mis_date=detail.v_pd_term_structure_id.fic_mis_date,
-            projection_year=proj_year,
-            v_int_rating_code=detail.v_credit_risk_basis_cd if detail.v_pd_term_structure_id.v_pd_term_structure_type == 'R' else None,
-            v_delq_band_code=detail.v_credit_risk_basis_cd if detail.v_pd_term_structure_id.v_pd_term_structure_type == 'D' else None,
-            v_pd_term_structure_type=detail.v_pd_term_structure_id.v_pd_term_structure_type,
-            n_pd_percent=detail.n_pd_percent,
-            n_per_period_default_prob=marginal_pd,
-            n_cumulative_default_prob=cumulative_pd,
-            n_cumulative_default_prob_base=cumulative_pd,
-            v_cash_flow_bucket_id=bucket,
-            v_cash_flow_bucket_unit=cash_flow_bucket_unit
-        ))
-        try:
-            FSI_PD_Interpolated.objects.bulk_create(records)
-            save_log('interpolation', 'INFO', f"Successfully saved records for credit risk band: {detail.v_credit_risk_basis_cd}")
-        except Exception as e:
-            save_log('interpolation', 'ERROR', f"Failed to save records for credit risk band {detail.v_credit_risk_basis_cd}: {e}")
-
-        # Stop the loop if the population reaches 0
-        if population_remaining <= 0:
-            break
+    for i in range(0, len(accounts), ACCOUNT_CHUNK_SIZE):
+        chunk = accounts[i:i + ACCOUNT_CHUNK_SIZE]
+        cash_flow_bucket_unit = get_cash_flow_bucket_unit(chunk[0][3])
+        bucket_frequency = BUCKET_FREQUENCY[cash_flow_bucket_unit]
+        periods = max(account[4] for account in chunk)
+
+        pd_percent = np.array([float(account[2]) for account in chunk])
+        curves = interpolate_pd_curves(pd_percent, bucket_frequency, periods, pd_interpolation_method, clamp_poisson=False)
+        if curves is None:
+            raise ValueError(f"Unknown PD interpolation method '{pd_interpolation_method}'")
+        # Unlike the term structure curves, every bucket up to the account's last cash flow is
+        # written, also after an exponential decay curve has exhausted its population
+        marginal, cumulative, _ = curves
+        projection_years = get_projection_years([account[1] for account in chunk], periods, cash_flow_bucket_unit)
+
+        # Exponential decay stores the per-bucket PD rather than the annual one
+        if pd_interpolation_method == 'EXPONENTIAL_DECAY' and bucket_frequency > 1:
+            pd_percent = 1 - (1 - pd_percent) ** (1 / bucket_frequency)
+
+        for j, (account_number, fic_mis_date, _, _, max_bucket) in enumerate(chunk):
+            account_pd = float(pd_percent[j])
+            for k, (proj_year, marginal_pd, cumulative_pd) in enumerate(zip(
+                projection_years[j, :max_bucket].tolist(),
+                marginal[j, :max_bucket].tolist(), cumulative[j, :max_bucket].tolist()
+            )):
+                yield (
+                    fic_mis_date, proj_year, account_number, account_pd, marginal_pd,
+                    cumulative_pd, cumulative_pd, k + 1, cash_flow_bucket_unit,
+                )
 
-# -------------------------
-# Account-level interpolation functions
-# -------------------------
 def pd_interpolation_account_level(mis_date):
     """
     Perform PD interpolation at the account level based on the PD details and cashflow buckets.
-    """
-    try:
-        accounts = Ldn_Financial_Instrument.objects.filter(fic_mis_date=mis_date)
-        if not accounts.exists():
-            save_log('pd_interpolation_account_level', 'ERROR', f"No accounts found for mis_date {mis_date}.")
-            return '0'
-
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = [
-                executor.submit(process_account_interpolation, account, mis_date)
-                for account in accounts
-            ]
-
-            for future in futures:
-                future.result()
 
-        save_log('pd_interpolation_account_level', 'INFO', "Account-level PD interpolation completed successfully.")
-        return '1'
-
-    except Exception as e:
-        save_log('pd_interpolation_account_level', 'ERROR', f"Error during account-level interpolation: {e}")
-        return '0'
-
-def process_account_interpolation(account, mis_date):
+    Max buckets for all accounts come from one GROUP BY on fsi_expected_cashflow, the curves are
+    built as matrices per bucket unit, and fsi_pd_account_interpolated is replaced for the date
+    in a single transaction.
     """
-    Process PD interpolation for a given account-level PD detail.
-    """
-    account_number = account.v_account_number
-    save_log('process_account_interpolation', 'INFO', f"Processing interpolation for account: {account_number}")
-
     try:
-        pd_percent = Ldn_Financial_Instrument.objects.get(fic_mis_date=account.fic_mis_date, v_account_number=account_number).n_pd_percent
-        pd_percent = float(pd_percent)
-    except Ldn_Financial_Instrument.DoesNotExist:
-        save_log('process_account_interpolation', 'ERROR', f"No PD found for account {account_number}")
-        return
-
-    max_bucket = FSI_Expected_Cashflow.objects.filter(v_account_number=account_number, fic_mis_date=mis_date)\
-                     .aggregate(max_bucket=models.Max('n_cash_flow_bucket'))['max_bucket']
-    if max_bucket is None:
-        save_log('process_account_interpolation', 'ERROR', f"No cashflow buckets found for account {account_number}")
-        return
-
-    bucket_length = account.v_interest_freq_unit
-    if bucket_length == 'M':
-        bucket_frequency = 12
-        cash_flow_bucket_unit = 'M'
-    elif bucket_length == 'H':
-        bucket_frequency = 2
-        cash_flow_bucket_unit = 'H'
-    elif bucket_length == 'Q':
-        bucket_frequency = 4
-        cash_flow_bucket_unit = 'Q'
-    else:
-        bucket_frequency = 1
-        cash_flow_bucket_unit = 'Y'
+        accounts = fetch_account_pd_inputs(mis_date)
+        if not accounts:
+            save_log('pd_interpolation_account_level', 'ERROR', f"No accounts with cashflow buckets found for mis_date {mis_date}.")
+            return '0'
 
-    FSI_PD_Account_Interpolated.objects.filter(fic_mis_date=account.fic_mis_date, v_account_number=account_number).delete()
+        missing_pd = [account[0] for account in accounts if account[2] is None]
+        if missing_pd:
+            save_log('pd_interpolation_account_level', 'ERROR', f"No PD found for {len(missing_pd)} accounts, e.g. {missing_pd[:10]}")
 
-    preferences = FSI_LLFP_APP_PREFERENCES.objects.first()
-    pd_interpolation_method = preferences.pd_interpolation_method or 'NL-POISSON'
+        groups = {}
+        for account in accounts:
+            if account[2] is not None:
+                groups.setdefault(get_cash_flow_bucket_unit(account[3]), []).append(account)
 
-    if pd_interpolation_method == 'NL-POISSON':
-        interpolate_poisson_account(account, bucket_frequency, max_bucket, pd_percent, cash_flow_bucket_unit)
-    elif pd_interpolation_method == 'NL-GEOMETRIC':
-        interpolate_geometric_account(account, bucket_frequency, max_bucket, pd_percent, cash_flow_bucket_unit)
-    elif pd_interpolation_method == 'NL-ARITHMETIC':
-        interpolate_arithmetic_account(account, bucket_frequency, max_bucket, pd_percent, cash_flow_bucket_unit)
-    elif pd_interpolation_method == 'EXPONENTIAL_DECAY':
-        interpolate_exponential_decay_account(account, bucket_frequency, max_bucket, pd_percent, cash_flow_bucket_unit)
+        preferences = get_run_context().get_app_preferences()
+        pd_interpolation_method = preferences.pd_interpolation_method or 'NL-POISSON'
 
-def interpolate_poisson_account(account, bucket_frequency, max_bucket, pd_percent, cash_flow_bucket_unit):
-    """
-    Perform Poisson interpolation for a given account-level PD detail.
-    """
-    cumulative_pd = 0
-    records = []
-    for bucket in range(1, max_bucket + 1):
-        marginal_pd = 1 - math.exp(math.log(1 - pd_percent) / bucket_frequency)
-        cumulative_pd = 1 - (1 - cumulative_pd) * (1 - marginal_pd)
-
-        proj_year = get_projection_year(account.fic_mis_date, bucket, cash_flow_bucket_unit)
-
-        records.append(FSI_PD_Account_Interpolated(
-            fic_mis_date=account.fic_mis_date,
-            projection_year=proj_year,
-            v_account_number=account.v_account_number,
-            n_pd_percent=pd_percent,
-            n_per_period_default_prob=marginal_pd,
-            n_cumulative_default_prob=cumulative_pd,
-            n_cumulative_default_prob_base=cumulative_pd,
-            v_cash_flow_bucket_id=bucket,
-            v_cash_flow_bucket_unit=cash_flow_bucket_unit
-        ))
-    try:
-        FSI_PD_Account_Interpolated.objects.bulk_create(records)
-        save_log('interpolation', 'INFO', f"Successfully saved account-level records for account: {account.v_account_number}")
-    except Exception as e:
-        save_log('interpolation', 'ERROR', f"Failed to save account-level records for account {account.v_account_number}: {e}")
+        def generate_rows():
+            for group in groups.values():
+                yield from generate_account_interpolation_rows(group, pd_interpolation_method)
 
-def interpolate_geometric_account(account, bucket_frequency, max_bucket, pd_percent, cash_flow_bucket_unit):
-    """
-    Perform Geometric interpolation for a given account-level PD detail.
-    """
-    cumulative_pd = 0
-    records = []
-    for bucket in range(1, max_bucket + 1):
-        marginal_pd = (1 + pd_percent) ** (1 / bucket_frequency) - 1
-        cumulative_pd = 1 - (1 - cumulative_pd) * (1 - marginal_pd)
-
-        proj_year = get_projection_year(account.fic_mis_date, bucket, cash_flow_bucket_unit)
-
-        records.append(FSI_PD_Account_Interpolated(
-            fic_mis_date=account.fic_mis_date,
-            projection_year=proj_year,
-            v_account_number=account.v_account_number,
-            n_pd_percent=pd_percent,
-            n_per_period_default_prob=marginal_pd,
-            n_cumulative_default_prob=cumulative_pd,
-            n_cumulative_default_prob_base=cumulative_pd,
-            v_cash_flow_bucket_id=bucket,
-            v_cash_flow_bucket_unit=cash_flow_bucket_unit
-        ))
-    try:
-        FSI_PD_Account_Interpolated.objects.bulk_create(records)
-        save_log('interpolation', 'INFO', f"Successfully saved account-level records for account: {account.v_account_number}")
-    except Exception as e:
-        save_log('interpolation', 'ERROR', f"Failed to save account-level records for account {account.v_account_number}: {e}")
+        with transaction.atomic():
+            FSI_PD_Account_Interpolated.objects.filter(fic_mis_date=mis_date).delete()
+            inserted = copy_rows(
+                'fsi_pd_account_interpolated', PD_ACCOUNT_INTERPOLATED_COLUMNS, generate_rows(), significant_digits=10
+            )
 
-def interpolate_arithmetic_account(account, bucket_frequency, max_bucket, pd_percent, cash_flow_bucket_unit):
-    """
-    Perform Arithmetic interpolation for a given account-level PD detail.
-    """
-    cumulative_pd = 0
-    marginal_pd = pd_percent / bucket_frequency
-    records = []
-    for bucket in range(1, max_bucket + 1):
-        cumulative_pd = 1 - (1 - cumulative_pd) * (1 - marginal_pd)
-
-        proj_year = get_projection_year(account.fic_mis_date, bucket, cash_flow_bucket_unit)
-
-        records.append(FSI_PD_Account_Interpolated(
-            fic_mis_date=account.fic_mis_date,
-            projection_year=proj_year,
-            v_account_number=account.v_account_number,
-            n_pd_percent=pd_percent,
-            n_per_period_default_prob=marginal_pd,
-            n_cumulative_default_prob=cumulative_pd,
-            n_cumulative_default_prob_base=cumulative_pd,
-            v_cash_flow_bucket_id=bucket,
-            v_cash_flow_bucket_unit=cash_flow_bucket_unit
-        ))
-    try:
-        FSI_PD_Account_Interpolated.objects.bulk_create(records)
-        save_log('interpolation', 'INFO', f"Successfully saved account-level records for account: {account.v_account_number}")
-    except Exception as e:
-        save_log('interpolation', 'ERROR', f"Failed to save account-level records for account {account.v_account_number}: {e}")
+        save_log(
+            'pd_interpolation_account_level', 'INFO',
+            f"Account-level PD interpolation completed successfully: {inserted} rows for {len(accounts) - len(missing_pd)} accounts."
+        )
+        return '1'
 
-def interpolate_exponential_decay_account(account, bucket_frequency, max_bucket, pd_percent, cash_flow_bucket_unit):
-    """
-    Perform Exponential Decay interpolation for a given account-level PD detail.
-    """
-    if cash_flow_bucket_unit == 'Q':
-        pd_percent = 1 - (1 - pd_percent) ** (1 / 4)
-    elif cash_flow_bucket_unit == 'H':
-        pd_percent = 1 - (1 - pd_percent) ** (1 / 2)
-    elif cash_flow_bucket_unit == 'M':
-        pd_percent = 1 - (1 - pd_percent) ** (1 / 12)
-
-    cumulative_pd = 0
-    population_remaining = 1
-    records = []
-    for bucket in range(1, max_bucket + 1):
-        marginal_pd = round(population_remaining * pd_percent, 4)
-        population_remaining = round(population_remaining - marginal_pd, 4)
-        cumulative_pd = round(cumulative_pd + marginal_pd, 4)
-
-        proj_year = get_projection_year(account.fic_mis_date, bucket, cash_flow_bucket_unit)
-
-        records.append(FSI_PD_Account_Interpolated(
-            fic_mis_date=account.fic_mis_date,
-            projection_year=proj_year,
-            v_account_number=account.v_account_number,
-            n_pd_percent=pd_percent,
-            n_per_period_default_prob=marginal_pd,
-            n_cumulative_default_prob=cumulative_pd,
-            n_cumulative_default_prob_base=cumulative_pd,
-            v_cash_flow_bucket_id=bucket,
-            v_cash_flow_bucket_unit=cash_flow_bucket_unit
-        ))
-    try:
-        FSI_PD_Account_Interpolated.objects.bulk_create(records)
-        save_log('interpolation', 'INFO', f"Successfully saved account-level records for account: {account.v_account_number}")
     except Exception as e:
-        save_log('interpolation', 'ERROR', f"Failed to save account-level records for account {account.v_account_number}: {e}")
+        save_log('pd_interpolation_account_level', 'ERROR', f"Error during account-level interpolation: {e}")
+        return '0'
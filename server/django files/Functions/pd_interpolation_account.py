@@ -3,6 +3,7 @@ from concurrent.futures import ThreadPoolExecutor
 from django.db import transaction
 from IFRS9.models import *
 from .save_log import save_log
+from .reference_data import get_run_context
 
 
 def pd_interpolation(mis_date):
@@ -13,7 +14,7 @@ def pd_interpolation(mis_date):
     """
     try:
         # Fetch preferences from FSI_LLFP_APP_PREFERENCES
-        preferences = FSI_LLFP_APP_PREFERENCES.objects.first()
+        preferences = get_run_context().get_app_preferences()
         if not preferences:
             print("No preferences found in FSI_LLFP_APP_PREFERENCES.")
             return '0'  # Return '0' if no preferences are found
@@ -317,7 +318,7 @@ def process_account_interpolation(account, mis_date):
     FSI_PD_Account_Interpolated.objects.filter(fic_mis_date=account.fic_mis_date, v_account_number=account_number).delete()
 
     # Apply the appropriate interpolation method
-    preferences = FSI_LLFP_APP_PREFERENCES.objects.first()
+    preferences = get_run_context().get_app_preferences()
     pd_interpolation_method = preferences.pd_interpolation_method or 'NL-POISSON'
 
     if pd_interpolation_method == 'NL-POISSON':
@@ -2,6 +2,7 @@ from django.db import connection, transaction
 from django.utils import timezone
 from IFRS9.models import Dim_Run
 from .save_log import save_log
+from .run_partitions import prepare_run_partition, prune_old_run_partitions
 
 def get_next_run_skey():
     """
@@ -33,6 +34,8 @@ def insert_cash_flow_data(fic_mis_date):
         if not next_run_skey:
             return '0'
 
+        prepare_run_partition('fsi_financial_cash_flow_cal', fic_mis_date, next_run_skey)
+
         with connection.cursor() as cursor, transaction.atomic():
             # Ensure full table references to handle schema issues
             sql = """
@@ -65,6 +68,7 @@ def insert_cash_flow_data(fic_mis_date):
             'INFO', 
             f"Inserted {inserted_count} records for fic_mis_date {fic_mis_date} with run key {next_run_skey}."
         )
+        prune_old_run_partitions('fsi_financial_cash_flow_cal', fic_mis_date, next_run_skey)
         return '1'
 
     except Exception as e:
@@ -2,6 +2,8 @@ from django.db import connection, transaction
 from django.utils import timezone
 from IFRS9.models import Dim_Run, FCT_Stage_Determination, ECLMethod
 from .save_log import save_log
+from .run_partitions import prepare_run_partition, prune_old_run_partitions
+from .report_snapshot_cache import invalidate_report_snapshots
 
 
 def get_next_run_skey():
@@ -60,6 +62,8 @@ def populate_fct_reporting_lines(mis_date):
             save_log('populate_fct_reporting_lines', 'ERROR', "Failed to retrieve or generate run_skey.")
             return '0'
 
+        prepare_run_partition('fct_reporting_lines', mis_date, last_run_skey)
+
         with transaction.atomic(), connection.cursor() as cursor:
             # Bulk insert into FCT_Reporting_Lines
             cursor.execute("""
@@ -193,6 +197,8 @@ def populate_fct_reporting_lines(mis_date):
             'INFO',
             f"Successfully populated FCT_Reporting_Lines for `fic_mis_date`={mis_date}."
         )
+        invalidate_report_snapshots(mis_date)
+        prune_old_run_partitions('fct_reporting_lines', mis_date, last_run_skey)
         return '1'
 
     except Exception as e:
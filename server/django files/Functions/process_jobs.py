@@ -0,0 +1,225 @@
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from IFRS9.models import FunctionExecutionStatus, ProcessJob
+from .save_log import save_log
+
+# A running job belongs to its worker until this many seconds after the last heartbeat
+PROCESS_JOB_LEASE_SECONDS = getattr(settings, 'PROCESS_JOB_LEASE_SECONDS', 120)
+
+# Interval between two lease renewals of the worker running a job
+PROCESS_JOB_HEARTBEAT_SECONDS = getattr(settings, 'PROCESS_JOB_HEARTBEAT_SECONDS', 30)
+
+# Interval between two polls of an idle worker for queued jobs
+PROCESS_JOB_POLL_SECONDS = getattr(settings, 'PROCESS_JOB_POLL_SECONDS', 5)
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_process_run(process, fic_mis_date, process_run_id, user=None):
+    """Queue a process run whose FunctionExecutionStatus entries were created as Pending."""
+    return ProcessJob.objects.create(
+        process=process,
+        process_run_id=process_run_id,
+        fic_mis_date=fic_mis_date,
+        created_by=user,
+    )
+
+
+def requeue_process_run(process_run_id):
+    """
+    Queue a finished (Failed or Cancelled) run again; the worker resumes it from its first
+    function that did not succeed.
+
+    :return: True if the run was queued again.
+    """
+    return ProcessJob.objects.filter(
+        process_run_id=process_run_id, status__in=['Failed', 'Cancelled']
+    ).update(
+        status='Queued', cancel_requested=False, worker_id=None, lease_expires_at=None,
+        error_message=None, completed_at=None
+    ) == 1
+
+
+def request_cancel(process_run_id):
+    """
+    Ask the worker running process_run_id to stop, from any web node. A job not claimed yet is
+    cancelled right away.
+
+    :return: True if a queued or running job was found.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        found = ProcessJob.objects.filter(
+            process_run_id=process_run_id, status__in=['Queued', 'Running']
+        ).update(cancel_requested=True)
+
+        if ProcessJob.objects.filter(process_run_id=process_run_id, status='Queued').update(status='Cancelled', completed_at=now):
+            FunctionExecutionStatus.objects.filter(
+                process_run_id=process_run_id, status='Pending'
+            ).update(status='Cancelled', execution_end_date=now)
+    return found == 1
+
+
+def is_cancel_requested(process_run_id):
+    return ProcessJob.objects.filter(process_run_id=process_run_id, cancel_requested=True).exists()
+
+
+def claim_next_job(worker_id):
+    """
+    Take the oldest queued job, or a running job whose worker stopped renewing its lease.
+    Competing workers skip the rows locked by each other.
+
+    :return: The claimed ProcessJob, or None when there is nothing to run.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        job = (
+            ProcessJob.objects.select_for_update(skip_locked=True)
+            .filter(Q(status='Queued') | Q(status='Running', lease_expires_at__lt=now))
+            .order_by('created_at')
+            .first()
+        )
+        if job is None:
+            return None
+
+        if job.status == 'Running':
+            save_log('claim_next_job', 'WARNING', f"Lease of worker {job.worker_id} on {job.process_run_id} expired; taken over by {worker_id}.")
+        job.status = 'Running'
+        job.worker_id = worker_id
+        job.heartbeat_at = now
+        job.lease_expires_at = now + timedelta(seconds=PROCESS_JOB_LEASE_SECONDS)
+        job.attempts += 1
+        job.started_at = job.started_at or now
+        job.save()
+    return job
+
+
+def renew_lease(job_id, worker_id):
+    """Extend the lease of a running job. Returns False if worker_id no longer owns the job."""
+    now = timezone.now()
+    return ProcessJob.objects.filter(id=job_id, worker_id=worker_id, status='Running').update(
+        heartbeat_at=now, lease_expires_at=now + timedelta(seconds=PROCESS_JOB_LEASE_SECONDS)
+    ) == 1
+
+
+def start_heartbeat(job_id, worker_id):
+    """
+    Renew the job's lease every PROCESS_JOB_HEARTBEAT_SECONDS in a daemon thread.
+
+    :return: (stop, lost) events. Set stop to end the heartbeat; lost is set when the lease was
+        lost to another worker.
+    """
+    stop = threading.Event()
+    lost = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(PROCESS_JOB_HEARTBEAT_SECONDS):
+                try:
+                    if not renew_lease(job_id, worker_id):
+                        lost.set()
+                        return
+                except Exception as e:
+                    # A transient database error; the lease still covers the next attempts
+                    save_log('start_heartbeat', 'ERROR', f"Failed to renew the lease of job {job_id}: {e}")
+                    close_old_connections()
+        finally:
+            connection.close()
+
+    threading.Thread(target=beat, daemon=True).start()
+    return stop, lost
+
+
+def prepare_resume(process_run_id):
+    """
+    FunctionExecutionStatus entries still to run for process_run_id, in process order: every
+    function from the first one that did not succeed, except those that already succeeded. Their
+    status is reset to Pending.
+    """
+    entries = list(
+        FunctionExecutionStatus.objects.filter(process_run_id=process_run_id)
+        .select_related('function')
+        .order_by('execution_order', 'id')
+    )
+    remaining = [entry for entry in entries if entry.status != 'Success']
+    FunctionExecutionStatus.objects.filter(id__in=[entry.id for entry in remaining]).update(
+        status='Pending', execution_end_date=None, duration=None
+    )
+    for entry in remaining:
+        entry.status = 'Pending'
+        entry.execution_end_date = None
+        entry.duration = None
+    return remaining
+
+
+def run_process_job(job, worker_id, execute):
+    """
+    Run a claimed job, resuming from its first function that did not succeed.
+
+    :param execute: Callable(function_status_entries, process_run_id, mis_date, should_cancel)
+        running the functions, i.e. execute_functions_in_background.
+    """
+    entries = prepare_resume(job.process_run_id)
+    if entries and job.attempts > 1:
+        save_log('run_process_job', 'INFO', f"Resuming {job.process_run_id} at {entries[0].function.function_name} ({len(entries)} functions left).")
+
+    stop, lost = start_heartbeat(job.id, worker_id)
+    error_message = None
+    try:
+        execute(
+            entries,
+            job.process_run_id,
+            job.fic_mis_date.strftime('%Y-%m-%d'),
+            lambda: lost.is_set() or is_cancel_requested(job.process_run_id),
+        )
+    except Exception as e:
+        error_message = str(e)
+        save_log('run_process_job', 'ERROR', f"Process run {job.process_run_id} stopped with an error: {e}")
+    finally:
+        stop.set()
+
+    if lost.is_set():
+        save_log('run_process_job', 'WARNING', f"Worker {worker_id} lost the lease on {job.process_run_id}; leaving it to its new owner.")
+        return
+
+    statuses = set(FunctionExecutionStatus.objects.filter(process_run_id=job.process_run_id).values_list('status', flat=True))
+    if 'Cancelled' in statuses:
+        status = 'Cancelled'
+    elif error_message or statuses & {'Failed', 'Skipped', 'Pending', 'Ongoing'}:
+        status = 'Failed'
+    else:
+        status = 'Success'
+
+    ProcessJob.objects.filter(id=job.id, worker_id=worker_id).update(
+        status=status, error_message=error_message, lease_expires_at=None, completed_at=timezone.now()
+    )
+    save_log('run_process_job', 'INFO', f"Process run {job.process_run_id} finished on {worker_id} with status {status}.")
+
+
+def run_worker(execute, worker_id=None, once=False, poll_seconds=None):
+    """
+    Claim and run queued process jobs until stopped.
+
+    :param once: Return after one job, or immediately when none is queued.
+    """
+    worker_id = worker_id or get_worker_id()
+    poll_seconds = poll_seconds or PROCESS_JOB_POLL_SECONDS
+
+    while True:
+        close_old_connections()
+        job = claim_next_job(worker_id)
+        if job is not None:
+            run_process_job(job, worker_id, execute)
+        if once:
+            return
+        if job is None:
+            time.sleep(poll_seconds)
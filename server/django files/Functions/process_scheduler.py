@@ -0,0 +1,245 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.conf import settings
+from django.db import connection
+
+# Maximum number of process functions running at the same time
+PROCESS_MAX_WORKERS = getattr(settings, 'PROCESS_MAX_WORKERS', 4)
+
+# Tables read and written by each pipeline function. Function.reads_tables / writes_tables
+# override these when set. Two functions that touch the same table, one of them writing it, keep
+# their process order; any other pair may run concurrently. Whole-table UPDATEs of the same table
+# are deliberately never overlapped, as they would contend on row locks.
+FUNCTION_TABLE_ACCESS = {
+    'perform_interpolation': {
+        'reads': ['ldn_pd_term_structure', 'ldn_pd_term_structure_dtl', 'ldn_financial_instrument', 'fsi_llfp_app_preferences'],
+        'writes': ['fsi_pd_interpolated', 'fsi_pd_account_interpolated'],
+    },
+    'run_vasicek_pit_PD_values': {
+        'reads': ['macroeconomic_projection', 'pd_sensitivity', 'pd_sensitivity_factors', 'scenario_weights'],
+        'writes': ['fsi_pd_interpolated'],
+    },
+    'provision_matrix': {
+        'reads': ['fct_stage_determination', 'dim_delinquency_band', 'dim_product_segment_group', 'historical_date_range'],
+        'writes': ['fsi_flow_rate_history', 'fsi_transition_matrix', 'fsi_cumulative_pd', 'ldn_pd_term_structure', 'ldn_pd_term_structure_dtl'],
+    },
+    'run_lgd_calculation_dpd': {
+        'reads': ['fct_stage_determination', 'dim_delinquency_band', 'dim_credit_rating_code_band', 'fsi_product_segment', 'ldn_lgd_default_band', 'historical_date_range'],
+        'writes': ['ldn_lgd_detailed', 'ldn_lgd_aggregated', 'ldn_lgd_term_structure', 'ldn_pd_term_structure'],
+    },
+    'run_frye_jacobs_pit_LGD_values': {
+        'reads': ['fsi_pd_interpolated', 'pd_sensitivity', 'scenario_weights'],
+        'writes': ['fsi_lgd_term_structure'],
+    },
+    'project_cash_flows': {
+        'reads': ['ldn_financial_instrument', 'ldn_payment_schedule'],
+        'writes': ['fsi_expected_cashflow', 'fsi_interest_method'],
+    },
+    'insert_fct_stage': {
+        'reads': ['ldn_financial_instrument'],
+        'writes': ['fct_stage_determination'],
+    },
+    'update_stage': {
+        'reads': ['fsi_creditrating_stage', 'fsi_dpd_stage_mapping', 'dim_run'],
+        'writes': ['fct_stage_determination'],
+    },
+    'process_cooling_period_for_accounts': {
+        'reads': ['cooling_period_definition'],
+        'writes': ['fct_stage_determination'],
+    },
+    'update_stage_determination': {
+        'reads': ['ldn_bank_product_info', 'ldn_customer_info', 'ldn_customer_rating_detail', 'ldn_pd_term_structure',
+                  'lgd_collateral', 'dim_delinquency_band', 'fsi_product_segment', 'dim_run'],
+        'writes': ['fct_stage_determination'],
+    },
+    'update_stage_determination_EAD_w_ACCR': {
+        'reads': [],
+        'writes': ['fct_stage_determination'],
+    },
+    'update_stage_determination_accrued_interest_and_ead': {
+        'reads': ['fsi_expected_cashflow'],
+        'writes': ['fct_stage_determination'],
+    },
+    'update_eir_using_intrest_rate': {
+        'reads': [],
+        'writes': ['fct_stage_determination'],
+    },
+    'update_eir_using_cashflows': {
+        'reads': ['fsi_expected_cashflow'],
+        'writes': ['fct_stage_determination'],
+    },
+    'update_lgd_for_stage_determination_term_structure': {
+        'reads': ['ldn_lgd_term_structure', 'fsi_lgd_term_structure', 'ldn_pd_term_structure', 'dim_run'],
+        'writes': ['fct_stage_determination'],
+    },
+    'update_lgd_for_stage_determination_term_structure_w_bands': {
+        'reads': ['ldn_lgd_term_structure', 'fsi_lgd_term_structure', 'ldn_pd_term_structure', 'dim_run'],
+        'writes': ['fct_stage_determination'],
+    },
+    'update_lgd_for_stage_determination_collateral': {
+        'reads': ['collateral_lgd', 'ldn_lgd_term_structure', 'dim_run'],
+        'writes': ['fct_stage_determination'],
+    },
+    'calculate_pd_for_accounts': {
+        'reads': ['fsi_pd_interpolated', 'ldn_pd_term_structure'],
+        'writes': ['fct_stage_determination'],
+    },
+    'insert_cash_flow_data': {
+        'reads': ['fsi_expected_cashflow', 'fct_stage_determination', 'fsi_pd_interpolated'],
+        'writes': ['fsi_financial_cash_flow_cal', 'dim_run'],
+    },
+    'update_financial_cash_flow': {
+        'reads': ['fct_stage_determination', 'dim_run'],
+        'writes': ['fsi_financial_cash_flow_cal'],
+    },
+    'calculate_discount_factors': {
+        'reads': ['fct_stage_determination', 'dim_run'],
+        'writes': ['fsi_financial_cash_flow_cal'],
+    },
+    'calculate_ead_by_buckets': {
+        'reads': ['dim_run'],
+        'writes': ['fsi_financial_cash_flow_cal'],
+    },
+    'update_cash_flow_with_pd_buckets': {
+        'reads': ['fct_stage_determination', 'fsi_pd_interpolated', 'dim_run'],
+        'writes': ['fsi_financial_cash_flow_cal'],
+    },
+    'update_marginal_pd': {
+        'reads': ['dim_run'],
+        'writes': ['fsi_financial_cash_flow_cal'],
+    },
+    'cal_lgd_and_loss_rate_for_cash_flows_using_collateral': {
+        'reads': ['fct_stage_determination', 'dim_run'],
+        'writes': ['fsi_financial_cash_flow_cal'],
+    },
+    'calculate_expected_cash_flow': {
+        'reads': ['dim_run'],
+        'writes': ['fsi_financial_cash_flow_cal'],
+    },
+    'update_stage_determination_ead_with_cashflow_pv': {
+        'reads': ['fsi_financial_cash_flow_cal', 'dim_run'],
+        'writes': ['fct_stage_determination'],
+    },
+    'calculate_forward_loss_fields': {
+        'reads': ['dim_run'],
+        'writes': ['fsi_financial_cash_flow_cal'],
+    },
+    'calculate_cashflow_fields': {
+        'reads': ['dim_run'],
+        'writes': ['fsi_financial_cash_flow_cal'],
+    },
+    'populate_fct_reporting_lines': {
+        'reads': ['fct_stage_determination', 'dim_ecl_method'],
+        'writes': ['fct_reporting_lines', 'dim_run'],
+    },
+    'calculate_ecl_based_on_method': {
+        'reads': ['fsi_financial_cash_flow_cal', 'dim_ecl_method', 'dim_run'],
+        'writes': ['fct_reporting_lines', 'fct_ecl_summary_cube'],
+    },
+    'update_reporting_lines_with_exchange_rate': {
+        'reads': ['dim_exchange_rate_conf', 'reporting_currency', 'dim_run'],
+        'writes': ['fct_reporting_lines', 'ldn_exchange_rate', 'fct_ecl_summary_cube'],
+    },
+}
+
+
+def get_table_access(function):
+    """
+    Return (reads, writes) table sets of a Function, or None when they are unknown. A function
+    with unknown access is scheduled as a barrier: it waits for every earlier function and every
+    later function waits for it.
+    """
+    reads = getattr(function, 'reads_tables', None)
+    writes = getattr(function, 'writes_tables', None)
+    if reads or writes:
+        return set(reads or []), set(writes or [])
+
+    access = FUNCTION_TABLE_ACCESS.get(function.function_name)
+    if access is None:
+        return None
+    return set(access['reads']), set(access['writes'])
+
+
+def build_dependency_graph(accesses):
+    """
+    Derive the DAG of a process from its functions' table access, in process order.
+
+    Function j depends on an earlier function i when one writes a table the other reads or writes
+    (read-after-write, write-after-read and write-after-write hazards).
+
+    :param accesses: List of (reads, writes) tuples or None, in process order.
+    :return: List of sets; entry j holds the indices function j waits for.
+    """
+    upstream = []
+    for j, access_j in enumerate(accesses):
+        depends_on = set()
+        for i in range(j):
+            access_i = accesses[i]
+            if access_i is None or access_j is None:
+                depends_on.add(i)
+                continue
+            reads_i, writes_i = access_i
+            reads_j, writes_j = access_j
+            if writes_i & (reads_j | writes_j) or writes_j & reads_i:
+                depends_on.add(i)
+        upstream.append(depends_on)
+    return upstream
+
+
+def run_dag(upstream, run_node, max_workers=None, should_cancel=None, on_skipped=None, on_cancelled=None):
+    """
+    Run the nodes of a DAG on a thread pool, each as soon as all of its upstream nodes succeeded.
+
+    A node whose upstream failed (or was skipped) is never started and is reported through
+    on_skipped, so a failure only blocks its own downstream path. Once should_cancel() returns
+    True no further node is started; the nodes not started are reported through on_cancelled.
+
+    :param upstream: Output of build_dependency_graph.
+    :param run_node: Callable(index) returning True on success. Runs in a worker thread.
+    :return: Dict of index -> 'Success', 'Failed', 'Skipped' or 'Cancelled'.
+    """
+    max_workers = max_workers or PROCESS_MAX_WORKERS
+    outcome = {}
+    running = {}
+
+    def run_in_worker(index):
+        try:
+            return bool(run_node(index))
+        finally:
+            # Worker threads open their own connection; release it for the next node
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            cancelled = bool(should_cancel and should_cancel())
+
+            # Settle nodes that can no longer run, then start the ready ones
+            for index, depends_on in enumerate(upstream):
+                if index in outcome or index in running:
+                    continue
+                if cancelled:
+                    outcome[index] = 'Cancelled'
+                    if on_cancelled:
+                        on_cancelled(index)
+                elif any(outcome.get(i) in ('Failed', 'Skipped', 'Cancelled') for i in depends_on):
+                    outcome[index] = 'Skipped'
+                    if on_skipped:
+                        on_skipped(index)
+                elif all(outcome.get(i) == 'Success' for i in depends_on):
+                    running[index] = executor.submit(run_in_worker, index)
+
+            if not running:
+                if len(outcome) == len(upstream):
+                    break
+                # Remaining nodes wait on skipped ones; settle them on the next pass
+                continue
+
+            done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+            for index, future in list(running.items()):
+                if future in done:
+                    del running[index]
+                    try:
+                        outcome[index] = 'Success' if future.result() else 'Failed'
+                    except Exception:
+                        outcome[index] = 'Failed'
+
+    return outcome
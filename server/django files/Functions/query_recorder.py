@@ -0,0 +1,20 @@
+import threading
+
+# Recorder of the function being measured on each thread; set by FunctionMetricsRecorder.
+# Kept free of package imports so low-level modules (bulk_copy, save_log) can report to it.
+_current = threading.local()
+
+
+def set_current_recorder(recorder):
+    """Make recorder (or None) the one statements of this thread are reported to."""
+    _current.recorder = recorder
+
+
+def record_query(seconds, rows=0):
+    """
+    Count a statement the execute_wrapper cannot see (e.g. COPY through copy_expert) in the
+    function being measured on this thread, if any.
+    """
+    recorder = getattr(_current, 'recorder', None)
+    if recorder is not None:
+        recorder.record_query(seconds, rows)
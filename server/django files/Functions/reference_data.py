@@ -0,0 +1,203 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from IFRS9.models import (
+    CoolingPeriodDefinition,
+    Dim_Run,
+    FSI_LLFP_APP_PREFERENCES,
+    FSI_Product_Segment,
+    IFRS9PDSensitivity,
+    Ldn_PD_Term_Structure,
+    ReferenceDataVersion,
+)
+from .save_log import save_log
+
+# Cached dimension of each reference model; a save or delete of the model invalidates it
+REFERENCE_MODELS = {
+    Ldn_PD_Term_Structure: 'pd_term_structures',
+    FSI_Product_Segment: 'product_segments',
+    IFRS9PDSensitivity: 'pd_sensitivities',
+    CoolingPeriodDefinition: 'cooling_period_definitions',
+    FSI_LLFP_APP_PREFERENCES: 'app_preferences',
+    Dim_Run: 'latest_run_skey',
+}
+
+# Context of the pipeline execution in progress in this process, shared by its worker threads
+_active = None
+
+
+def get_reference_versions():
+    """Version of every reference dimension changed at least once, as {dimension: version}."""
+    try:
+        return dict(ReferenceDataVersion.objects.values_list('v_dimension', 'n_version'))
+    except Exception as e:
+        save_log('get_reference_versions', 'ERROR', f"Unable to read the reference data versions: {e}")
+        return {}
+
+
+def _group_first(rows, key):
+    """Map key(row) -> first row with that key."""
+    mapping = {}
+    for row in rows:
+        mapping.setdefault(key(row), row)
+    return mapping
+
+
+class RunContext:
+    """
+    Reference dimensions of one pipeline execution, each loaded on first use into an in-memory
+    map and kept until it is invalidated. Safe to share between the threads of the run.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._cache = {}
+        self._versions = {}
+
+    def _get(self, name, load):
+        with self._lock:
+            if name not in self._cache:
+                self._cache[name] = load()
+            return self._cache[name]
+
+    def invalidate(self, *names):
+        """Drop the given dimensions (all of them without names); they reload on next use."""
+        with self._lock:
+            if not names:
+                self._cache.clear()
+            for name in names:
+                self._cache.pop(name, None)
+
+    def refresh(self):
+        """
+        Drop the dimensions whose version changed since the context last checked, e.g. because a
+        configuration view of the web process saved them. One query; called between functions.
+        """
+        versions = get_reference_versions()
+        with self._lock:
+            changed = [name for name in set(versions) | set(self._versions) if versions.get(name) != self._versions.get(name)]
+            self._versions = versions
+            if changed:
+                self.invalidate(*changed)
+
+    def get_pd_term_structure(self, term_structure_id):
+        """Ldn_PD_Term_Structure of a v_pd_term_structure_id, or None."""
+        structures = self._get(
+            'pd_term_structures',
+            lambda: Ldn_PD_Term_Structure.objects.in_bulk(field_name='v_pd_term_structure_id'),
+        )
+        return structures.get(str(term_structure_id))
+
+    def get_product_segment(self, segment_id):
+        """FSI_Product_Segment of a segment_id; raises FSI_Product_Segment.DoesNotExist as get() does."""
+        segments = self._get('product_segments', lambda: FSI_Product_Segment.objects.in_bulk())
+        try:
+            return segments[int(segment_id)]
+        except (KeyError, TypeError, ValueError):
+            raise FSI_Product_Segment.DoesNotExist(f"No FSI_Product_Segment with segment_id={segment_id}.")
+
+    def get_pd_sensitivity(self, term_structure):
+        """IFRS9PDSensitivity of a Ldn_PD_Term_Structure instance, or None."""
+        sensitivities = self._get(
+            'pd_sensitivities',
+            lambda: _group_first(
+                IFRS9PDSensitivity.objects.select_related('pd_term_structure').order_by('pk'),
+                lambda obj: obj.pd_term_structure,
+            ),
+        )
+        return sensitivities.get(term_structure)
+
+    def get_cooling_period_definition(self, amrt_term_unit):
+        """
+        CoolingPeriodDefinition of an amortization term unit; raises DoesNotExist or
+        MultipleObjectsReturned as get() does.
+        """
+        def load():
+            definitions = defaultdict(list)
+            for definition in CoolingPeriodDefinition.objects.all():
+                definitions[definition.v_amrt_term_unit].append(definition)
+            return dict(definitions)
+
+        definitions = self._get('cooling_period_definitions', load).get(amrt_term_unit, [])
+        if not definitions:
+            raise CoolingPeriodDefinition.DoesNotExist(f"No cooling period defined for v_amrt_term_unit={amrt_term_unit}.")
+        if len(definitions) > 1:
+            raise CoolingPeriodDefinition.MultipleObjectsReturned(f"Several cooling periods defined for v_amrt_term_unit={amrt_term_unit}.")
+        return definitions[0]
+
+    def get_app_preferences(self):
+        """The FSI_LLFP_APP_PREFERENCES row, or None."""
+        return self._get('app_preferences', lambda: FSI_LLFP_APP_PREFERENCES.objects.first())
+
+    def get_latest_run_skey(self):
+        """latest_run_skey of Dim_Run, or None without run. Errors are raised and not cached."""
+        def load():
+            run_record = Dim_Run.objects.only('latest_run_skey').first()
+            return run_record.latest_run_skey if run_record else None
+
+        return self._get('latest_run_skey', load)
+
+
+@contextmanager
+def run_context():
+    """Make a new RunContext the active one for the duration of a pipeline execution."""
+    global _active
+    previous, _active = _active, RunContext()
+    _active.refresh()  # Records the current versions
+    try:
+        yield _active
+    finally:
+        _active = previous
+
+
+def get_run_context():
+    """
+    The RunContext of the execution in progress. Outside an execution (shell, management
+    commands, shard processes) a new context is returned, so nothing is cached across calls.
+    """
+    return _active if _active is not None else RunContext()
+
+
+def get_latest_run_skey():
+    """
+    Retrieve the latest_run_skey from Dim_Run table.
+    """
+    try:
+        run_skey = get_run_context().get_latest_run_skey()
+        if run_skey is None:
+            save_log('get_latest_run_skey', 'ERROR', "No run key is available in the Dim_Run table.")
+        return run_skey
+    except Exception as e:
+        save_log('get_latest_run_skey', 'ERROR', f"Error fetching run key: {e}")
+        return None
+
+
+def invalidate_reference_data(*names):
+    """
+    Mark reference dimensions as changed: the active context of this process drops them now and
+    the contexts of other processes at their next refresh(). Errors are logged and swallowed.
+    """
+    if _active is not None:
+        _active.invalidate(*names)
+    for name in names:
+        try:
+            # A savepoint, so a failure does not break the transaction of the save being signalled
+            with transaction.atomic():
+                if not ReferenceDataVersion.objects.filter(v_dimension=name).update(n_version=F('n_version') + 1):
+                    ReferenceDataVersion.objects.get_or_create(v_dimension=name, defaults={'n_version': 1})
+        except Exception as e:
+            save_log('invalidate_reference_data', 'ERROR', f"Unable to invalidate reference data {name}: {e}")
+
+
+def _on_reference_change(sender, **kwargs):
+    invalidate_reference_data(REFERENCE_MODELS[sender])
+
+
+# Configuration views, the admin and the pipeline itself (new run keys) all save through the ORM
+for _model in REFERENCE_MODELS:
+    post_save.connect(_on_reference_change, sender=_model, dispatch_uid=f'reference_data_{_model.__name__}_save')
+    post_delete.connect(_on_reference_change, sender=_model, dispatch_uid=f'reference_data_{_model.__name__}_delete')
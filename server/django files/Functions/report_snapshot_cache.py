@@ -0,0 +1,138 @@
+import hashlib
+import os
+import shutil
+import uuid
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+from django.conf import settings
+from django.db import models
+from IFRS9.models import FCT_Reporting_Lines
+from .save_log import save_log
+
+# Directory shared by all web workers; one sub-directory per reporting date
+REPORT_SNAPSHOT_DIR = getattr(settings, 'REPORT_SNAPSHOT_DIR', os.path.join(os.getcwd(), 'report_snapshots'))
+
+# Total size of the snapshots kept on disk; least recently read snapshots are evicted first
+REPORT_SNAPSHOT_MAX_BYTES = getattr(settings, 'REPORT_SNAPSHOT_MAX_BYTES', 2 * 1024 ** 3)
+
+SNAPSHOT_SUFFIX = '.arrow'
+
+
+def get_snapshot_path(fic_mis_date, n_run_key, columns):
+    """
+    Path of the snapshot holding columns of one run of fic_mis_date. The file name is derived
+    from the key, so two requests for the same data share one file.
+    """
+    key = f"{fic_mis_date}|{n_run_key}|{','.join(sorted(columns))}"
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+    run_part = 'null' if n_run_key is None else int(n_run_key)
+    return os.path.join(REPORT_SNAPSHOT_DIR, str(fic_mis_date), f"r{run_part}_{digest}{SNAPSHOT_SUFFIX}")
+
+
+def build_reporting_lines_frame(fic_mis_date, n_run_key, columns):
+    """
+    Query columns of FCT_Reporting_Lines for one run. Decimal columns are returned as floats and
+    date columns as ISO strings, the types the report views work with.
+    """
+    rows = FCT_Reporting_Lines.objects.filter(
+        fic_mis_date=fic_mis_date, n_run_key=n_run_key
+    ).values_list(*columns)
+    df = pd.DataFrame.from_records(list(rows), columns=columns)
+
+    for column in columns:
+        field = FCT_Reporting_Lines._meta.get_field(column)
+        if isinstance(field, models.DecimalField):
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('float64')
+        elif isinstance(field, models.DateField):
+            df[column] = df[column].map(lambda value: None if value is None else value.isoformat())
+    return df
+
+
+def write_snapshot(path, df):
+    """Write df as an uncompressed Arrow IPC file; the temp file + rename keeps readers safe."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        feather.write_feather(
+            pa.Table.from_pandas(df, preserve_index=False), temp_path, compression='uncompressed'
+        )
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def evict_snapshots(max_bytes=None):
+    """
+    Delete the least recently used snapshots until the cache fits in max_bytes.
+
+    :return: Number of files deleted.
+    """
+    max_bytes = REPORT_SNAPSHOT_MAX_BYTES if max_bytes is None else max_bytes
+    snapshots = []
+    for root, _, files in os.walk(REPORT_SNAPSHOT_DIR):
+        for name in files:
+            if not name.endswith(SNAPSHOT_SUFFIX):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            snapshots.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in snapshots)
+    deleted = 0
+    for _, size, path in sorted(snapshots):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        deleted += 1
+    return deleted
+
+
+def load_reporting_lines_snapshot(fic_mis_date, n_run_key, columns):
+    """
+    Return columns of one run of FCT_Reporting_Lines as a DataFrame, read from the snapshot cache.
+
+    A missing snapshot is built from the database and written for the next request. Snapshots are
+    memory-mapped on read, and their modification time is refreshed so eviction is least recently
+    used.
+    """
+    columns = list(dict.fromkeys(columns))
+    path = get_snapshot_path(fic_mis_date, n_run_key, columns)
+
+    if os.path.exists(path):
+        try:
+            table = feather.read_table(path, columns=columns, memory_map=True)
+            os.utime(path)
+            return table.to_pandas()
+        except (OSError, pa.ArrowInvalid) as e:
+            # Evicted or invalidated between the existence check and the read; rebuild below
+            save_log('load_reporting_lines_snapshot', 'WARNING', f"Unable to read snapshot {path}: {e}")
+
+    df = build_reporting_lines_frame(fic_mis_date, n_run_key, columns)
+    try:
+        write_snapshot(path, df)
+        evict_snapshots()
+    except Exception as e:
+        save_log('load_reporting_lines_snapshot', 'ERROR', f"Unable to write snapshot {path}: {e}")
+    return df
+
+
+def invalidate_report_snapshots(fic_mis_date):
+    """
+    Drop every snapshot of fic_mis_date. Called whenever the reporting lines of the date are
+    (re)populated or updated. Errors are logged and swallowed.
+    """
+    date_dir = os.path.join(REPORT_SNAPSHOT_DIR, str(fic_mis_date))
+    try:
+        if os.path.isdir(date_dir):
+            shutil.rmtree(date_dir, ignore_errors=True)
+    except Exception as e:
+        save_log('invalidate_report_snapshots', 'ERROR', f"Unable to invalidate snapshots for fic_mis_date={fic_mis_date}: {e}")
@@ -1,14 +1,17 @@
-import math
+import numpy as np
+import pandas as pd
+from django.db import transaction
 from django.db.models import Q
 from scipy.stats import norm
 
 from IFRS9.models import (
     IFRS9ScenarioWeights,
-    IFRS9PDSensitivity,           # Correlation model
     FSI_LGD_Term_Structure,
     FSI_PD_Interpolated
 )
 from .save_log import save_log
+from .bulk_copy import update_from_rows
+from .reference_data import get_run_context
 
 ###############################################################################
 # Configuration & Helpers
@@ -48,10 +51,72 @@ def clamp_to_plus_minus_10pct(pit_value, ttc_value):
     """
     Ensures pit_value stays within ±10 percentage points of TTC LGD.
     E.g., if TTC LGD=0.40, clamp to [0.30, 0.50], also ensuring [0,1].
+    Works element-wise on arrays.
     """
-    lower_bound = max(0.0, ttc_value - 0.10)
-    upper_bound = min(1.0, ttc_value + 0.10)
-    return max(lower_bound, min(pit_value, upper_bound))
+    lower_bound = np.maximum(0.0, ttc_value - 0.10)
+    upper_bound = np.minimum(1.0, ttc_value + 0.10)
+    return np.maximum(lower_bound, np.minimum(pit_value, upper_bound))
+
+def load_12m_pd_records(term_structure_ids, codes):
+    """
+    Fetch in one query the 12-month PD rows (bucket 12 of M, 4 of Q, 2 of H, 1 of Y) of the
+    term structures, keyed by delinquency band or rating code.
+
+    :return: DataFrame with columns pd_id, v_pd_term_structure_id, v_delq_band_code,
+        v_int_rating_code and the TTC and scenario PDs, ordered by pd_id.
+    """
+    bucket_filter = Q(pk__in=[])
+    for unit in ['M', 'Q', 'H', 'Y']:
+        bucket_filter |= Q(v_cash_flow_bucket_unit=unit, v_cash_flow_bucket_id=get_12m_bucket_id(unit))
+
+    columns = ['id', 'v_pd_term_structure_id', 'v_delq_band_code', 'v_int_rating_code',
+               'n_cumulative_default_prob_base', 'n_pit_pd_base', 'n_pit_pd_best', 'n_pit_pd_worst']
+    rows = (
+        FSI_PD_Interpolated.objects
+        .filter(bucket_filter, v_pd_term_structure_id__in=term_structure_ids)
+        .filter(Q(v_delq_band_code__in=codes) | Q(v_int_rating_code__in=codes))
+        .order_by('id')
+        .values_list(*columns)
+    )
+    return pd.DataFrame.from_records(list(rows), columns=columns).rename(columns={'id': 'pd_id'})
+
+def match_12m_pd_records(lgd_df, pd_df):
+    """
+    Match every LGD record to its first 12-month PD row (lowest id) of the same term structure
+    whose delinquency band or rating code is the record's v_credit_risk_basis_cd.
+
+    :return: lgd_df restricted to the matched records, with the PD columns of pd_df.
+    """
+    lgd_keys = lgd_df[['id', 'v_pd_term_structure_id', 'v_credit_risk_basis_cd']]
+    matches = pd.concat([
+        lgd_keys.merge(pd_df, left_on=['v_pd_term_structure_id', 'v_credit_risk_basis_cd'],
+                       right_on=['v_pd_term_structure_id', code_column])
+        for code_column in ['v_delq_band_code', 'v_int_rating_code']
+    ])
+    matches = matches.sort_values('pd_id').drop_duplicates('id')
+    return lgd_df.merge(matches.drop(columns=['v_pd_term_structure_id', 'v_credit_risk_basis_cd']), on='id')
+
+def get_lgd_correlations(term_structure_ids):
+    """
+    Asset correlation of each PD term structure from IFRS9PDSensitivity, falling back to
+    DEFAULT_RHO_LGD when missing or outside (0, 1).
+    """
+    context = get_run_context()
+    rho = np.full(len(term_structure_ids), DEFAULT_RHO_LGD)
+    for i, term_id in enumerate(term_structure_ids):
+        term_structure = context.get_pd_term_structure(term_id)
+        corr_obj = context.get_pd_sensitivity(term_structure) if term_structure is not None else None
+        if corr_obj is not None:
+            rho[i] = float(corr_obj.asset_correlation or DEFAULT_RHO_LGD)
+            if rho[i] <= 0 or rho[i] >= 1:
+                save_log('apply_frye_jacobs_all_scenarios_lgd', 'WARNING',
+                         f"Invalid correlation={rho[i]} for term structure {term_id}; using default={DEFAULT_RHO_LGD}")
+                rho[i] = DEFAULT_RHO_LGD
+    return rho
+
+def to_float_array(values):
+    """Decimal/None values as floats, None as 0.0."""
+    return np.array([0.0 if pd.isna(value) else float(value or 0.0) for value in values], dtype=float)
 
 ###############################################################################
 # Main Implementation (Mimicking Excel Formula & TTC PD = 100% Shortcut)
@@ -60,7 +125,7 @@ def clamp_to_plus_minus_10pct(pit_value, ttc_value):
 def apply_frye_jacobs_all_scenarios_lgd(mis_date):
     """
     1) Loads FSI_LGD_Term_Structure for the given mis_date.
-    2) For each LGD record, finds the matching PD record in FSI_PD_Interpolated:
+    2) Matches each LGD record to its PD record in FSI_PD_Interpolated (one query for all):
        - Same v_pd_term_structure_id
        - v_credit_risk_basis_cd matches v_delq_band_code or v_int_rating_code
        - Must have the correct v_cash_flow_bucket_unit => 12-month horizon
@@ -73,157 +138,103 @@ def apply_frye_jacobs_all_scenarios_lgd(mis_date):
          k = (NORMSINV(TTC PD) - NORMSINV(TTC PD * TTC LGD)) / sqrt(1 - rho)
          PIT_LGD_scenario = NORMSDIST( NORMSINV(cDR_scenario) - k ) / cDR_scenario
     5) Clamps each PIT LGD ±10% around TTC LGD.
-    6) Computes scenario-weighted average & updates DB.
+    6) Computes scenario-weighted average & updates DB with a single temp-table UPDATE ... FROM.
+    Steps 4-6 run on arrays of all the matched records.
     """
 
-    lgd_records = list(
-        FSI_LGD_Term_Structure.objects.filter(fic_mis_date=mis_date)
+    lgd_df = pd.DataFrame.from_records(
+        list(
+            FSI_LGD_Term_Structure.objects.filter(fic_mis_date=mis_date).values_list(
+                'id', 'v_lgd_term_structure_id__v_pd_term_structure_id', 'v_credit_risk_basis_cd', 'ttc_lgd_percent'
+            )
+        ),
+        columns=['id', 'v_pd_term_structure_id', 'v_credit_risk_basis_cd', 'ttc_lgd_percent'],
     )
-    if not lgd_records:
+    if lgd_df.empty:
         save_log('apply_frye_jacobs_all_scenarios_lgd', 'INFO',
                  f"No LGD records found for MIS date={mis_date}.")
         return
 
-    scenario_weights = get_scenario_weights()
-    updated_records = []
-
-    for rec in lgd_records:
-        # Ensure we have TTC LGD
-        if rec.ttc_lgd_percent is None:
-            save_log('apply_frye_jacobs_all_scenarios_lgd', 'WARNING',
-                     f"LGD record {rec.id} missing TTC LGD. Skipping.")
-            continue
-
-        # Clamp TTC LGD to (0,1)
-        ttc_lgd = float(rec.ttc_lgd_percent)
-        ttc_lgd = min(max(ttc_lgd, 1e-6), 1 - 1e-6)
-
-        # Find matching PD record(s)
-        pd_candidates = FSI_PD_Interpolated.objects.filter(
-            v_pd_term_structure_id=rec.v_lgd_term_structure_id.v_pd_term_structure_id
-        ).filter(
-            Q(v_delq_band_code=rec.v_credit_risk_basis_cd) |
-            Q(v_int_rating_code=rec.v_credit_risk_basis_cd)
-        )
+    # Ensure we have TTC LGD
+    missing_ttc = lgd_df['ttc_lgd_percent'].isna()
+    if missing_ttc.any():
+        save_log('apply_frye_jacobs_all_scenarios_lgd', 'WARNING',
+                 f"{missing_ttc.sum()} LGD records missing TTC LGD, e.g. IDs {lgd_df.loc[missing_ttc, 'id'].tolist()[:10]}. Skipping.")
+        lgd_df = lgd_df[~missing_ttc]
 
-        matched_pd_record = None
-        for pd_rec in pd_candidates:
-            desired_id = get_12m_bucket_id(pd_rec.v_cash_flow_bucket_unit)
-            if desired_id is not None and pd_rec.v_cash_flow_bucket_id == desired_id:
-                matched_pd_record = pd_rec
-                break
-
-        if not matched_pd_record:
-            save_log('apply_frye_jacobs_all_scenarios_lgd', 'WARNING',
-                     f"No 12m PD match for LGD record {rec.id}; skipping PIT LGD.")
-            continue
-
-        # Extract TTC PD
-        pd_ttc = float(matched_pd_record.n_cumulative_default_prob_base or 0.0)
-        if pd_ttc <= 0.0:
-            save_log('apply_frye_jacobs_all_scenarios_lgd', 'WARNING',
-                     f"LGD record {rec.id}: No valid TTC PD in matched PD record; skipping.")
-            continue
-
-        # Check if TTC PD is ~100%
-        if pd_ttc >= 0.999999:
-            # If TTC PD is effectively 100%, set PIT = TTC for all scenarios
-            save_log('apply_frye_jacobs_all_scenarios_lgd', 'INFO',
-                     f"TTC PD ~100%. Setting PIT LGD = TTC LGD for LGD record {rec.id}.")
-            rec.pit_base_lgd_percent  = ttc_lgd
-            rec.pit_best_lgd_percent  = ttc_lgd
-            rec.pit_worst_lgd_percent = ttc_lgd
-            rec.n_lgd_percent         = ttc_lgd
-            updated_records.append(rec)
-            continue
-
-        # Otherwise clamp PD to avoid extremes in ppf
-        pd_ttc = min(max(pd_ttc, 1e-6), 1 - 1e-6)
-
-        # Extract scenario PD
-        cdr_base  = float(matched_pd_record.n_pit_pd_base  or 0.0)
-        cdr_best  = float(matched_pd_record.n_pit_pd_best  or 0.0)
-        cdr_worst = float(matched_pd_record.n_pit_pd_worst or 0.0)
-
-        cdr_base  = min(max(cdr_base,  1e-6), 1 - 1e-6)
-        cdr_best  = min(max(cdr_best,  1e-6), 1 - 1e-6)
-        cdr_worst = min(max(cdr_worst, 1e-6), 1 - 1e-6)
-
-        # Fetch correlation
-        try:
-            corr_obj = IFRS9PDSensitivity.objects.get(
-                pd_term_structure=rec.v_lgd_term_structure_id
-            )
-            rho = float(corr_obj.asset_correlation or DEFAULT_RHO_LGD)
-            if rho <= 0 or rho >= 1:
-                save_log('apply_frye_jacobs_all_scenarios_lgd', 'WARNING',
-                         f"Invalid correlation={rho} for term structure {rec.v_lgd_term_structure_id}; using default={DEFAULT_RHO_LGD}")
-                rho = DEFAULT_RHO_LGD
-        except IFRS9PDSensitivity.DoesNotExist:
-            rho = DEFAULT_RHO_LGD
-
-        # Calculate k (Excel-style):
-        # k = (NORMSINV(pd_ttc) - NORMSINV(pd_ttc * ttc_lgd)) / sqrt(1 - rho)
-        try:
-            pd_ttc_times_lgd = min(pd_ttc * ttc_lgd, 1 - 1e-15)
-            part1 = norm.ppf(min(pd_ttc, 1 - 1e-15))
-            part2 = norm.ppf(pd_ttc_times_lgd)
-            k_val = (part1 - part2) / math.sqrt(1 - rho)
-        except Exception as e:
-            save_log('apply_frye_jacobs_all_scenarios_lgd', 'ERROR',
-                     f"Error computing k for LGD record {rec.id}: {e}")
-            continue
-
-        # Excel formula for PIT LGD scenario:
-        # =IFERROR( NORMSDIST(NORMSINV(cDR) - k) / cDR, ttc_lgd )
-        def excel_style_pit_lgd(cdr):
-            try:
-                cdr_clamped = min(cdr, 1 - 1e-15)
-                numerator = norm.cdf(norm.ppf(cdr_clamped) - k_val)
-                pit_est = numerator / cdr_clamped if cdr_clamped > 1e-15 else ttc_lgd
-                # clamp to [0,1]
-                pit_est = min(max(pit_est, 0.0), 1.0)
-                # clamp ±10% around TTC LGD
-                return clamp_to_plus_minus_10pct(pit_est, ttc_lgd)
-            except:
-                return ttc_lgd
-
-        pit_base  = excel_style_pit_lgd(cdr_base)
-        pit_best  = excel_style_pit_lgd(cdr_best)
-        pit_worst = excel_style_pit_lgd(cdr_worst)
-
-        # Weighted average
-        w_base  = scenario_weights['BASE']
-        w_best  = scenario_weights['BEST']
-        w_worst = scenario_weights['WORST']
-        avg_pit_lgd = (pit_base  * w_base +
-                       pit_best  * w_best +
-                       pit_worst * w_worst)
-
-        # Store results
-        rec.pit_base_lgd_percent   = pit_base
-        rec.pit_best_lgd_percent   = pit_best
-        rec.pit_worst_lgd_percent  = pit_worst
-        rec.n_lgd_percent          = avg_pit_lgd
-
-        updated_records.append(rec)
+    # Find the matching 12m PD record of every LGD record
+    pd_df = load_12m_pd_records(
+        lgd_df['v_pd_term_structure_id'].unique().tolist(), lgd_df['v_credit_risk_basis_cd'].unique().tolist()
+    )
+    matched_df = match_12m_pd_records(lgd_df, pd_df)
+    unmatched = lgd_df.loc[~lgd_df['id'].isin(matched_df['id']), 'id'].tolist()
+    if unmatched:
+        save_log('apply_frye_jacobs_all_scenarios_lgd', 'WARNING',
+                 f"No 12m PD match for {len(unmatched)} LGD records, e.g. IDs {unmatched[:10]}; skipping PIT LGD.")
+
+    # Extract TTC PD
+    pd_ttc = to_float_array(matched_df['n_cumulative_default_prob_base'])
+    invalid_pd = pd_ttc <= 0.0
+    if invalid_pd.any():
+        save_log('apply_frye_jacobs_all_scenarios_lgd', 'WARNING',
+                 f"{invalid_pd.sum()} LGD records have no valid TTC PD in the matched PD record, "
+                 f"e.g. IDs {matched_df.loc[invalid_pd, 'id'].tolist()[:10]}; skipping.")
+        matched_df = matched_df[~invalid_pd].reset_index(drop=True)
+        pd_ttc = pd_ttc[~invalid_pd]
+    if matched_df.empty:
+        return
 
+    # Clamp TTC LGD to (0,1)
+    ttc_lgd = np.clip(to_float_array(matched_df['ttc_lgd_percent']), 1e-6, 1 - 1e-6)
+
+    # If TTC PD is effectively 100%, PIT = TTC for all scenarios
+    full_default = pd_ttc >= 0.999999
+    if full_default.any():
         save_log('apply_frye_jacobs_all_scenarios_lgd', 'INFO',
-                 (f"LGD record {rec.id}: PD_ttc={pd_ttc:.6f}, TTC_LGD={ttc_lgd:.4f}, "
-                  f"Corr={rho:.3f}, k={k_val:.3f}, "
-                  f"BASE_PIT={pit_base:.4f}, BEST_PIT={pit_best:.4f}, "
-                  f"WORST_PIT={pit_worst:.4f}, Weighted={avg_pit_lgd:.4f}"))
-
-    # Bulk update
-    if updated_records:
-        FSI_LGD_Term_Structure.objects.bulk_update(
-            updated_records,
-            [
-                'pit_base_lgd_percent',
-                'pit_best_lgd_percent',
-                'pit_worst_lgd_percent',
-                'n_lgd_percent'
-            ]
+                 f"TTC PD ~100% for {full_default.sum()} LGD records. Setting PIT LGD = TTC LGD.")
+
+    # Otherwise clamp PD to avoid extremes in ppf
+    pd_ttc = np.clip(pd_ttc, 1e-6, 1 - 1e-6)
+
+    # Correlation, resolved once per term structure and joined back by index
+    term_ids, term_index = np.unique(matched_df['v_pd_term_structure_id'].to_numpy(dtype=object), return_inverse=True)
+    rho = get_lgd_correlations(term_ids)[term_index]
+
+    # Calculate k (Excel-style):
+    # k = (NORMSINV(pd_ttc) - NORMSINV(pd_ttc * ttc_lgd)) / sqrt(1 - rho)
+    pd_ttc_times_lgd = np.minimum(pd_ttc * ttc_lgd, 1 - 1e-15)
+    k_val = (norm.ppf(np.minimum(pd_ttc, 1 - 1e-15)) - norm.ppf(pd_ttc_times_lgd)) / np.sqrt(1 - rho)
+
+    # Excel formula for PIT LGD scenario:
+    # =IFERROR( NORMSDIST(NORMSINV(cDR) - k) / cDR, ttc_lgd )
+    scenario_weights = get_scenario_weights()
+    pit_lgd = {}
+    avg_pit_lgd = np.zeros(len(matched_df))
+    for scenario, column in [('BASE', 'n_pit_pd_base'), ('BEST', 'n_pit_pd_best'), ('WORST', 'n_pit_pd_worst')]:
+        cdr = np.minimum(np.clip(to_float_array(matched_df[column]), 1e-6, 1 - 1e-6), 1 - 1e-15)
+        with np.errstate(all='ignore'):
+            pit_est = norm.cdf(norm.ppf(cdr) - k_val) / cdr
+        pit_est = np.where(np.isfinite(pit_est), pit_est, ttc_lgd)
+        # clamp to [0,1], then ±10% around TTC LGD
+        pit = clamp_to_plus_minus_10pct(np.clip(pit_est, 0.0, 1.0), ttc_lgd)
+        pit_lgd[scenario] = np.where(full_default, ttc_lgd, pit)
+        avg_pit_lgd += pit_lgd[scenario] * scenario_weights[scenario]
+    avg_pit_lgd = np.where(full_default, ttc_lgd, avg_pit_lgd)
+
+    save_log('apply_frye_jacobs_all_scenarios_lgd', 'INFO',
+             (f"Computed PIT LGD for {len(matched_df)} LGD records: mean TTC_LGD={ttc_lgd.mean():.4f}, "
+              f"mean BASE_PIT={pit_lgd['BASE'].mean():.4f}, mean BEST_PIT={pit_lgd['BEST'].mean():.4f}, "
+              f"mean WORST_PIT={pit_lgd['WORST'].mean():.4f}, mean Weighted={avg_pit_lgd.mean():.4f}"))
+
+    # Set-based update, rounding the floats as bulk_update did for the DecimalFields
+    with transaction.atomic():
+        update_from_rows(
+            FSI_LGD_Term_Structure._meta.db_table, 'id', 'BIGINT',
+            ['pit_base_lgd_percent', 'pit_best_lgd_percent', 'pit_worst_lgd_percent', 'n_lgd_percent'],
+            'NUMERIC',
+            zip(matched_df['id'].tolist(), pit_lgd['BASE'].tolist(), pit_lgd['BEST'].tolist(),
+                pit_lgd['WORST'].tolist(), avg_pit_lgd.tolist()),
+            significant_digits=FSI_LGD_Term_Structure._meta.get_field('n_lgd_percent').max_digits,
         )
 
 def run_frye_jacobs_pit_LGD_values(mis_date):
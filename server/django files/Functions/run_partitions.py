@@ -0,0 +1,330 @@
+from django.conf import settings
+from django.db import connection, transaction
+from .save_log import save_log
+
+# Run tables partitioned by LIST (fic_mis_date), each date sub-partitioned by LIST (run key column)
+PARTITIONED_TABLES = {
+    'fsi_financial_cash_flow_cal': 'n_run_skey',
+    'fct_reporting_lines': 'n_run_key',
+}
+
+# Number of runs kept per reporting date once a new run has been written; None keeps every run
+RUN_PARTITION_KEEP_RUNS = getattr(settings, 'RUN_PARTITION_KEEP_RUNS', None)
+
+# Detach pruned run partitions (left as standalone tables) instead of dropping them
+RUN_PARTITION_DETACH_ONLY = getattr(settings, 'RUN_PARTITION_DETACH_ONLY', False)
+
+
+def get_date_partition_name(table_name, fic_mis_date):
+    """Name of the partition of table_name holding fic_mis_date."""
+    return f"{table_name}_d{str(fic_mis_date).replace('-', '')}"
+
+
+def get_run_partition_name(table_name, fic_mis_date, run_key):
+    """Name of the sub-partition of table_name holding one run of fic_mis_date."""
+    run_suffix = 'null' if run_key is None else int(run_key)
+    return f"{get_date_partition_name(table_name, fic_mis_date)}_r{run_suffix}"
+
+
+def get_default_run_partition_name(table_name, fic_mis_date):
+    """Name of the DEFAULT sub-partition of the date partition of fic_mis_date."""
+    return f"{get_date_partition_name(table_name, fic_mis_date)}_rdefault"
+
+
+def is_partitioned(table_name):
+    """
+    Return True when table_name is a partitioned table, so the pipeline keeps working on databases
+    that have not been migrated with the partition_run_tables command.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relkind
+            FROM pg_class c
+            WHERE c.oid = to_regclass(%s);
+        """, [table_name])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def get_run_partitions(table_name, fic_mis_date):
+    """
+    Return the run partitions attached under the date partition of fic_mis_date as
+    {run_key: partition name}. Run partitions are named by get_run_partition_name; the DEFAULT
+    sub-partition is not included.
+    """
+    date_partition = get_date_partition_name(table_name, fic_mis_date)
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT child.relname
+            FROM pg_inherits i
+            JOIN pg_class child ON child.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s);
+        """, [date_partition])
+        names = [row[0] for row in cursor.fetchall()]
+
+    prefix = f"{date_partition}_r"
+    partitions = {}
+    for name in names:
+        if not name.startswith(prefix):
+            continue
+        suffix = name[len(prefix):]
+        if suffix == 'null':
+            partitions[None] = name
+        elif suffix.isdigit():
+            partitions[int(suffix)] = name
+    return partitions
+
+
+def create_run_partition(table_name, fic_mis_date, run_key):
+    """
+    Create (if missing) the date partition with its DEFAULT sub-partition, and the run
+    sub-partition that will receive the rows of one run. Does nothing when table_name is not
+    partitioned.
+
+    :return: True when the table is partitioned.
+    """
+    if not is_partitioned(table_name):
+        return False
+
+    run_column = PARTITIONED_TABLES[table_name]
+    date_partition = get_date_partition_name(table_name, fic_mis_date)
+    run_partition = get_run_partition_name(table_name, fic_mis_date, run_key)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {date_partition}
+            PARTITION OF {table_name} FOR VALUES IN (%s)
+            PARTITION BY LIST ({run_column});
+        """, [fic_mis_date])
+        # Catches the rows of a run whose sub-partition could not be created
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {get_default_run_partition_name(table_name, fic_mis_date)}
+            PARTITION OF {date_partition} DEFAULT;
+        """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {run_partition}
+            PARTITION OF {date_partition} FOR VALUES IN (%s);
+        """, [run_key])
+    return True
+
+
+def drop_run_partitions(table_name, fic_mis_date, run_keys, detach_only=False):
+    """
+    Remove whole runs of fic_mis_date by dropping (or detaching) their partitions, instead of a
+    DELETE over the run's rows.
+
+    :param detach_only: Detach the partitions and keep them as standalone tables.
+    :return: Names of the partitions removed.
+    """
+    partitions = get_run_partitions(table_name, fic_mis_date)
+    date_partition = get_date_partition_name(table_name, fic_mis_date)
+
+    removed = []
+    with connection.cursor() as cursor:
+        for run_key in run_keys:
+            partition = partitions.get(run_key)
+            if not partition:
+                continue
+            if detach_only:
+                cursor.execute(f"ALTER TABLE {date_partition} DETACH PARTITION {partition};")
+            else:
+                cursor.execute(f"DROP TABLE {partition};")
+            removed.append(partition)
+    return removed
+
+
+def prune_run_partitions(table_name, fic_mis_date, keep_runs, detach_only=False, current_run_key=None):
+    """
+    Keep only the keep_runs most recent runs of fic_mis_date in table_name.
+
+    :param current_run_key: Run being written by the pipeline; never removed, whatever its rank.
+    :return: Names of the partitions removed.
+    """
+    run_keys = sorted(
+        (run_key for run_key in get_run_partitions(table_name, fic_mis_date) if run_key is not None),
+        reverse=True,
+    )
+    stale = [run_key for run_key in run_keys[keep_runs:] if run_key != current_run_key]
+    return drop_run_partitions(table_name, fic_mis_date, stale, detach_only)
+
+
+def prepare_run_partition(table_name, fic_mis_date, run_key):
+    """
+    Pipeline hook called before a run's rows are inserted into table_name: creates the run
+    partition. Older runs are pruned by prune_old_run_partitions once the insert has committed.
+
+    Errors are logged and swallowed: the insert then lands in the DEFAULT sub-partition of the
+    date (or the table's DEFAULT partition when the date partition is missing too).
+    """
+    try:
+        with transaction.atomic():
+            create_run_partition(table_name, fic_mis_date, run_key)
+    except Exception as e:
+        save_log(
+            'prepare_run_partition',
+            'ERROR',
+            f"Error preparing partition of {table_name} for fic_mis_date={fic_mis_date}, run key {run_key}: {e}"
+        )
+
+
+def prune_old_run_partitions(table_name, fic_mis_date, run_key):
+    """
+    Pipeline hook called after a run's rows have been committed to table_name: prunes older runs
+    of the same date according to RUN_PARTITION_KEEP_RUNS. The run just written counts towards
+    the runs kept and is never removed.
+
+    Errors are logged and swallowed; the run's rows are already in place.
+    """
+    if not RUN_PARTITION_KEEP_RUNS:
+        return
+    try:
+        with transaction.atomic():
+            if not is_partitioned(table_name):
+                return
+            removed = prune_run_partitions(
+                table_name, fic_mis_date, RUN_PARTITION_KEEP_RUNS, RUN_PARTITION_DETACH_ONLY, current_run_key=run_key
+            )
+        if removed:
+            save_log(
+                'prune_old_run_partitions',
+                'INFO',
+                f"{'Detached' if RUN_PARTITION_DETACH_ONLY else 'Dropped'} {len(removed)} old run partitions "
+                f"of {table_name} for fic_mis_date={fic_mis_date}: {', '.join(removed)}."
+            )
+    except Exception as e:
+        save_log(
+            'prune_old_run_partitions',
+            'ERROR',
+            f"Error pruning run partitions of {table_name} for fic_mis_date={fic_mis_date}: {e}"
+        )
+
+
+def get_table_indexes(table_name):
+    """
+    Indexes of table_name other than its primary key, including those backing unique
+    constraints, as dicts with keys name, definition (pg_get_indexdef), is_unique, columns and
+    constraint (the constraint's name and definition, or None).
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT i.relname,
+                   pg_get_indexdef(ix.indexrelid),
+                   ix.indisunique,
+                   ARRAY(
+                       SELECT a.attname
+                       FROM unnest(ix.indkey) AS k(attnum)
+                       JOIN pg_attribute a ON a.attrelid = ix.indrelid AND a.attnum = k.attnum
+                   ),
+                   con.conname,
+                   pg_get_constraintdef(con.oid)
+            FROM pg_index ix
+            JOIN pg_class i ON i.oid = ix.indexrelid
+            LEFT JOIN pg_constraint con ON con.conindid = ix.indexrelid AND con.conrelid = ix.indrelid
+            WHERE ix.indrelid = to_regclass(%s) AND NOT ix.indisprimary;
+        """, [table_name])
+        return [
+            {
+                'name': name,
+                'definition': definition,
+                'is_unique': is_unique,
+                'columns': list(columns),
+                'constraint': (constraint_name, constraint_definition) if constraint_name else None,
+            }
+            for name, definition, is_unique, columns, constraint_name, constraint_definition in cursor.fetchall()
+        ]
+
+
+def recreate_indexes(cursor, indexes, table_name, run_column):
+    """
+    Create the indexes and unique constraints of the original table (see get_table_indexes) on the
+    partitioned table_name, under their original names; they cascade to every partition. Unique
+    keys without both partition keys cannot be enforced on a partitioned table and are created
+    as plain indexes.
+    """
+    for index in indexes:
+        enforceable = {'fic_mis_date', run_column} <= set(index['columns'])
+        if index['constraint'] and enforceable:
+            constraint_name, constraint_definition = index['constraint']
+            cursor.execute(f"ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} {constraint_definition};")
+            continue
+
+        if index['is_unique'] and not enforceable:
+            save_log(
+                'partition_table',
+                'WARNING',
+                f"Unique index {index['name']} of {table_name} does not contain fic_mis_date and {run_column}; "
+                f"recreated as a non-unique index."
+            )
+        # Keep everything from USING on: method, columns or expressions, and a partial index's WHERE
+        using = index['definition'][index['definition'].index(' USING '):]
+        unique = 'UNIQUE ' if index['is_unique'] and enforceable else ''
+        cursor.execute(f"CREATE {unique}INDEX {index['name']} ON {table_name}{using};")
+
+
+def partition_table(table_name, keep_old=False):
+    """
+    Convert table_name into a table partitioned by fic_mis_date and run key and move its data.
+
+    The existing table is renamed to {table_name}_unpartitioned, a partitioned table with the same
+    columns and defaults takes its name, one partition is created per (fic_mis_date, run key) found
+    in the data, a DEFAULT partition catches rows written by other loaders, and the rows are copied
+    across. The original unique constraints and indexes are then recreated, under their original
+    names, on the partitioned table (those of the old table get an _unpartitioned suffix). Runs in
+    a single transaction.
+
+    :param keep_old: Keep {table_name}_unpartitioned instead of dropping it.
+    :return: Number of rows moved.
+    """
+    run_column = PARTITIONED_TABLES[table_name]
+    old_table = f"{table_name}_unpartitioned"
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {table_name} RENAME TO {old_table};")
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id');", [old_table])
+        old_sequence = cursor.fetchone()[0]
+
+        # Index names are unique per schema; free the original names for the partitioned table
+        indexes = get_table_indexes(old_table)
+        for index in indexes:
+            old_name = f"{index['name'][:49]}_unpartitioned"
+            if index['constraint']:
+                cursor.execute(f"ALTER TABLE {old_table} RENAME CONSTRAINT {index['constraint'][0]} TO {old_name};")
+            else:
+                cursor.execute(f"ALTER INDEX {index['name']} RENAME TO {old_name};")
+
+        cursor.execute(f"""
+            CREATE TABLE {table_name} (
+                LIKE {old_table} INCLUDING DEFAULTS INCLUDING IDENTITY
+            ) PARTITION BY LIST (fic_mis_date);
+        """)
+        # Unique keys of a partitioned table must include the partition keys; the run key of
+        # fct_reporting_lines is nullable, so id is made unique rather than a primary key
+        cursor.execute(f"ALTER TABLE {table_name} ADD UNIQUE (id, fic_mis_date, {run_column});")
+        cursor.execute(f"CREATE TABLE {table_name}_default PARTITION OF {table_name} DEFAULT;")
+
+        # A serial id keeps using the old sequence; an identity id gets a new one to advance
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id');", [table_name])
+        new_sequence = cursor.fetchone()[0]
+        if new_sequence and new_sequence != old_sequence:
+            cursor.execute(
+                f"SELECT setval(%s, COALESCE((SELECT MAX(id) FROM {old_table}), 0) + 1, false);",
+                [new_sequence]
+            )
+        elif old_sequence:
+            cursor.execute(f"ALTER SEQUENCE {old_sequence} OWNED BY {table_name}.id;")
+
+        cursor.execute(f"SELECT DISTINCT fic_mis_date, {run_column} FROM {old_table};")
+        for fic_mis_date, run_key in cursor.fetchall():
+            create_run_partition(table_name, fic_mis_date, run_key)
+
+        cursor.execute(f"INSERT INTO {table_name} SELECT * FROM {old_table};")
+        moved_count = cursor.rowcount
+
+        # Built after the load, which is faster than maintaining them row by row
+        recreate_indexes(cursor, indexes, table_name, run_column)
+
+        if not keep_old:
+            cursor.execute(f"DROP TABLE {old_table};")
+
+    save_log('partition_table', 'INFO', f"Partitioned {table_name}: moved {moved_count} rows.")
+    return moved_count
@@ -1,8 +1,8 @@
-import math
-from bisect import bisect_right
+import numpy as np
+import pandas as pd
 from collections import defaultdict
 from scipy.stats import norm
-from django.db.models import Q
+from django.db import transaction
 from IFRS9.models import (
     FSI_PD_Interpolated, 
     MacroeconomicProjection, 
@@ -11,6 +11,7 @@ from IFRS9.models import (
     IFRS9ScenarioWeights
 )
 from .save_log import save_log
+from .bulk_copy import update_from_rows
 
 # Default Basel values for sensitivity factors and asset correlation
 DEFAULT_BETA1 = -0.300  # For Real GDP Growth
@@ -32,15 +33,11 @@ def get_scenario_weights():
         # Fallback defaults if no record exists
         return {'BASE': 0.333, 'BEST': 0.333, 'WORST': 0.333}
     
-def load_sensitivity_cache(mis_date):
+def load_sensitivity_cache(pd_term_ids):
     """
-    Pre-fetch sensitivity factors and asset correlation for all PD term structures 
-    appearing in FSI_PD_Interpolated for the given MIS date.
+    Pre-fetch sensitivity factors and asset correlation for the given PD term structures.
     Returns two dictionaries keyed by pd_term_structure id.
     """
-    records = FSI_PD_Interpolated.objects.filter(fic_mis_date=mis_date)
-    pd_term_ids = {r.v_pd_term_structure_id for r in records if r.v_pd_term_structure_id}
-    
     sensitivity_cache = {}
     correlation_cache = {}
     
@@ -77,123 +74,128 @@ def load_macro_projection_cache(mis_date, scenarios=('BASE','BEST','WORST')):
         macro_cache[scenario].sort(key=lambda x: x[0])
     return macro_cache
 
-def get_macro_for_record(macro_list, target_year):
+def get_macro_arrays(macro_list, target_years):
+    """
+    Look up the macro variables for every target year at once.
+
+    For each year the projection for that year is used, or the closest lower year; years below
+    the available range use the first projection and years above it use the last.
+
+    :return: Array of shape (len(target_years), 4) holding X1..X4, zeros if macro_list is empty.
     """
-    Given a sorted list of (projection_year, macro_dict) and a target_year,
-    return the macro_dict for the target_year if present; otherwise, return the last available macro.
+    if not macro_list:
+        return np.zeros((len(target_years), 4))
+    years = np.array([item[0] for item in macro_list])
+    values = np.array([[m['X1'], m['X2'], m['X3'], m['X4']] for _, m in macro_list])
+    idx = np.searchsorted(years, target_years, side='right')
+    return values[np.maximum(idx - 1, 0)]
+
+def get_term_structure_parameters(pd_term_ids, sensitivity_cache, correlation_cache):
     """
-    years = [item[0] for item in macro_list]
-    idx = bisect_right(years, target_year)
-    if idx == 0:
-        return macro_list[0][1]  # Use the first available if target_year is below available range.
-    elif idx >= len(years):
-        return macro_list[-1][1]  # Use the last available if target_year is above available range.
-    else:
-        # Exact match or closest lower value.
-        return macro_list[idx-1][1]
+    Resolve betas and asset correlation for each PD term structure, falling back to Basel defaults.
+    Logs one warning per term structure rather than per record.
+
+    :return: (betas, rho) arrays of shape (len(pd_term_ids), 4) and (len(pd_term_ids),).
+    """
+    betas = np.empty((len(pd_term_ids), 4))
+    rho = np.empty(len(pd_term_ids))
+    for i, term_id in enumerate(pd_term_ids):
+        sens_obj = sensitivity_cache.get(term_id)
+        if sens_obj:
+            betas[i] = [float(sens_obj.beta1), float(sens_obj.beta2), float(sens_obj.beta3), float(sens_obj.beta4)]
+        else:
+            betas[i] = [DEFAULT_BETA1, DEFAULT_BETA2, DEFAULT_BETA3, DEFAULT_BETA4]
+            save_log('apply_vasicek_adjustment_all_scenarios', 'WARNING',
+                     f"No sensitivity factors found for PD term structure {term_id}. Using default Basel values.")
+
+        corr_obj = correlation_cache.get(term_id)
+        if corr_obj:
+            rho[i] = float(corr_obj.asset_correlation) if corr_obj.asset_correlation is not None else DEFAULT_RHO
+            if rho[i] <= 0 or rho[i] >= 1:
+                save_log('apply_vasicek_adjustment_all_scenarios', 'WARNING',
+                         f"Asset correlation {rho[i]} for PD term structure {term_id} is invalid. Using default {DEFAULT_RHO}.")
+                rho[i] = DEFAULT_RHO
+        else:
+            rho[i] = DEFAULT_RHO
+            save_log('apply_vasicek_adjustment_all_scenarios', 'WARNING',
+                     f"No asset correlation found for PD term structure {term_id}. Using default {DEFAULT_RHO}.")
+    return betas, rho
 
 def apply_vasicek_adjustment_all_scenarios(mis_date):
     """
-    For each FSI_PD_Interpolated record with the given MIS date:
-      - Uses the record's projection_year to retrieve macroeconomic variables from the pre-cached macro projections.
-      - Uses cached sensitivity factors and asset correlation for each PD term structure.
+    For all FSI_PD_Interpolated records with the given MIS date, as arrays:
+      - Uses each record's projection_year to pick macroeconomic variables from the cached projections.
+      - Joins sensitivity factors and asset correlation by PD term structure through an index array.
       - Computes the PIT PD for each scenario (BASE, BEST, WORST) using the Vasicek model.
       - Stores computed PIT PDs in n_pit_pd_base, n_pit_pd_best, n_pit_pd_worst.
-      - Updates n_cumulative_default_prob to the average of these PIT PDs.
+      - Updates n_cumulative_default_prob to the weighted average of these PIT PDs.
       - Leaves n_cumulative_default_prob_base unchanged.
+    Results are written back with a single temp-table UPDATE ... FROM.
     """
-    records = list(FSI_PD_Interpolated.objects.filter(fic_mis_date=mis_date))
-    if not records:
+    rows = list(
+        FSI_PD_Interpolated.objects.filter(fic_mis_date=mis_date)
+        .values_list('id', 'v_pd_term_structure_id', 'projection_year', 'n_cumulative_default_prob_base')
+    )
+    if not rows:
         save_log('apply_vasicek_adjustment_all_scenarios', 'INFO', f"No records found for MIS date {mis_date}")
         return
-    
-    # Pre-fetch sensitivity and correlation objects
-    sensitivity_cache, correlation_cache = load_sensitivity_cache(mis_date)
+
+    invalid = [row[0] for row in rows if row[3] is None]
+    if invalid:
+        save_log('apply_vasicek_adjustment_all_scenarios', 'ERROR',
+                 f"{len(invalid)} records have invalid n_cumulative_default_prob_base, e.g. IDs {invalid[:10]}.")
+        rows = [row for row in rows if row[3] is not None]
+        if not rows:
+            return
+
+    record_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    projection_years = np.array([row[2] for row in rows], dtype=np.int64)
+    # Use original TTC PD from n_cumulative_default_prob_base
+    base_pd = np.clip(np.array([float(row[3]) for row in rows]), 1e-6, 1 - 1e-6)
+
+    # Term structure parameters are resolved once per term structure and joined back by index
+    # Ids are not sortable when some are None, so they are factorized in order of appearance
+    term_index, pd_term_ids = pd.factorize(np.array([row[1] for row in rows], dtype=object))
+    pd_term_ids = list(pd_term_ids)
+    if (term_index < 0).any():
+        # Records without a term structure get the default parameters, as in the per-record loop
+        term_index = np.where(term_index < 0, len(pd_term_ids), term_index)
+        pd_term_ids.append(None)
+    sensitivity_cache, correlation_cache = load_sensitivity_cache([term_id for term_id in pd_term_ids if term_id])
+    betas, rho = get_term_structure_parameters(pd_term_ids, sensitivity_cache, correlation_cache)
+    record_betas = betas[term_index]
+    sqrt_one_minus_rho = np.sqrt(1 - rho)[term_index]
+
     # Pre-fetch macro projections for each scenario
     macro_cache = load_macro_projection_cache(mis_date)
-    
-    updated_records = []
-    
-    for record in records:
-        # Use original TTC PD from n_cumulative_default_prob_base
-        try:
-            base_pd = float(record.n_cumulative_default_prob_base)
-        except (TypeError, ValueError):
-            save_log('apply_vasicek_adjustment_all_scenarios', 'ERROR', f"Record ID {record.id} has invalid n_cumulative_default_prob_base.")
-            continue
-        base_pd = min(max(base_pd, 1e-6), 1 - 1e-6)
-        proj_year = record.projection_year
-        
-        pit_pd_values = {}
-        for scenario in ['BASE', 'BEST', 'WORST']:
-            # Get macro projection from cache; if none available, use zeros.
-            macro_list = macro_cache.get(scenario, [])
-            if macro_list:
-                macro = get_macro_for_record(macro_list, proj_year)
-            else:
-                macro = {'X1': 0.0, 'X2': 0.0, 'X3': 0.0, 'X4': 0.0}
-            
-            X1, X2, X3, X4 = macro['X1'], macro['X2'], macro['X3'], macro['X4']
-            
-            # Retrieve sensitivity factors from cache; use default if not found.
-            sens_obj = sensitivity_cache.get(record.v_pd_term_structure_id)
-            if sens_obj:
-                beta1 = float(sens_obj.beta1)
-                beta2 = float(sens_obj.beta2)
-                beta3 = float(sens_obj.beta3)
-                beta4 = float(sens_obj.beta4)
-            else:
-                beta1, beta2, beta3, beta4 = DEFAULT_BETA1, DEFAULT_BETA2, DEFAULT_BETA3, DEFAULT_BETA4
-                save_log('apply_vasicek_adjustment_all_scenarios', 'WARNING',
-                         f"No sensitivity factors found for PD term structure {record.v_pd_term_structure_id}. Using default Basel values.")
-            
-            # Retrieve asset correlation from cache; use default if not found.
-            corr_obj = correlation_cache.get(record.v_pd_term_structure_id)
-            if corr_obj:
-                rho = float(corr_obj.asset_correlation) if corr_obj.asset_correlation is not None else DEFAULT_RHO
-                if rho <= 0 or rho >= 1:
-                    save_log('apply_vasicek_adjustment_all_scenarios', 'WARNING',
-                             f"Asset correlation {rho} for PD term structure {record.v_pd_term_structure_id} is invalid. Using default {DEFAULT_RHO}.")
-                    rho = DEFAULT_RHO
-            else:
-                rho = DEFAULT_RHO
-                save_log('apply_vasicek_adjustment_all_scenarios', 'WARNING',
-                         f"No asset correlation found for PD term structure {record.v_pd_term_structure_id}. Using default {DEFAULT_RHO}.")
-            
-            # Compute adjusted factor and PIT PD.
-            adjusted_factor = beta1 * X1 + beta2 * X2 + beta3 * X3 + beta4 * X4
-            x = norm.ppf(base_pd)
-            pit_input = (x - adjusted_factor) / math.sqrt(1 - rho)
-            pit_pd = norm.cdf(pit_input)
-            pit_pd = min(max(pit_pd, 1e-6), 1 - 1e-6)  # Ensure PD stays within a reasonable range
-            pit_pd_values[scenario] = pit_pd
-            save_log('apply_vasicek_adjustment_all_scenarios', 'INFO',
-                     f"Record ID {record.id} ({scenario}): Base PD = {base_pd}, PIT PD = {pit_pd} using adjusted factor = {adjusted_factor} "
-                     f"(betas: {beta1}, {beta2}, {beta3}, {beta4}; macro: {X1}, {X2}, {X3}, {X4}; ρ = {rho})")
-        
-        # Calculate average PIT PD from scenarios.
-        weights = get_scenario_weights()
-        avg_pit_pd =(weights['BASE'] * pit_pd_values.get('BASE', 0.0) +
-                     weights['BEST'] * pit_pd_values.get('BEST', 0.0) +
-                     weights['WORST'] * pit_pd_values.get('WORST', 0.0))
-        
-        # Update record fields.
-        record.n_pit_pd_base = pit_pd_values.get('BASE')
-        record.n_pit_pd_best = pit_pd_values.get('BEST')
-        record.n_pit_pd_worst = pit_pd_values.get('WORST')
-        record.n_cumulative_default_prob = avg_pit_pd
-        updated_records.append(record)
+    weights = get_scenario_weights()
+
+    x = norm.ppf(base_pd)
+    pit_pd_values = {}
+    avg_pit_pd = np.zeros(len(rows))
+    for scenario in ['BASE', 'BEST', 'WORST']:
+        macro = get_macro_arrays(macro_cache.get(scenario, []), projection_years)
+        adjusted_factor = (record_betas * macro).sum(axis=1)
+        pit_pd = np.clip(norm.cdf((x - adjusted_factor) / sqrt_one_minus_rho), 1e-6, 1 - 1e-6)
+        pit_pd_values[scenario] = pit_pd
+        avg_pit_pd += weights[scenario] * pit_pd
         save_log('apply_vasicek_adjustment_all_scenarios', 'INFO',
-                 f"Record ID {record.id} updated: Average PIT PD = {avg_pit_pd} stored in n_cumulative_default_prob; "
-                 f"Original TTC PD remains in n_cumulative_default_prob_base; Scenario PIT PDs: {pit_pd_values}")
-    
-    # Bulk update all changed records at once.
-    if updated_records:
-        FSI_PD_Interpolated.objects.bulk_update(
-            updated_records, 
-            ['n_pit_pd_base', 'n_pit_pd_best', 'n_pit_pd_worst', 'n_cumulative_default_prob']
+                 f"{scenario}: computed PIT PDs for {len(rows)} records, mean {pit_pd.mean():.6f} "
+                 f"(mean base PD {base_pd.mean():.6f})")
+
+    with transaction.atomic():
+        updated = update_from_rows(
+            'fsi_pd_interpolated', 'id', 'BIGINT',
+            ['n_pit_pd_base', 'n_pit_pd_best', 'n_pit_pd_worst', 'n_cumulative_default_prob'],
+            'NUMERIC',
+            zip(record_ids.tolist(), pit_pd_values['BASE'].tolist(), pit_pd_values['BEST'].tolist(),
+                pit_pd_values['WORST'].tolist(), avg_pit_pd.tolist()),
+            significant_digits=15,
         )
 
+    save_log('apply_vasicek_adjustment_all_scenarios', 'INFO',
+             f"Updated {updated} records with PIT PDs; original TTC PD remains in n_cumulative_default_prob_base.")
+
 def run_vasicek_pit_PD_values(mis_date):
     """
     Main function to run the Vasicek adjustment for a given MIS date.
@@ -1,18 +1,184 @@
+import atexit
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
 from IFRS9.models import Log
+from .bulk_copy import copy_rows
+
+# Flush the buffer once this many records are queued, or every LOG_FLUSH_INTERVAL seconds
+LOG_FLUSH_SIZE = getattr(settings, 'LOG_FLUSH_SIZE', 1000)
+LOG_FLUSH_INTERVAL = getattr(settings, 'LOG_FLUSH_INTERVAL', 2.0)
+
+# Consecutive failed flushes after which the queued records are dropped, so one bad batch cannot
+# block the buffer forever
+LOG_FLUSH_RETRIES = getattr(settings, 'LOG_FLUSH_RETRIES', 5)
+
+# Seconds flush_logs() waits for the flusher thread to write the queued records
+LOG_FLUSH_TIMEOUT = getattr(settings, 'LOG_FLUSH_TIMEOUT', 30.0)
+
+# Maximum records kept per (function, level) in each rate window; levels not listed are never limited
+LOG_RATE_LIMITS = getattr(settings, 'LOG_RATE_LIMITS', {'INFO': 100, 'WARNING': 500})
+LOG_RATE_WINDOW = getattr(settings, 'LOG_RATE_WINDOW', 60.0)
+
+# Fraction of records kept per level before rate limiting; levels not listed are always kept
+LOG_SAMPLE_RATES = getattr(settings, 'LOG_SAMPLE_RATES', {'INFO': 1.0})
+
+LOG_COLUMNS = ['timestamp', 'function_name', 'log_level', 'message', 'status']
+FUNCTION_NAME_LENGTH = Log._meta.get_field('function_name').max_length
+
+
+class LogSink:
+    """
+    Buffered, rate-limited writer for the Log table.
+
+    Records are queued in memory and written by a background thread with COPY, so callers in hot
+    loops never wait on the database and log rows are not tied to the caller's transaction.
+    Records dropped by sampling or rate limiting are counted and written as one summary row per
+    (function, level) when the rate window closes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._thread = None
+        self._pending = []
+        self._flush_requests = []
+        self._failed_flushes = 0
+        self._window_start = time.monotonic()
+        self._window_counts = defaultdict(int)
+        self._suppressed = defaultdict(int)
+
+    def _ensure_thread(self):
+        # A forked worker inherits the buffer but not the flusher thread
+        if self._pid != os.getpid():
+            self._reset()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='save_log-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(LOG_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            with self._lock:
+                requests, self._flush_requests = self._flush_requests, []
+            try:
+                self._write(close_window=any(close_window for _, close_window in requests))
+            finally:
+                for done, _ in requests:
+                    done.set()
+
+    def _close_window(self):
+        """Turn the suppressed counters into summary records and start a new rate window."""
+        elapsed = time.monotonic() - self._window_start
+        for (function_name, log_level), count in self._suppressed.items():
+            self._pending.append((
+                timezone.now(), function_name, log_level,
+                f"{count} similar {log_level} messages from {function_name} suppressed in the last {elapsed:.0f}s.",
+                'SUCCESS',
+            ))
+        self._window_start = time.monotonic()
+        self._window_counts.clear()
+        self._suppressed.clear()
+
+    def add(self, function_name, log_level, message, status):
+        function_name = function_name[:FUNCTION_NAME_LENGTH]
+        key = (function_name, log_level)
+        with self._lock:
+            self._ensure_thread()
+            if time.monotonic() - self._window_start >= LOG_RATE_WINDOW:
+                self._close_window()
+
+            sample_rate = LOG_SAMPLE_RATES.get(log_level, 1.0)
+            rate_limit = LOG_RATE_LIMITS.get(log_level)
+            if (sample_rate < 1.0 and random.random() >= sample_rate) or \
+                    (rate_limit is not None and self._window_counts[key] >= rate_limit):
+                self._suppressed[key] += 1
+                return
+
+            self._window_counts[key] += 1
+            self._pending.append((timezone.now(), function_name, log_level, message, status))
+            if len(self._pending) >= LOG_FLUSH_SIZE:
+                self._wakeup.set()
+
+    def flush(self, close_window=True):
+        """
+        Write all queued records and wait until they are written (at most LOG_FLUSH_TIMEOUT
+        seconds). close_window also writes the pending suppression summaries.
+
+        The write is handed to the flusher thread, so it always runs on the flusher's own
+        connection: log rows never join, or abort, the caller's transaction.
+        """
+        if threading.current_thread() is self._thread:
+            self._write(close_window)
+            return
+        done = threading.Event()
+        with self._lock:
+            if not self._pending and not (close_window and self._suppressed):
+                return
+            self._ensure_thread()
+            self._flush_requests.append((done, close_window))
+        self._wakeup.set()
+        done.wait(LOG_FLUSH_TIMEOUT)
+
+    def _write(self, close_window):
+        """
+        Write the queued records with COPY; flusher thread only. A batch that cannot be written is
+        queued again ahead of newer records and retried by the next flush, up to
+        LOG_FLUSH_RETRIES consecutive failures.
+        """
+        with self._lock:
+            if close_window and self._suppressed:
+                self._close_window()
+            records, self._pending = self._pending, []
+
+        if not records:
+            return
+        try:
+            copy_rows(connection.ops.quote_name(Log._meta.db_table), LOG_COLUMNS, records)
+            print(f"Logs saved: {len(records)} records")
+        except Exception as e:
+            with self._lock:
+                self._failed_flushes += 1
+                if self._failed_flushes < LOG_FLUSH_RETRIES:
+                    self._pending = records + self._pending
+                    print(f"Failed to save {len(records)} logs, retrying with the next flush: {e}")
+                else:
+                    self._failed_flushes = 0
+                    print(f"Failed to save {len(records)} logs after {LOG_FLUSH_RETRIES} attempts; dropped: {e}")
+            # Discard the flusher's broken connection so the next flush reconnects
+            close_old_connections()
+        else:
+            self._failed_flushes = 0
+
+log_sink = LogSink()
+atexit.register(log_sink.flush)
+
 
 def save_log(function_name, log_level, message, status='SUCCESS'):
     """
     Function to save logs to the Log table.
 
+    Records are buffered and written in batches; call flush_logs() when they must be visible
+    immediately (for example at the end of a pipeline step).
     """
     try:
-        log_entry = Log(
-            function_name=function_name,
-            log_level=log_level,
-            message=message,
-            status=status
-        )
-        log_entry.save()
-        print(f"Log saved: {function_name} - {log_level} - {status}")
+        log_sink.add(function_name, log_level, message, status)
     except Exception as e:
         print(f"Failed to save log: {e}")
+
+
+def flush_logs():
+    """
+    Write every buffered log record, including suppression summaries, to the Log table.
+    """
+    log_sink.flush()
@@ -0,0 +1,155 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.conf import settings
+from django.db import connection, transaction
+from .save_log import save_log, flush_logs
+from .populate_cashflows import get_next_run_skey
+from .run_partitions import prepare_run_partition, prune_old_run_partitions
+from .pd_cumulative_term_str import get_buckets_for_12_months
+from .fused_cash_flow_chain import DEFAULT_FUSED_STEPS, FUSED_CASH_FLOW_STEPS, build_fused_cash_flow_sql
+from .calculate_ecl import ECL_METHODS, get_ecl_method, get_latest_run_skey, update_ecl_for_method
+from .ecl_summary_cube import refresh_ecl_summary_cube_safely
+from .report_snapshot_cache import invalidate_report_snapshots
+
+# Number of account-hash shards, each computed by its own process and database connection
+CASH_FLOW_SHARD_COUNT = getattr(settings, 'CASH_FLOW_SHARD_COUNT', 4)
+
+
+def run_in_shards(target, args, shard_count):
+    """
+    Call target(*args, (shard, shard_count)) for every shard, each in its own process.
+
+    Processes are spawned rather than forked so they never share the parent's database sockets;
+    each one sets Django up and opens its own connection.
+
+    :return: List of the shards' results, in shard order. The first shard error is re-raised.
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=shard_count, mp_context=context, initializer=django.setup) as executor:
+        futures = [executor.submit(target, *args, (shard, shard_count)) for shard in range(shard_count)]
+        return [future.result() for future in futures]
+
+
+def insert_cash_flow_shard(fic_mis_date, run_skey, steps, shard):
+    """Shard process: insert the shard's rows of the run with every step in steps applied."""
+    try:
+        sql, parameters = build_fused_cash_flow_sql(steps, shard_count=shard[1])
+        values = {
+            'run_skey': run_skey,
+            'fic_mis_date': fic_mis_date,
+            'months_to_12m': get_buckets_for_12_months('M'),
+            'shard': shard[0],
+        }
+        with connection.cursor() as cursor, transaction.atomic():
+            cursor.execute(sql, [values[name] for name in parameters])
+            return cursor.rowcount
+    except Exception as e:
+        # Database exceptions do not always survive pickling back to the parent
+        raise RuntimeError(f"Shard {shard[0]}/{shard[1]}: {e}")
+    finally:
+        flush_logs()
+        connection.close()
+
+
+def insert_cash_flow_data_sharded(fic_mis_date, steps=None, shard_count=None):
+    """
+    Sharded version of insert_cash_flow_data_fused: the run's accounts are split into shard_count
+    hash shards and each shard inserts its rows, with the final values of the calculation chain,
+    in its own process. The rows are the same as a single-process run's.
+
+    Shards commit separately, so the run's rows are deleted again if any shard fails.
+
+    :param steps: Steps to fold, in execution order (default DEFAULT_FUSED_STEPS).
+    :param shard_count: Number of shards (default CASH_FLOW_SHARD_COUNT).
+    :return: '1' on success, '0' on failure.
+    """
+    steps = DEFAULT_FUSED_STEPS if steps is None else steps
+    shard_count = shard_count or CASH_FLOW_SHARD_COUNT
+    unknown = [step for step in steps if step not in FUSED_CASH_FLOW_STEPS]
+    if unknown:
+        save_log('insert_cash_flow_data_sharded', 'ERROR', f"Steps cannot be fused: {', '.join(unknown)}.")
+        return '0'
+
+    next_run_skey = get_next_run_skey()
+    if not next_run_skey:
+        return '0'
+
+    try:
+        prepare_run_partition('fsi_financial_cash_flow_cal', fic_mis_date, next_run_skey)
+        inserted_counts = run_in_shards(insert_cash_flow_shard, (fic_mis_date, next_run_skey, list(steps)), shard_count)
+
+    except Exception as e:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM fsi_financial_cash_flow_cal WHERE fic_mis_date = %s AND n_run_skey = %s;",
+                [fic_mis_date, next_run_skey]
+            )
+        save_log('insert_cash_flow_data_sharded', 'ERROR', f"Error during sharded cash flow insertion: {e}")
+        return '0'
+
+    save_log(
+        'insert_cash_flow_data_sharded',
+        'INFO',
+        f"Inserted {sum(inserted_counts)} records for fic_mis_date {fic_mis_date} with run key {next_run_skey} "
+        f"in {shard_count} shards ({', '.join(str(count) for count in inserted_counts)}), "
+        f"fused steps: {', '.join(steps) or 'none'}."
+    )
+    prune_old_run_partitions('fsi_financial_cash_flow_cal', fic_mis_date, next_run_skey)
+    return '1'
+
+
+def calculate_ecl_shard(method_name, n_run_key, fic_mis_date, uses_discounting, shard):
+    """Shard process: update the ECL of the shard's reporting lines."""
+    try:
+        return update_ecl_for_method(method_name, n_run_key, fic_mis_date, uses_discounting, shard)
+    finally:
+        flush_logs()
+        connection.close()
+
+
+def calculate_ecl_based_on_method_sharded(fic_mis_date, shard_count=None):
+    """
+    Sharded version of calculate_ecl_based_on_method: each account shard updates the ECL of its
+    reporting lines in its own process, then the reporting-level aggregates (the ECL summary cube
+    and the report snapshots) are rebuilt once for the whole run.
+
+    :return: '1' on success, '0' on failure.
+    """
+    shard_count = shard_count or CASH_FLOW_SHARD_COUNT
+    try:
+        n_run_key = get_latest_run_skey()
+        if not n_run_key:
+            return '0'
+
+        result = get_ecl_method()
+        if not result:
+            save_log('calculate_ecl_based_on_method_sharded', 'ERROR', "No ECL method is defined in the dim_ecl_method table.")
+            return '0'
+
+        method_name, uses_discounting = result
+        if method_name not in ECL_METHODS:
+            save_log('calculate_ecl_based_on_method_sharded', 'ERROR', f"Unknown ECL method: {method_name}")
+            return '0'
+
+        # Each shard's update is idempotent, so a failed run can simply be executed again
+        shard_results = run_in_shards(calculate_ecl_shard, (method_name, n_run_key, fic_mis_date, uses_discounting), shard_count)
+        failed = [str(shard) for shard, succeeded in enumerate(shard_results) if not succeeded]
+        if failed:
+            save_log('calculate_ecl_based_on_method_sharded', 'ERROR', f"ECL calculation failed in shards {', '.join(failed)} of {shard_count}.")
+            return '0'
+
+        # Merge: reporting-level aggregation over every shard
+        refresh_ecl_summary_cube_safely(fic_mis_date, n_run_key)
+        invalidate_report_snapshots(fic_mis_date)
+
+        save_log(
+            'calculate_ecl_based_on_method_sharded',
+            'INFO',
+            f"ECL calculated with method {method_name} for run key {n_run_key} in {shard_count} shards."
+        )
+        return '1'
+
+    except Exception as e:
+        save_log('calculate_ecl_based_on_method_sharded', 'ERROR', f"Error calculating ECL: {e}")
+        return '0'
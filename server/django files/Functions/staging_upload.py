@@ -0,0 +1,255 @@
+import os
+import uuid
+import pandas as pd
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.utils import timezone
+from openpyxl import load_workbook
+from .bulk_copy import copy_rows
+from .data_quality_rules import run_data_quality_rules_after_upload
+from .save_log import save_log
+
+# Uploaded files are kept here between the wizard steps instead of in the session
+UPLOAD_DIR = getattr(settings, 'UPLOAD_DIR', os.path.join(os.getcwd(), 'uploads'))
+
+# Rows read, cleaned and COPYed per chunk
+UPLOAD_CHUNK_SIZE = getattr(settings, 'UPLOAD_CHUNK_SIZE', 50000)
+
+# Seconds an upload's progress stays readable after its last update
+UPLOAD_PROGRESS_TIMEOUT = getattr(settings, 'UPLOAD_PROGRESS_TIMEOUT', 3600)
+
+NUMERIC_FIELDS = (models.DecimalField, models.FloatField, models.IntegerField, models.BigIntegerField,
+                  models.SmallIntegerField, models.PositiveIntegerField, models.PositiveSmallIntegerField)
+
+
+def save_upload(file):
+    """Write an uploaded file to UPLOAD_DIR and return its path."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}_{os.path.basename(file.name)}")
+    with open(path, 'wb') as destination:
+        for chunk in file.chunks():
+            destination.write(chunk)
+    return path
+
+
+def set_upload_progress(upload_key, percent):
+    """
+    Publish the progress of an upload in the cache. The load runs in one transaction, so progress
+    written through the database (e.g. the session) would stay invisible to other requests.
+    """
+    cache.set(f"upload_progress_{upload_key}", percent, UPLOAD_PROGRESS_TIMEOUT)
+
+
+def get_upload_progress(upload_key):
+    """Last progress published by set_upload_progress, 0 when none."""
+    return cache.get(f"upload_progress_{upload_key}", 0)
+
+
+def is_excel(path):
+    return path.lower().endswith(('.xls', '.xlsx'))
+
+
+def read_upload_preview(path, nrows=10):
+    """Header and first nrows rows of an uploaded file, every value read as text."""
+    if is_excel(path):
+        return pd.read_excel(path, nrows=nrows, dtype=str)
+    return pd.read_csv(path, nrows=nrows, dtype=str)
+
+
+def iter_upload_chunks(path, columns, chunk_size=None):
+    """
+    Yield DataFrames of chunk_size rows holding columns of an uploaded file.
+
+    Every value is read as text so codes keep their leading zeros; convert_chunk then applies
+    the types of the target model's fields. Excel files are streamed with a read-only workbook.
+    """
+    chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+    if not is_excel(path):
+        yield from pd.read_csv(path, usecols=columns, dtype=str, chunksize=chunk_size)
+        return
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        headers = [None if header is None else str(header) for header in next(rows, [])]
+        positions = [headers.index(column) for column in columns]
+
+        buffer = []
+        for row in rows:
+            buffer.append([row[position] if position < len(row) else None for position in positions])
+            if len(buffer) >= chunk_size:
+                yield pd.DataFrame(buffer, columns=columns, dtype=object)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns, dtype=object)
+    finally:
+        workbook.close()
+
+
+def count_upload_rows(path):
+    """Number of data rows in an uploaded file, counted without parsing it."""
+    if is_excel(path):
+        workbook = load_workbook(path, read_only=True)
+        try:
+            return max((workbook.active.max_row or 1) - 1, 0)
+        finally:
+            workbook.close()
+
+    lines = 0
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            lines += block.count(b'\n')
+    return max(lines - 1, 0)
+
+
+def clean_chunk(df):
+    """
+    Vectorised cleaning of text columns: trim, collapse inner whitespace and upper-case; then drop
+    empty and duplicate rows.
+    """
+    for column in df.columns:
+        if df[column].dtype == object or pd.api.types.is_string_dtype(df[column].dtype):
+            text = df[column].where(df[column].isna(), df[column].astype(str))
+            text = text.str.strip().str.replace(r'\s+', ' ', regex=True).str.upper()
+            df[column] = text.mask(text == '')
+
+    df = df.dropna(how='all')
+    return df.drop_duplicates()
+
+
+def convert_chunk(df, model_class):
+    """
+    Convert the columns of df to the types of the matching model fields. Values that cannot be
+    parsed become NULL, as the previous loader did for dates.
+    """
+    for column in df.columns:
+        field = model_class._meta.get_field(column)
+        if isinstance(field, models.DateTimeField):
+            df[column] = pd.to_datetime(df[column], errors='coerce').map(
+                lambda value: None if pd.isna(value) else value.isoformat()
+            )
+        elif isinstance(field, models.DateField):
+            df[column] = pd.to_datetime(df[column], errors='coerce').dt.strftime('%Y-%m-%d')
+        elif isinstance(field, NUMERIC_FIELDS):
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+        elif isinstance(field, models.BooleanField):
+            df[column] = df[column].map(
+                lambda value: None if pd.isna(value) else str(value).upper() in ('TRUE', 'T', 'Y', 'YES', '1')
+            )
+    return df.astype(object).where(df.notna(), None)
+
+
+def get_conflict_columns(model_class, columns):
+    """
+    First unique key of model_class whose columns are all loaded, used as the ON CONFLICT target
+    of the merge; None when the upload does not cover any unique key.
+    """
+    unique_keys = [list(fields) for fields in model_class._meta.unique_together]
+    unique_keys += [
+        list(constraint.fields) for constraint in model_class._meta.constraints
+        if isinstance(constraint, models.UniqueConstraint) and constraint.fields and constraint.condition is None
+    ]
+    unique_keys += [[field.name] for field in model_class._meta.fields if field.unique and not field.primary_key]
+
+    for key in unique_keys:
+        if all(name in columns for name in key):
+            return [model_class._meta.get_field(name).column for name in key]
+    return None
+
+
+def load_upload_to_table(path, model_class, source_columns, mappings, progress=None):
+    """
+    Load an uploaded file into model_class's table with COPY.
+
+    Each chunk is read, cleaned and typed, then COPYed into a temp table created with the target's
+    column types. One INSERT ... SELECT then merges the temp table into the target: rows whose
+    unique key already exists are updated (ON CONFLICT DO UPDATE) when the upload covers a unique
+    key. Runs in a single transaction; the data quality rules affected by the table are then
+    re-evaluated.
+
+    :param source_columns: File columns to load.
+    :param mappings: {file column: model field name}.
+    :param progress: Optional callable receiving (rows_loaded, percent) after each chunk. It is
+                     called inside the transaction, so it must publish outside the database
+                     connection, e.g. with set_upload_progress.
+    :return: Number of rows inserted or updated in the target table.
+    """
+    field_names = [mappings[column] for column in source_columns]
+
+    # Model defaults bulk_create used to apply to fields the upload does not provide
+    default_fields = [
+        field for field in model_class._meta.concrete_fields
+        if field.name not in field_names and not field.primary_key
+        and (field.has_default() or getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False))
+    ]
+    db_columns = [model_class._meta.get_field(name).column for name in field_names]
+    db_columns += [field.column for field in default_fields]
+    column_list = ', '.join(connection.ops.quote_name(column) for column in db_columns)
+    target_table = connection.ops.quote_name(model_class._meta.db_table)
+    temp_table = 'tmp_upload_stage'
+
+    total_rows = max(count_upload_rows(path), 1) if progress else 1
+    rows_read = 0
+    loaded = 0
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {temp_table}")
+            cursor.execute(
+                f"CREATE TEMP TABLE {temp_table} ON COMMIT DROP AS "
+                f"SELECT {column_list} FROM {target_table} WITH NO DATA"
+            )
+
+        for chunk in iter_upload_chunks(path, source_columns):
+            rows_read += len(chunk)
+            chunk = chunk[source_columns].rename(columns=mappings)
+            chunk = convert_chunk(clean_chunk(chunk), model_class)
+            for field in default_fields:
+                chunk[field.name] = timezone.now() if not field.has_default() else field.get_default()
+            loaded += copy_rows(temp_table, db_columns, chunk.itertuples(index=False, name=None))
+
+            if progress:
+                # The merge accounts for the last 10%
+                progress(loaded, min(90, int(rows_read * 90 / total_rows)))
+
+        conflict_columns = get_conflict_columns(model_class, field_names)
+        with connection.cursor() as cursor:
+            if conflict_columns:
+                conflict_list = ', '.join(connection.ops.quote_name(column) for column in conflict_columns)
+                update_columns = [column for column in db_columns[:len(field_names)] if column not in conflict_columns]
+                on_conflict = (
+                    "DO UPDATE SET " + ', '.join(
+                        f"{connection.ops.quote_name(column)} = EXCLUDED.{connection.ops.quote_name(column)}"
+                        for column in update_columns
+                    )
+                    if update_columns else "DO NOTHING"
+                )
+                cursor.execute(f"""
+                    INSERT INTO {target_table} ({column_list})
+                    SELECT DISTINCT ON ({conflict_list}) {column_list} FROM {temp_table}
+                    ON CONFLICT ({conflict_list}) {on_conflict};
+                """)
+            else:
+                cursor.execute(f"""
+                    INSERT INTO {target_table} ({column_list})
+                    SELECT DISTINCT {column_list} FROM {temp_table};
+                """)
+            merged = cursor.rowcount
+
+            uploaded_dates = []
+            if 'fic_mis_date' in db_columns:
+                cursor.execute(f"SELECT DISTINCT fic_mis_date FROM {temp_table} WHERE fic_mis_date IS NOT NULL;")
+                uploaded_dates = [row[0] for row in cursor.fetchall()]
+
+    # Re-evaluate the data quality rules that read the loaded table
+    run_data_quality_rules_after_upload(model_class._meta.model_name, uploaded_dates)
+
+    if progress:
+        progress(loaded, 100)
+    save_log(
+        'load_upload_to_table',
+        'INFO',
+        f"Loaded {loaded} rows from {os.path.basename(path)} into {model_class._meta.db_table}; {merged} rows merged."
+    )
+    return merged
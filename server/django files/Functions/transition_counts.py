@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+
+EPSILON = 1e-6  # Small value to avoid division by zero
+
+
+def count_code_transitions(from_codes, to_codes, code_order):
+    """
+    Count the moves from_codes[k] -> to_codes[k] of a list of transitions in one bincount.
+
+    :param code_order: Codes in matrix order.
+    :return: int64 array (codes, codes); [i, j] = transitions from code i to code j.
+    :raise KeyError: When a code is not in code_order.
+    """
+    code_index = pd.Index(code_order)
+    from_index = code_index.get_indexer(from_codes)
+    to_index = code_index.get_indexer(to_codes)
+    unknown = (from_index < 0) | (to_index < 0)
+    if unknown.any():
+        codes = set(np.asarray(from_codes, dtype=object)[from_index < 0]) | set(np.asarray(to_codes, dtype=object)[to_index < 0])
+        raise KeyError(f"Codes not in code_order: {sorted(map(str, codes))}")
+
+    code_count = len(code_order)
+    return np.bincount(from_index * code_count + to_index, minlength=code_count * code_count).reshape(code_count, code_count)
+
+
+def count_transitions(observations, code_column, code_order, group_column='v_combined_group',
+                      account_column='n_account_number', period_column='period'):
+    """
+    Count the transitions between codes (delinquency bands, ratings) of every group, for every
+    pair of consecutive periods observed in the group, in one pass.
+
+    The observations are joined to themselves on (group, account, next period), so only accounts
+    present in both periods are counted. An account observed with several codes in a period counts
+    once per code, as with the per-period account sets this replaces.
+
+    :param observations: DataFrame with group_column, account_column, period_column and code_column.
+    :param code_order: Codes (lowercase) in matrix order; other codes are not counted.
+    :return: (pairs, counts, totals):
+        pairs: DataFrame of group_column, previous_period and current_period, one row per pair,
+            sorted by group then period.
+        counts: array (pairs, codes, codes); counts[p, i, j] = accounts moving from code i to code j.
+        totals: array (pairs, codes); totals[p, i] = accounts with code i in the previous period
+            that are still observed in the current period.
+    """
+    obs = observations[[group_column, account_column, period_column, code_column]].dropna(subset=[period_column])
+    obs = obs.assign(**{code_column: obs[code_column].str.lower()}).drop_duplicates()
+
+    # Rank of each period among the periods observed in its group
+    periods = obs[[group_column, period_column]].drop_duplicates().sort_values([group_column, period_column])
+    periods['rank'] = periods.groupby(group_column).cumcount()
+    obs = obs.merge(periods, on=[group_column, period_column])
+
+    # A pair is keyed by its group and the rank of its previous period
+    pairs = periods.rename(columns={period_column: 'previous_period'})
+    pairs['current_period'] = pairs.groupby(group_column)['previous_period'].shift(-1)
+    pairs = pairs.dropna(subset=['current_period']).reset_index(drop=True)
+    pairs['pair'] = np.arange(len(pairs))
+
+    code_count = len(code_order)
+    counts = np.zeros((len(pairs), code_count, code_count), dtype=np.int64)
+    totals = np.zeros((len(pairs), code_count), dtype=np.int64)
+    if pairs.empty:
+        return pairs[[group_column, 'previous_period', 'current_period']], counts, totals
+
+    moves = obs.merge(
+        obs.assign(rank=obs['rank'] - 1),
+        on=[group_column, account_column, 'rank'],
+        suffixes=('_from', '_to'),
+    ).merge(pairs[[group_column, 'rank', 'pair']], on=[group_column, 'rank'])
+
+    code_index = {code: index for index, code in enumerate(code_order)}
+    from_index = moves[f'{code_column}_from'].map(code_index).fillna(-1).to_numpy(dtype=np.int64)
+    to_index = moves[f'{code_column}_to'].map(code_index).fillna(-1).to_numpy(dtype=np.int64)
+    pair_index = moves['pair'].to_numpy(dtype=np.int64)
+
+    moved = (from_index >= 0) & (to_index >= 0)
+    np.add.at(counts, (pair_index[moved], from_index[moved], to_index[moved]), 1)
+
+    # Each account counts once in its previous code, whatever its codes in the current period
+    starts = pd.DataFrame({'pair': pair_index, 'account': moves[account_column].to_numpy(), 'code': from_index})
+    starts = starts[starts['code'] >= 0].drop_duplicates()
+    np.add.at(totals, (starts['pair'].to_numpy(), starts['code'].to_numpy()), 1)
+
+    return pairs[[group_column, 'previous_period', 'current_period']], counts, totals
+
+
+def adjacent_flow_rates(observations, code_column, code_order, from_column, to_column, **columns):
+    """
+    Flow rates from each code to the next one in code_order, for every group and pair of
+    consecutive periods (see count_transitions and adjacent_flow_rates_from_counts).
+
+    :param columns: group_column, account_column or period_column, as for count_transitions.
+    """
+    pairs, counts, totals = count_transitions(observations, code_column, code_order, **columns)
+    return adjacent_flow_rates_from_counts(
+        pairs, counts, totals, code_order, from_column, to_column, columns.get('group_column', 'v_combined_group')
+    )
+
+
+def adjacent_flow_rates_from_counts(pairs, counts, totals, code_order, from_column, to_column, group_column='v_combined_group'):
+    """
+    Flow rates from each code to the next one in code_order, derived from the count matrices
+    returned by count_transitions (or stored by transition_history).
+
+    :param from_column: Output column of the code moved from.
+    :param to_column: Output column of the code moved to.
+    :return: DataFrame with columns v_combined_group (the group column), previous_period,
+        current_period, from_column, to_column, n_prev_period_accounts, n_next_period_accounts
+        and transition_prob = n_next_period_accounts / (n_prev_period_accounts + EPSILON), or 0
+        without previous accounts. Rows are in pair order, then code order.
+    """
+    steps = max(len(code_order) - 1, 0)
+    index = np.arange(steps)
+    n_next = counts[:, index, index + 1]
+    n_prev = totals[:, index]
+    transition_prob = np.where(n_prev > 0, n_next / (n_prev + EPSILON), 0.0)
+
+    return pd.DataFrame({
+        group_column: np.repeat(pairs[group_column].to_numpy(), steps),
+        'previous_period': np.repeat(pairs['previous_period'].to_numpy(), steps),
+        'current_period': np.repeat(pairs['current_period'].to_numpy(), steps),
+        from_column: np.tile(np.asarray(code_order[:-1], dtype=object), len(pairs)),
+        to_column: np.tile(np.asarray(code_order[1:], dtype=object), len(pairs)),
+        'n_prev_period_accounts': n_prev.ravel(),
+        'n_next_period_accounts': n_next.ravel(),
+        'transition_prob': transition_prob.ravel(),
+    })
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from IFRS9.models import FCT_Stage_Determination, FSITransitionCount
+from .save_log import save_log
+from .transition_counts import count_transitions
+
+# Count only the period pairs whose stage data is new or changed; False recounts the whole history window on every run
+TRANSITION_HISTORY_INCREMENTAL = getattr(settings, 'TRANSITION_HISTORY_INCREMENTAL', True)
+
+
+def get_partition_fingerprints(code_column, segments, start_date, end_date):
+    """
+    Row count and order-independent checksum of the (account, code) rows of every monthly
+    partition (segment, month) of FCT_Stage_Determination between start_date and end_date,
+    aggregated in the database without loading the rows.
+
+    :return: DataFrame with columns n_segment_skey, period (monthly Period), n_rows, n_checksum.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT n_segment_skey,
+                   date_trunc('month', fic_mis_date)::date,
+                   COUNT(*),
+                   SUM(hashtext(COALESCE(n_account_number, '') || '|' || COALESCE(lower({code_column}), ''))::bigint)
+            FROM {FCT_Stage_Determination._meta.db_table}
+            WHERE n_segment_skey = ANY(%s) AND fic_mis_date BETWEEN %s AND %s
+            GROUP BY 1, 2;
+        """, [list(segments), start_date, end_date])
+        rows = cursor.fetchall()
+
+    df = pd.DataFrame(rows, columns=['n_segment_skey', 'period', 'n_rows', 'n_checksum'])
+    df['period'] = pd.to_datetime(df['period']).dt.to_period('M')
+    return df
+
+
+def plan_transition_pairs(partitions_df, code_order):
+    """
+    Consecutive observed periods of every group of partitions_df (which needs a v_combined_group
+    column), each with a fingerprint of the partitions of both periods and of code_order.
+
+    :return: DataFrame with columns v_combined_group, previous_period, current_period and
+        fingerprint, sorted by group then period.
+    """
+    records = []
+    for group, group_df in partitions_df.groupby('v_combined_group'):
+        digests = {
+            period: sorted(str(partition) for partition in zip(df['n_segment_skey'], df['n_rows'], df['n_checksum']))
+            for period, df in group_df.groupby('period')
+        }
+        periods = sorted(digests)
+        for previous_period, current_period in zip(periods, periods[1:]):
+            payload = json.dumps([
+                list(code_order), str(previous_period), str(current_period),
+                digests[previous_period], digests[current_period]
+            ])
+            records.append({
+                'v_combined_group': group,
+                'previous_period': previous_period,
+                'current_period': current_period,
+                'fingerprint': hashlib.sha256(payload.encode()).hexdigest(),
+            })
+    return pd.DataFrame(records, columns=['v_combined_group', 'previous_period', 'current_period', 'fingerprint'])
+
+
+def get_stale_pairs(basis, planned_df, full_rebuild=False):
+    """
+    Split the planned pairs against the counts stored for basis ('D' or 'R').
+
+    :return: (stale_df, obsolete):
+        stale_df: planned pairs not stored yet or stored with another fingerprint (restated
+            months, changed codes); all of them with full_rebuild.
+        obsolete: (group, current period) of stored pairs of the planned window that are no
+            longer planned, e.g. because the stage data of a month was removed.
+    """
+    if planned_df.empty:
+        return planned_df, []
+
+    stored = {
+        (row['v_combined_group'], row['current_period']): row['v_fingerprint']
+        for row in FSITransitionCount.objects.filter(
+            v_transition_basis=basis,
+            current_period__gte=planned_df['current_period'].min().start_time.date(),
+            current_period__lte=planned_df['current_period'].max().start_time.date(),
+        ).values('v_combined_group', 'current_period', 'v_fingerprint')
+    }
+    keys = [(str(group), period.start_time.date()) for group, period in zip(planned_df['v_combined_group'], planned_df['current_period'])]
+
+    if full_rebuild:
+        stale_df = planned_df
+    else:
+        stale_df = planned_df[[stored.get(key) != fingerprint for key, fingerprint in zip(keys, planned_df['fingerprint'])]]
+    obsolete = sorted(set(stored) - set(keys))
+    return stale_df.reset_index(drop=True), obsolete
+
+
+def get_pair_periods(pairs_df):
+    """Periods whose stage data is needed to count pairs_df, in order."""
+    return sorted(set(pairs_df['previous_period']) | set(pairs_df['current_period']))
+
+
+def period_filter(periods, field='fic_mis_date'):
+    """Q object selecting the rows of the monthly periods; it selects nothing without periods."""
+    condition = Q(pk__in=[])
+    for period in periods:
+        condition |= Q(**{f'{field}__gte': period.start_time.date(), f'{field}__lte': period.end_time.date()})
+    return condition
+
+
+@transaction.atomic
+def count_and_save_transitions(basis, observations, code_column, code_order, pairs_df):
+    """
+    Count the transitions of the pairs of pairs_df (from get_stale_pairs) in the observations
+    of their periods and store them, replacing the pairs' previous counts.
+
+    :return: (pairs, counts, totals) of the pairs, as returned by count_transitions.
+    """
+    pairs, counts, totals = count_transitions(observations, code_column, code_order)
+    selected = pairs.reset_index().merge(pairs_df, on=['v_combined_group', 'previous_period', 'current_period'])
+    counts = counts[selected['index'].to_numpy()]
+    totals = totals[selected['index'].to_numpy()]
+    pairs = selected.drop(columns=['index'])
+
+    # A pair without any observation left in one of its periods has no counts
+    missing = len(pairs_df) - len(pairs)
+    if missing:
+        save_log('count_and_save_transitions', 'WARNING', f"{missing} period pairs had no stage data to count.")
+
+    delete_transition_counts(basis, [(group, period.start_time.date()) for group, period in zip(pairs['v_combined_group'], pairs['current_period'])])
+    FSITransitionCount.objects.bulk_create([
+        FSITransitionCount(
+            v_transition_basis=basis,
+            v_combined_group=str(row.v_combined_group),
+            previous_period=row.previous_period.start_time.date(),
+            current_period=row.current_period.start_time.date(),
+            v_codes=list(code_order),
+            n_counts=counts[index].tolist(),
+            n_totals=totals[index].tolist(),
+            v_fingerprint=row.fingerprint,
+        )
+        for index, row in enumerate(pairs.itertuples(index=False))
+    ], batch_size=1000)
+    save_log('count_and_save_transitions', 'INFO', f"Stored the {basis} transition counts of {len(pairs)} period pairs.")
+    return pairs.drop(columns=['fingerprint']), counts, totals
+
+
+def delete_transition_counts(basis, keys):
+    """Delete the stored counts of the (group, current period date) keys."""
+    condition = Q(pk__in=[])
+    for group, current_period in keys:
+        condition |= Q(v_combined_group=str(group), current_period=current_period)
+    FSITransitionCount.objects.filter(condition, v_transition_basis=basis).delete()
+
@@ -1,23 +1,8 @@
 from django.db import connection, transaction
-from IFRS9.models import Dim_Run
 from .save_log import save_log
+from .reference_data import get_latest_run_skey
 
 
-def get_latest_run_skey():
-    """
-    Retrieve the latest_run_skey from Dim_Run table.
-    """
-    try:
-        run_record = Dim_Run.objects.only('latest_run_skey').first()
-        if not run_record:
-            raise ValueError("No run key is available in the Dim_Run table.")
-        return run_record.latest_run_skey
-    except Dim_Run.DoesNotExist:
-        raise ValueError("Dim_Run table is missing.")
-    except Exception as e:
-        save_log('get_latest_run_skey', 'ERROR', f"Error fetching latest run_skey: {e}")
-        return None
-
 
 def update_financial_cash_flow(fic_mis_date):
     """
@@ -655,6 +655,27 @@ class FCT_Reporting_Lines(models.Model):
             models.UniqueConstraint(fields=['fic_mis_date', 'n_account_number', 'n_run_key'], name='unique_fct_reporting_lines')
         ]
 
+class FCT_ECL_Summary_Cube(models.Model):
+    # One row per (date, run, stage, segment, product type, loan type, currency) of FCT_Reporting_Lines
+    fic_mis_date = models.DateField()
+    n_run_key = models.BigIntegerField(null=True, blank=True)
+    n_stage_descr = models.CharField(max_length=50, null=True)
+    n_prod_segment = models.CharField(max_length=255, null=True, blank=True)
+    n_prod_type = models.CharField(max_length=50, null=True)
+    n_loan_type = models.CharField(max_length=50, null=True)
+    v_ccy_code = models.CharField(max_length=3, null=True, blank=True)
+    n_exposure_at_default_ncy = models.DecimalField(max_digits=22, decimal_places=3, null=True, blank=True)
+    n_exposure_at_default_rcy = models.DecimalField(max_digits=22, decimal_places=3, null=True, blank=True)
+    n_12m_ecl_rcy = models.DecimalField(max_digits=22, decimal_places=3, null=True, blank=True)
+    n_lifetime_ecl_rcy = models.DecimalField(max_digits=22, decimal_places=3, null=True, blank=True)
+    n_account_count = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'fct_ecl_summary_cube'
+        indexes = [
+            models.Index(fields=['fic_mis_date', 'n_run_key'], name='ecl_summary_cube_date_run_idx'),
+        ]
+
 class ECLMethod(models.Model):
     METHOD_CHOICES = [
         ('simple_ead', 'Forward Exposure Methodology'),
@@ -694,8 +715,10 @@ class ReportColumnConfig(models.Model):
 class Function(models.Model):
     function_name = models.CharField(max_length=255, unique=True)
     description = models.TextField(blank=True)
-
-   
+    # Tables the function reads and writes; the process scheduler runs functions whose tables do
+    # not conflict in parallel. Empty lists fall back to process_scheduler.FUNCTION_TABLE_ACCESS.
+    reads_tables = models.JSONField(default=list, blank=True)
+    writes_tables = models.JSONField(default=list, blank=True)
 
     def __str__(self):
         return self.function_name
@@ -731,7 +754,7 @@ class FunctionExecutionStatus(models.Model):
     duration = models.DurationField(null=True, blank=True)
     execution_order = models.PositiveIntegerField(null=True)
     reporting_date = models.DateField(null=True)
-    status = models.CharField(max_length=20, choices=[('Pending', 'Pending'), ('Ongoing', 'Ongoing'), ('Success', 'Success'), ('Failed', 'Failed')], default='Pending')
+    status = models.CharField(max_length=20, choices=[('Pending', 'Pending'), ('Ongoing', 'Ongoing'), ('Success', 'Success'), ('Failed', 'Failed'), ('Skipped', 'Skipped'), ('Cancelled', 'Cancelled')], default='Pending')
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)  # Link to the User model
     # Track process execution instances
     process_run_id = models.CharField(max_length=50)  # Combined process_id, execution_date, and run_count
@@ -747,8 +770,68 @@ class FunctionExecutionStatus(models.Model):
 
     def __str__(self):
         return f"{self.process.process_name} - {self.function.function_name} - {self.status}"
-    
-    
+
+
+class FunctionExecutionMetric(models.Model):
+    # Resource usage of one function in one process run, recorded by Functions/function_metrics.py
+    process = models.ForeignKey(Process, on_delete=models.CASCADE)
+    function = models.ForeignKey(Function, on_delete=models.CASCADE)
+    process_run_id = models.CharField(max_length=50)
+    fic_mis_date = models.DateField(null=True)
+    status = models.CharField(max_length=20)
+    wall_seconds = models.FloatField()
+    cpu_seconds = models.FloatField()  # CPU time of the thread running the function
+    peak_rss_mb = models.FloatField(null=True, blank=True)  # Peak resident memory of the worker process while the function ran
+    query_count = models.PositiveIntegerField(default=0)
+    db_seconds = models.FloatField(default=0)
+    rows_affected = models.BigIntegerField(default=0)  # Rows inserted, updated, deleted or COPYed
+    recorded_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'fct_function_execution_metric'
+        ordering = ['recorded_at']
+        constraints = [
+            models.UniqueConstraint(fields=['process_run_id', 'function'], name='unique_function_execution_metric')
+        ]
+        indexes = [
+            models.Index(fields=['function', 'recorded_at'], name='function_metric_trend_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.process_run_id} - {self.function.function_name} - {self.wall_seconds:.1f}s"
+
+
+class ProcessJob(models.Model):
+    # Queued process run, executed by the run_process_worker command. The worker owning a running
+    # job renews lease_expires_at; another worker takes over the job once the lease has expired.
+    STATUS_CHOICES = [('Queued', 'Queued'), ('Running', 'Running'), ('Success', 'Success'), ('Failed', 'Failed'), ('Cancelled', 'Cancelled')]
+
+    process = models.ForeignKey(Process, on_delete=models.CASCADE)
+    process_run_id = models.CharField(max_length=50, unique=True)
+    fic_mis_date = models.DateField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='Queued')
+    cancel_requested = models.BooleanField(default=False)
+    worker_id = models.CharField(max_length=255, null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)  # Number of times a worker claimed the job
+    error_message = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        db_table = 'dim_process_job'
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'lease_expires_at'], name='process_job_claim_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.process_run_id} - {self.status}"
+
+
 class Log(models.Model):
     LOG_LEVEL_CHOICES = [
         ('INFO', 'Info'),
@@ -765,7 +848,61 @@ class Log(models.Model):
         verbose_name = 'Log'
         verbose_name_plural = 'Logs'
         ordering = ['-timestamp']
-    
+
+
+class ExportJob(models.Model):
+    # Large table/report extracts written to a file in the background and downloaded when finished
+    FORMAT_CHOICES = [('csv', 'CSV'), ('xlsx', 'Excel')]
+
+    table_name = models.CharField(max_length=100)
+    export_format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default='csv')
+    parameters = models.JSONField(default=dict)  # Filters, sort order and columns of the extract
+    status = models.CharField(max_length=20, choices=[('Pending', 'Pending'), ('Ongoing', 'Ongoing'), ('Success', 'Success'), ('Failed', 'Failed')], default='Pending')
+    total_rows = models.BigIntegerField(null=True, blank=True)
+    rows_written = models.BigIntegerField(default=0)
+    file_path = models.CharField(max_length=500, null=True, blank=True)
+    error_message = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        db_table = 'dim_export_job'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.table_name} ({self.export_format}) - {self.status}"
+
+
+class DataQualityViolation(models.Model):
+    # One row per (date, rule, record) failing a rule of Functions/data_quality_rules.py
+    fic_mis_date = models.DateField()
+    rule_code = models.CharField(max_length=50)
+    table_name = models.CharField(max_length=100)
+    v_account_number = models.CharField(max_length=255, null=True, blank=True)
+    v_reference_code = models.CharField(max_length=255, null=True, blank=True)  # Offending code, e.g. a missing product code
+    message = models.TextField()
+
+    class Meta:
+        db_table = 'fct_data_quality_violation'
+        indexes = [
+            models.Index(fields=['fic_mis_date', 'rule_code', 'v_account_number'], name='dq_violation_date_rule_idx'),
+        ]
+
+
+class DataQualityCheckRun(models.Model):
+    # Last evaluation of the rules of one table for one date
+    fic_mis_date = models.DateField()
+    table_name = models.CharField(max_length=100)
+    evaluated_at = models.DateTimeField(auto_now=True)
+    violation_count = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'dim_data_quality_check_run'
+        constraints = [
+            models.UniqueConstraint(fields=['fic_mis_date', 'table_name'], name='unique_data_quality_check_run')
+        ]
+
 
 class CurrencyCode(models.Model):
 
@@ -806,4 +943,40 @@ class FSICUMULATIVEPD(models.Model):
     transition_date = models.DateField(null=True, blank=True)
     class Meta:
         db_table = 'fsi_cumulative_pd'
- 
\ No newline at end of file
+ 
+
+class FSITransitionCount(models.Model):
+    # Transition counts between two consecutive observed periods of a group, counted once per
+    # period pair by Functions/transition_history.py so a new month only counts its newest pair
+    v_transition_basis = models.CharField(max_length=1)  # 'D' delinquency bands, 'R' credit ratings
+    v_combined_group = models.CharField(max_length=100)
+    previous_period = models.DateField()  # First day of the previous observed period
+    current_period = models.DateField()  # First day of the period the accounts moved to
+    v_codes = models.JSONField()  # Codes (lowercase) in matrix order
+    n_counts = models.JSONField()  # n_counts[i][j]: accounts moving from code i to code j
+    n_totals = models.JSONField()  # n_totals[i]: accounts with code i still observed in the current period
+    v_fingerprint = models.CharField(max_length=64)  # Stage data of both periods the counts were computed from
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'fsi_transition_count'
+        constraints = [
+            models.UniqueConstraint(fields=['v_transition_basis', 'v_combined_group', 'current_period'], name='unique_transition_count')
+        ]
+
+    def __str__(self):
+        return f"{self.v_transition_basis} {self.v_combined_group}: {self.previous_period} -> {self.current_period}"
+
+
+class ReferenceDataVersion(models.Model):
+    # Bumped whenever a reference dimension cached by Functions/reference_data.py changes, so the
+    # run context of a worker process reloads it before its next function
+    v_dimension = models.CharField(max_length=50, unique=True)
+    n_version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'dim_reference_data_version'
+
+    def __str__(self):
+        return f"{self.v_dimension} v{self.n_version}"
@@ -4,7 +4,7 @@ from django.db import transaction
 import threading
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib import messages
-from IFRS9.models import Process, RunProcess,Function,FunctionExecutionStatus
+from IFRS9.models import Process, RunProcess,Function,FunctionExecutionStatus,FunctionExecutionMetric
 from Users.models import AuditTrail  # Import AuditTrail model
 from django.utils.timezone import now  # For timestamping
 from scylla_ifrs9_postgre.forms import ProcessForm, RunProcessForm
@@ -56,7 +56,19 @@ from ..Functions.cal_forward_exposure4 import *
 from ..Functions.calculate_marginal_pd import *
 from ..Functions.populate_reporting_table import *
 from ..Functions.calculate_ecl import *
+from ..Functions.fused_cash_flow_chain import *
+from ..Functions.sharded_cash_flow_chain import CASH_FLOW_SHARD_COUNT, calculate_ecl_based_on_method_sharded, insert_cash_flow_data_sharded
 from ..Functions.cal_reporting_currency import *
+from ..Functions.save_log import flush_logs
+from ..Functions.data_quality_rules import ensure_data_quality_rules, get_violations
+from ..Functions.data_export import xlsx_temp_file
+from ..Functions.process_scheduler import build_dependency_graph, get_table_access, run_dag
+from ..Functions.reference_data import run_context
+from ..Functions.process_jobs import enqueue_process_run, is_cancel_requested, request_cancel, requeue_process_run
+from ..Functions.function_metrics import FunctionMetricsRecorder, compare_with_previous_runs, get_function_trend, save_function_metrics
+from django.db.models import F
+from django.http import FileResponse
+import tempfile
 from django.db.models import Min, Max
 
 
@@ -330,10 +342,6 @@ def execute_process_view(request):
 # Handle execution
 # Function to generate the process run ID and count
 
-running_threads = {}
-cancel_flags = {}
-
-
 def generate_process_run_id(process, execution_date):
     """
     Generate a process_run_id in the format 'process_id_execution_date_run_number'.
@@ -362,68 +370,111 @@ def generate_process_run_id(process, execution_date):
 
 # Background function for running the process
 # Background function for running the process
-def execute_functions_in_background(function_status_entries, process_run_id, mis_date):
-    for status_entry in function_status_entries:
-
-        if cancel_flags.get(process_run_id):  # Check if cancellation was requested
-            status_entry.status = 'Cancelled'
-            status_entry.execution_end_date = timezone.now()
-            status_entry.duration = status_entry.execution_end_date - status_entry.execution_start_date
-            status_entry.save()
-            print(f"Process {process_run_id} was cancelled.")
-            break  # Stop execution if cancelled
-
-        function_name = status_entry.function.function_name
-        print(f"Preparing to execute function: {function_name}")
-
-        # Set the function status to "Ongoing" and record the start date
-        status_entry.status = 'Ongoing'
-        status_entry.execution_start_date = timezone.now()  # Start time for the function
-        status_entry.save()
-        print(f"Function {function_name} marked as Ongoing.")
-
-        # Execute the function
-        try:
-            if function_name in globals():
+def run_process_function(status_entry, mis_date, fused_steps):
+    """Execute one process function, recording its status, start/end dates and duration."""
+    function_name = status_entry.function.function_name
+    print(f"Preparing to execute function: {function_name}")
+
+    # Set the function status to "Ongoing" and record the start date
+    status_entry.status = 'Ongoing'
+    status_entry.execution_start_date = timezone.now()  # Start time for the function
+    status_entry.save()
+    print(f"Function {function_name} marked as Ongoing.")
+
+    # Execute the function, measuring its time, memory and database work
+    metrics = FunctionMetricsRecorder()
+    try:
+        with metrics:
+            if function_name in fused_steps:
+                print(f"Function {function_name} was computed by the fused cash flow insert.")
+                result = 1
+            elif function_name == 'insert_cash_flow_data' and CASH_FLOW_CHAIN_MODE == 'fused':
+                print(f"Executing function: {function_name} (fused with {len(fused_steps)} steps) with date {mis_date}")
+                result = insert_cash_flow_data_fused(mis_date, fused_steps)
+            elif function_name == 'insert_cash_flow_data' and CASH_FLOW_CHAIN_MODE == 'sharded':
+                print(f"Executing function: {function_name} ({CASH_FLOW_SHARD_COUNT} shards, fused with {len(fused_steps)} steps) with date {mis_date}")
+                result = insert_cash_flow_data_sharded(mis_date, fused_steps)
+            elif function_name == 'calculate_ecl_based_on_method' and CASH_FLOW_CHAIN_MODE == 'sharded':
+                print(f"Executing function: {function_name} ({CASH_FLOW_SHARD_COUNT} shards) with date {mis_date}")
+                result = calculate_ecl_based_on_method_sharded(mis_date)
+            elif function_name in globals():
                 print(f"Executing function: {function_name} with date {mis_date}")
                 result = globals()[function_name](mis_date)  # Execute the function and capture the return value
-                
-                # Update status and end date based on the return value
-                status_entry.execution_end_date = timezone.now()  # End time for the function
-                if result == 1 or result == '1':
-                    status_entry.status = 'Success'
-                    print(f"Function {function_name} executed successfully.")
-                elif result == 0 or result == '0':
-                    status_entry.status = 'Failed'
-                    print(f"Function {function_name} execution failed.")
-                    status_entry.save()
-                    break  # Stop execution if the function fails
-                else:
-                    status_entry.status = 'Failed'
-                    print(f"Unexpected return value {result} from function {function_name}.")
-                    status_entry.save()
-                    break  # Stop execution for any unexpected result
             else:
-                status_entry.status = 'Failed'
                 print(f"Function {function_name} not found in the global scope.")
-                status_entry.execution_end_date = timezone.now()
-                status_entry.save()
-                break  # Stop execution if the function is not found
+                result = None
 
-        except Exception as e:
+        if result == 1 or result == '1':
+            status_entry.status = 'Success'
+            print(f"Function {function_name} executed successfully.")
+        elif result == 0 or result == '0':
             status_entry.status = 'Failed'
-            status_entry.execution_end_date = timezone.now()
-            print(f"Error executing {function_name}: {e}")
-            status_entry.save()
-            break  # Stop execution if any function throws an exception
+            print(f"Function {function_name} execution failed.")
+        else:
+            status_entry.status = 'Failed'
+            print(f"Unexpected return value {result} from function {function_name}.")
+
+    except Exception as e:
+        status_entry.status = 'Failed'
+        print(f"Error executing {function_name}: {e}")
+
+    # Update end date and duration
+    status_entry.execution_end_date = timezone.now()  # End time for the function
+    status_entry.duration = status_entry.execution_end_date - status_entry.execution_start_date
+
+    # Save the final status and duration
+    status_entry.save()
+    save_function_metrics(status_entry, metrics)
+    print(f"Updated FunctionExecutionStatus for {function_name} to {status_entry.status}")
+    return status_entry.status == 'Success'
+
+
+def execute_functions_in_background(function_status_entries, process_run_id, mis_date, should_cancel=None):
+    """
+    Run the process functions as a DAG on a worker pool: functions whose tables do not conflict
+    (see process_scheduler.get_table_access) run in parallel, the others keep their process order.
+    A failure only skips the functions downstream of it; cancellation stops starting new ones.
+    Called by the run_process_worker command for each queued ProcessJob.
+    """
+    # Dimension lookups of the run's functions share one cache (see reference_data.get_run_context)
+    with run_context() as context:
+        # In fused and sharded modes the cash flow calculation steps are computed by the insert itself
+        fused_steps = []
+        if CASH_FLOW_CHAIN_MODE in ('fused', 'sharded'):
+            fused_steps = get_fused_cash_flow_steps(
+                [status_entry.function.function_name for status_entry in function_status_entries]
+            )
+
+        upstream = build_dependency_graph(
+            [get_table_access(status_entry.function) for status_entry in function_status_entries]
+        )
 
-        # Calculate duration
-        if status_entry.execution_start_date and status_entry.execution_end_date:
-            status_entry.duration = status_entry.execution_end_date - status_entry.execution_start_date
+        def run_node(index):
+            # Pick up the reference data saved since the previous function, e.g. from the web process
+            context.refresh()
+            return run_process_function(function_status_entries[index], mis_date, fused_steps)
+
+        def mark(status):
+            def mark_entry(index):
+                status_entry = function_status_entries[index]
+                status_entry.status = status
+                status_entry.execution_end_date = timezone.now()
+                status_entry.save()
+                print(f"Function {status_entry.function.function_name} marked as {status}.")
+            return mark_entry
+
+        outcome = run_dag(
+            upstream,
+            run_node,
+            should_cancel=should_cancel or (lambda: is_cancel_requested(process_run_id)),  # Cancellation goes through the database
+            on_skipped=mark('Skipped'),
+            on_cancelled=mark('Cancelled'),
+        )
+        if 'Cancelled' in outcome.values():
+            print(f"Process {process_run_id} was cancelled.")
 
-        # Save the final status and duration
-        status_entry.save()
-        print(f"Updated FunctionExecutionStatus for {function_name} to {status_entry.status}")
+    # Make the run's buffered log records visible once the run stops
+    flush_logs()
 
 
 @login_required
@@ -468,14 +519,11 @@ def run_process_execution(request):
             function_status_entries.append(status_entry)
             print(f"Function {run_process.function.function_name} marked as Pending.")
 
-        # Redirect to the monitoring page so the user can see the function statuses
-        response = redirect('monitor_specific_process', process_run_id=process_run_id)
-
-        # Execute functions in the background (thread)
-        execution_thread = threading.Thread(target=execute_functions_in_background, args=(function_status_entries, process_run_id, mis_date))
-        execution_thread.start()
+        # Queue the run for the run_process_worker command, which survives web worker restarts
+        enqueue_process_run(process, mis_date, process_run_id, request.user)
 
-        return response  # Redirects immediately while the background task executes
+        # Redirect to the monitoring page so the user can see the function statuses
+        return redirect('monitor_specific_process', process_run_id=process_run_id)
         
 
 @login_required
@@ -547,12 +595,45 @@ def monitor_specific_process(request, process_run_id):
     # Fetch the specific process run by its ID
     process_statuses = FunctionExecutionStatus.objects.filter(process_run_id=process_run_id)
 
+    # Resource usage of each step, compared with the step's previous runs
+    function_metrics = compare_with_previous_runs(
+        list(FunctionExecutionMetric.objects.filter(process_run_id=process_run_id).select_related('function'))
+    )
+
     context = {
         'process_statuses': process_statuses,
         'process_run_id': process_run_id,
+        'function_metrics': function_metrics,
     }
     return render(request, 'operations/monitor_specific_process.html', context)
 
+
+@login_required
+def function_metrics_trend(request, function_id):
+    # Per-run metrics of one step, oldest first, for the trend charts of the monitoring page
+    function = get_object_or_404(Function, id=function_id)
+    runs = int(request.GET.get('runs', 30))
+
+    metrics = get_function_trend(function.id, runs)
+    return JsonResponse({
+        'function_name': function.function_name,
+        'runs': [
+            {
+                'process_run_id': metric.process_run_id,
+                'fic_mis_date': metric.fic_mis_date,
+                'recorded_at': metric.recorded_at,
+                'wall_seconds': metric.wall_seconds,
+                'cpu_seconds': metric.cpu_seconds,
+                'db_seconds': metric.db_seconds,
+                'query_count': metric.query_count,
+                'rows_affected': metric.rows_affected,
+                'rows_per_second': metric.rows_affected / metric.wall_seconds if metric.wall_seconds else None,
+                'peak_rss_mb': metric.peak_rss_mb,
+            }
+            for metric in metrics
+        ],
+    })
+
 @login_required
 def get_updated_status_table(request):
     process_run_id = request.GET.get('process_run_id')
@@ -608,6 +689,11 @@ def running_processes_view(request):
 # Updated function to handle cancellation request
 @login_required
 def cancel_running_process(request, process_run_id):
+    # Queued and running jobs are cancelled through the database, whichever node runs them
+    if request_cancel(process_run_id):
+        messages.success(request, f"Cancellation of process '{process_run_id}' has been requested.")
+        return redirect('running_processes')
+
     # Check if the process is running
     try:
         # Get all functions related to the given process_run_id
@@ -629,6 +715,17 @@ def cancel_running_process(request, process_run_id):
     return redirect('running_processes')  # Redirect to the running processes list
 
 
+@login_required
+@permission_required('IFRS9.can_execute_run',raise_exception=True)
+def resume_process_run(request, process_run_id):
+    # Queue a failed or cancelled run again; it restarts at its first function that did not succeed
+    if requeue_process_run(process_run_id):
+        messages.success(request, f"Process '{process_run_id}' has been queued to resume.")
+    else:
+        messages.info(request, f"Process '{process_run_id}' is not failed or cancelled and cannot be resumed.")
+    return redirect('monitor_specific_process', process_run_id=process_run_id)
+
+
 @login_required
 def data_quality_check(request):
     """
@@ -637,11 +734,21 @@ def data_quality_check(request):
     return render(request, 'operations/data_quality_check.html')
 
 
+def refresh_data_quality_rules(request):
+    """Evaluate the data quality rules of the requested fic_mis_date again when ?refresh=true."""
+    fic_mis_date = request.GET.get("fic_mis_date")
+    if fic_mis_date and request.GET.get("refresh") == "true":
+        ensure_data_quality_rules(fic_mis_date, refresh=True)
+
+
 @login_required
 def check_missing_customers(request):
     """
     View to check for missing customers with AJAX support for pagination and Excel download.
+    Reads the violations of the missing_customer data quality rule; refresh=true evaluates the
+    rules of the date again first.
     """
+    refresh_data_quality_rules(request)
     # AJAX call to fetch fic_mis_dates
     if request.headers.get("x-requested-with") == "XMLHttpRequest" and "fic_mis_date" not in request.GET:
         fic_mis_dates = (
@@ -655,39 +762,19 @@ def check_missing_customers(request):
     if request.GET.get("download") == "true":
         fic_mis_date = request.GET.get("fic_mis_date")
         if fic_mis_date:
-            missing_customers = Ldn_Financial_Instrument.objects.filter(
-                fic_mis_date=fic_mis_date
-            ).exclude(
-                v_cust_ref_code__in=Ldn_Customer_Info.objects.values_list("v_party_id", flat=True)
-            ).values("v_cust_ref_code", "v_account_number", "fic_mis_date")
-
-            # Create an Excel file
-            workbook = openpyxl.Workbook()
-            sheet = workbook.active
-            sheet.title = "Missing Customers"
-
-            # Add headers
+            missing_customers = get_violations(fic_mis_date, "missing_customer").values_list(
+                "v_reference_code", "v_account_number", "fic_mis_date"
+            )
+
+            # Write the Excel file row by row and send it from disk
             headers = ["Customer Reference Code", "Account Number", "Reporting Date"]
-            sheet.append(headers)
-
-            # Add data rows
-            for customer in missing_customers:
-                sheet.append(
-                    [
-                        customer["v_cust_ref_code"],
-                        customer["v_account_number"],
-                        customer["fic_mis_date"],
-                    ]
-                )
-
-            # Save the workbook to the HTTP response
-            response = HttpResponse(
-                content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            return FileResponse(
+                xlsx_temp_file(headers, missing_customers.iterator(), "Missing Customers"),
+                as_attachment=True,
+                filename=f"missing_customers_{fic_mis_date}.xlsx",
+                content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )
-            response["Content-Disposition"] = f'attachment; filename="missing_customers_{fic_mis_date}.xlsx"'
-            workbook.save(response)  # Save directly to response
-            return response
-        
+
     # AJAX call to fetch paginated missing customers
     if request.headers.get("x-requested-with") == "XMLHttpRequest" and "fic_mis_date" in request.GET:
         fic_mis_date = request.GET.get("fic_mis_date")
@@ -695,11 +782,9 @@ def check_missing_customers(request):
         rows_per_page = int(request.GET.get("rows_per_page", 100))
 
         if fic_mis_date:
-            missing_customers = Ldn_Financial_Instrument.objects.filter(
-                fic_mis_date=fic_mis_date
-            ).exclude(
-                v_cust_ref_code__in=Ldn_Customer_Info.objects.values_list("v_party_id", flat=True)
-            ).values("v_cust_ref_code", "v_account_number", "fic_mis_date")
+            missing_customers = get_violations(fic_mis_date, "missing_customer").values(
+                "v_account_number", "fic_mis_date", v_cust_ref_code=F("v_reference_code")
+            )
 
             paginator = Paginator(missing_customers, rows_per_page)
             paginated_data = list(paginator.get_page(page).object_list)
@@ -725,8 +810,11 @@ def check_missing_customers(request):
 def check_missing_products(request):
     """
     View to check for missing products based on the given fic_mis_date.
-    It compares v_prod_code in Ldn_Financial_Instrument with v_prod_code in Ldn_Bank_Product_Info.
+    Reads the violations of the missing_product data quality rule, which compares v_prod_code in
+    Ldn_Financial_Instrument with v_prod_code in Ldn_Bank_Product_Info; refresh=true evaluates the
+    rules of the date again first.
     """
+    refresh_data_quality_rules(request)
 
     # AJAX call to fetch fic_mis_dates
     if request.headers.get("x-requested-with") == "XMLHttpRequest" and "fic_mis_date" not in request.GET:
@@ -743,41 +831,20 @@ def check_missing_products(request):
         if fic_mis_date:
             # Fetch distinct product codes
             missing_products = (
-                Ldn_Financial_Instrument.objects.filter(
-                    fic_mis_date=fic_mis_date
-                )
-                .exclude(
-                    v_prod_code__in=Ldn_Bank_Product_Info.objects.values_list("v_prod_code", flat=True)
-                )
-                .values("v_prod_code", "fic_mis_date")
+                get_violations(fic_mis_date, "missing_product")
+                .order_by("v_reference_code")
+                .values_list("v_reference_code", "fic_mis_date")
                 .distinct()  # Ensure distinct product codes
-                )
-
-            # Create an Excel workbook
-            workbook = openpyxl.Workbook()
-            sheet = workbook.active
-            sheet.title = "Missing Products"
+            )
 
-            # Add headers
+            # Write the Excel file row by row and send it from disk
             headers = ["Product Code", "Reporting Date"]
-            sheet.append(headers)
-
-            # Add data rows
-            for product in missing_products:
-                sheet.append(
-                    [
-                        product["v_prod_code"],
-                        product["fic_mis_date"],
-                    ]
-                )
-
-            # Save the workbook to the HTTP response
-            response = HttpResponse(
-                content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            return FileResponse(
+                xlsx_temp_file(headers, missing_products.iterator(), "Missing Products"),
+                as_attachment=True,
+                filename=f"missing_products_{fic_mis_date}.xlsx",
+                content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )
-            response["Content-Disposition"] = f'attachment; filename="missing_products_{fic_mis_date}.xlsx"'
-            workbook.save(response)  # Save directly to response
-            return response
 
     # AJAX call to fetch paginated missing products
     if request.headers.get("x-requested-with") == "XMLHttpRequest" and "fic_mis_date" in request.GET:
@@ -787,16 +854,11 @@ def check_missing_products(request):
 
         if fic_mis_date:
             missing_products = (
-                    Ldn_Financial_Instrument.objects.filter(
-                        fic_mis_date=fic_mis_date
-                    )
-                    .exclude(
-                        v_prod_code__in=Ldn_Bank_Product_Info.objects.values_list("v_prod_code", flat=True)
-                    )
-                    .values("v_prod_code", "fic_mis_date")
-                    .distinct()  # Ensure distinct product codes
-                                )
-
+                get_violations(fic_mis_date, "missing_product")
+                .order_by("v_reference_code")
+                .values("fic_mis_date", v_prod_code=F("v_reference_code"))
+                .distinct()  # Ensure distinct product codes
+            )
 
             paginator = Paginator(missing_products, rows_per_page)
             paginated_data = list(paginator.get_page(page).object_list)
@@ -817,11 +879,18 @@ def check_missing_products(request):
     return render(request, "operations/check_missing_products.html", {})
 
 
+# Data quality rules shown on the cashflow data check page
+CASHFLOW_DATA_RULES = ["rule1", "rule2", "rule3", "rule4", "rule5", "rule6"]
+
+
 @login_required
 def check_cashflow_data(request):
     """
-    View to check cashflow data quality based on provided rules.
+    View to check cashflow data quality based on provided rules. The rules are evaluated once per
+    date by the data quality rule engine; pages and downloads read the stored violations, and
+    refresh=true evaluates them again.
     """
+    refresh_data_quality_rules(request)
     if request.headers.get("x-requested-with") == "XMLHttpRequest" and "fic_mis_date" not in request.GET:
         fic_mis_dates = (
             Ldn_Financial_Instrument.objects.values_list("fic_mis_date", flat=True)
@@ -835,99 +904,41 @@ def check_cashflow_data(request):
     download = request.GET.get("download", False)
 
     if fic_mis_date:
-        cashflow_data = Ldn_Financial_Instrument.objects.filter(
-            fic_mis_date=fic_mis_date
-        ).values(
-            "v_account_number",
-            "d_maturity_date",
-            "d_next_payment_date",
-            "fic_mis_date",
-            "n_curr_payment_recd",
-            "n_eop_bal",
-            "v_amrt_repayment_type",
-        )
-
-        errors = {"rule1": [], "rule2": [], "rule3": [], "rule4": [], "rule5": [], "rule6": []}
-
-        for record in cashflow_data:
-            v_account_number = record["v_account_number"]
-            d_maturity_date = record["d_maturity_date"]
-            d_next_payment_date = record["d_next_payment_date"]
-            fic_mis_date = record["fic_mis_date"]
-            n_curr_payment_recd = record["n_curr_payment_recd"]
-            n_eop_bal = record["n_eop_bal"]
-            v_amrt_repayment_type = record["v_amrt_repayment_type"]
-
-            # Rule 1
-            if d_maturity_date < d_next_payment_date:
-                errors["rule1"].append({
-                    "v_account_number": v_account_number,
-                    "error": f"Maturity date {d_maturity_date} must be greater than or equal to the next payment date {d_next_payment_date}.",
-                })
-
-            # Rule 2
-            if d_next_payment_date > d_maturity_date:
-                errors["rule2"].append({
-                    "v_account_number": v_account_number,
-                    "error": f"Next payment date {d_next_payment_date} must be less than or equal to maturity date {d_maturity_date}.",
-                })
-
-            # Rule 3
-            if fic_mis_date >= d_maturity_date or fic_mis_date >= d_next_payment_date:
-                errors["rule3"].append({
-                    "v_account_number": v_account_number,
-                    "error": f"Reporting Date {fic_mis_date} must be less than maturity date {d_maturity_date} and next payment date {d_next_payment_date}.",
-                })
-
-            # Rule 4
-            if d_maturity_date == d_next_payment_date and n_curr_payment_recd < n_eop_bal:
-                errors["rule4"].append({
-                    "v_account_number": v_account_number,
-                    "error": f"IF {d_maturity_date}={d_next_payment_date} then Current payment {n_curr_payment_recd} must be greater than or equal to end-of-period balance {n_eop_bal}.",
-                })
-
-            # Rule 5
-            if d_maturity_date > d_next_payment_date and n_curr_payment_recd >= n_eop_bal:
-                errors["rule5"].append({
-                    "v_account_number": v_account_number,
-                    "error": f"IF {d_maturity_date}>{d_next_payment_date} then Current payment {n_curr_payment_recd} must be less than end-of-period balance {n_eop_bal}.",
-                })
-
-            # Rule 6
-            if v_amrt_repayment_type not in ["BULLET", "AMORTIZED"] or v_amrt_repayment_type is None:
-                errors["rule6"].append({
-                    "v_account_number": v_account_number,
-                    "error": f"Repayment type must be 'BULLET' or 'AMORTIZED' but found '{v_amrt_repayment_type}'.",
-                })
+        errors = {
+            rule: get_violations(fic_mis_date, rule).values("v_account_number", error=F("message"))
+            for rule in CASHFLOW_DATA_RULES
+        }
 
         if download:
-            # Create Excel workbook
-            workbook = openpyxl.Workbook()
-            del workbook["Sheet"]
+            # Create a write-only Excel workbook, one sheet per rule
+            workbook = openpyxl.Workbook(write_only=True)
+            headers = ["#", "Account Number", "Error"]
 
             for rule, rule_errors in errors.items():
                 sheet = workbook.create_sheet(title=rule.upper())
-                headers = ["#", "Account Number", "Error"]
-                sheet.append(headers)
 
-                for index, error in enumerate(rule_errors, start=1):
+                # Adjust column width
+                for col_num, column in enumerate(headers, start=1):
+                    sheet.column_dimensions[get_column_letter(col_num)].width = 25
+
+                sheet.append(headers)
+                for index, error in enumerate(rule_errors.iterator(), start=1):
                     sheet.append([
                         index,
                         error["v_account_number"],
                         error["error"]
                     ])
 
-                # Adjust column width
-                for col_num, column in enumerate(headers, start=1):
-                    sheet.column_dimensions[get_column_letter(col_num)].width = 25
-
-            # Save the Excel file
-            response = HttpResponse(
-                content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            # Save the Excel file to disk and send it from there
+            file = tempfile.TemporaryFile()
+            workbook.save(file)
+            file.seek(0)
+            return FileResponse(
+                file,
+                as_attachment=True,
+                filename=f"cashflow_data_errors_{fic_mis_date}.xlsx",
+                content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )
-            response["Content-Disposition"] = f"attachment; filename=cashflow_data_errors_{fic_mis_date}.xlsx"
-            workbook.save(response)
-            return response
 
         # Paginate errors
         paginated_errors = {}
@@ -72,6 +72,20 @@ import csv
 import openpyxl
 from django.http import JsonResponse, HttpResponse
 from IFRS9.signals import *
+from .Functions.ecl_summary_cube import CUBE_DIMENSIONS, refresh_ecl_summary_cube
+from .Functions.report_snapshot_cache import load_reporting_lines_snapshot
+from .Functions.staging_upload import (
+    get_upload_progress,
+    load_upload_to_table,
+    read_upload_preview,
+    save_upload,
+    set_upload_progress,
+)
+from .Functions.data_export import (
+    EXPORT_BACKGROUND_ROW_THRESHOLD, build_export_queryset, iter_export_rows, start_export_job, stream_csv,
+    xlsx_temp_file,
+)
+from django.http import FileResponse, StreamingHttpResponse
 from django.db.models import Min, Max
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
@@ -313,20 +327,16 @@ class FileUploadView(LoginRequiredMixin,View):
 
             try:
                 # Automatically detect file type and process accordingly
-                if file.name.endswith('.csv'):
-                    df = pd.read_csv(file)
-                elif file.name.endswith(('.xls', '.xlsx')):
-                    df = pd.read_excel(file)
-                else:
+                if not file.name.endswith(('.csv', '.xls', '.xlsx')):
                     messages.error(request, "Unsupported file format. Please upload a CSV or Excel file.")
                     return render(request, self.template_name, {'form': form, 'stg_tables': TableMetadata.objects.filter(table_type='STG')})
 
-                # Convert Timestamps to strings for JSON serialization
-                df = df.applymap(lambda x: x.isoformat() if isinstance(x, pd.Timestamp) else x)
-
+                # Keep the file on disk; only its path and header travel in the session
+                upload_path = save_upload(file)
+                df = read_upload_preview(upload_path)
 
-                # Store the data, column names, and selected table in session for later steps
-                request.session['file_data'] = df.to_dict()  # Save the full data in session
+                # Store the file path, column names, and selected table in session for later steps
+                request.session['upload_path'] = upload_path
                 request.session['columns'] = list(df.columns)
                 request.session['selected_table'] = selected_table  # Save the selected table
 
@@ -472,89 +482,48 @@ class SubmitToDatabaseView(LoginRequiredMixin, View):
     def post(self, request):
         try:
             # Retrieve data from the session
-            df_data = request.session.get('file_data')
+            upload_path = request.session.get('upload_path')
             selected_columns = request.session.get('selected_columns')
             mappings = request.session.get('column_mappings')
             selected_table = request.session.get('selected_table')
 
-            if not df_data or not selected_columns or not mappings:
+            if not upload_path or not selected_columns or not mappings:
                 return JsonResponse({'status': 'error', 'message': 'Missing data in the session.'}, status=400)
+            if not os.path.exists(upload_path):
+                return JsonResponse({'status': 'error', 'message': 'The uploaded file is no longer available. Please upload it again.'}, status=400)
 
-            # Convert session data to DataFrame and apply mappings
-            df = pd.DataFrame(df_data)
-            df = df[selected_columns].rename(columns=mappings)
-
-            # Clean the data
-            df = self.clean_data(df)
-
-            # Convert date columns to YYYY-MM-DD format
-            for column in df.columns:
-                if 'date' in column.lower():
-                    df[column] = pd.to_datetime(df[column], errors='coerce').dt.strftime('%Y-%m-%d').astype(str)
-            
             # Retrieve the model class dynamically
             model_class = apps.get_model('IFRS9', selected_table)
 
-            # Define chunk size for bulk insert
-            chunk_size = 5000
-            total_chunks = len(df) // chunk_size + (1 if len(df) % chunk_size > 0 else 0)
-            request.session['progress'] = 0
-
-            # Counter to track the total number of records successfully inserted
-            success_count = 0
+            # Publish the progress after each chunk so CheckProgressView sees it while the load runs
+            upload_key = request.session.session_key
 
-            for i, chunk_start in enumerate(range(0, len(df), chunk_size), start=1):
-                # Prepare the chunk for insertion
-                chunk_df = df.iloc[chunk_start:chunk_start + chunk_size]
-                records_to_insert = [model_class(**row.to_dict()) for _, row in chunk_df.iterrows()]
+            def report_progress(rows_loaded, percent):
+                set_upload_progress(upload_key, percent)
 
-                try:
-                    # Bulk create the records with conflict handling
-                    model_class.objects.bulk_create(records_to_insert)
-                    success_count += len(records_to_insert)  # Increment success count by inserted records
-                except IntegrityError as e:
-                    return JsonResponse({'status': 'error', 'message': f'Integrity error: {str(e)}'}, status=400)
-                except ValidationError as e:
-                    error_messages = "; ".join(f"{field}: {', '.join(errors)}" for field, errors in e.message_dict.items())
-                    return JsonResponse({'status': 'error', 'message': f'Validation error: {error_messages}'}, status=400)
-                except DBError as e:
-                    return JsonResponse({'status': 'error', 'message': f'Database error: {str(e)}'}, status=400)
+            set_upload_progress(upload_key, 0)
+            try:
+                # Read, clean and COPY the file in chunks, then merge it into the table
+                success_count = load_upload_to_table(upload_path, model_class, selected_columns, mappings, report_progress)
+            except IntegrityError as e:
+                return JsonResponse({'status': 'error', 'message': f'Integrity error: {str(e)}'}, status=400)
+            except DBError as e:
+                return JsonResponse({'status': 'error', 'message': f'Database error: {str(e)}'}, status=400)
 
-                # Update progress in session after each chunk
-                request.session['progress'] = int((i / total_chunks) * 100)
-                request.session.modified = True
+            # The file is no longer needed once it is in the database
+            os.remove(upload_path)
+            request.session.pop('upload_path', None)
 
             # Mark completion and return success message with count of records uploaded
-            request.session['progress'] = 100
+            set_upload_progress(upload_key, 100)
             return JsonResponse({'status': 'success', 'message': f'{success_count} records successfully uploaded.'})
 
         except Exception as e:
             return JsonResponse({'status': 'error', 'message': f"Unexpected error: {str(e)}"}, status=500)
-        
-    def clean_data(self, df):
-        """
-        Cleans the DataFrame by applying various data cleaning steps.
-        """
-        # Remove leading and trailing spaces from all string columns
-        for column in df.select_dtypes(include=['object']).columns:
-            df[column] = df[column].str.strip()
-
-        # Trim whitespace and normalize spaces between words
-        for column in df.select_dtypes(include=['object']).columns:
-            df[column] = df[column].str.strip().str.replace(r'\s+', ' ', regex=True)
-
-        # Convert all text to uppercase
-        for column in df.select_dtypes(include=['object']).columns:
-            df[column] = df[column].str.upper()
-        # Additional cleaning steps can be added here, such as:
-        df.dropna(how='all', inplace=True)  # Drop rows where all values are NaN
-        # Drop duplicates
-        df.drop_duplicates(inplace=True)
-
-        return df
+
 class CheckProgressView(LoginRequiredMixin, View):
     def get(self, request):
-        progress = request.session.get('progress', 0)
+        progress = get_upload_progress(request.session.session_key)
         return JsonResponse({'progress': progress})
     
 
@@ -756,63 +725,87 @@ def filter_table(request):
     })
 
 
+def export_response(request, table_name, queryset, columns, parameters, filename):
+    """
+    Send queryset as a CSV or XLSX download (?format=csv|xlsx).
+
+    CSV is streamed from a server-side cursor and XLSX is written by a write-only workbook, so
+    memory stays flat whatever the size. Extracts larger than EXPORT_BACKGROUND_ROW_THRESHOLD, or
+    requested with ?background=1, become an ExportJob and the response describes how to follow it.
+    """
+    export_format = 'xlsx' if request.GET.get('format') == 'xlsx' else 'csv'
+
+    if request.GET.get('background') or queryset.count() > EXPORT_BACKGROUND_ROW_THRESHOLD:
+        job = start_export_job(table_name, export_format, parameters, request.user)
+        return JsonResponse({
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': reverse('export_job_status', args=[job.id]),
+            'download_url': reverse('download_export_job', args=[job.id]),
+        }, status=202)
+
+    rows = iter_export_rows(queryset, columns)
+    if export_format == 'xlsx':
+        return FileResponse(
+            xlsx_temp_file(columns, rows, table_name),
+            as_attachment=True,
+            filename=f"{filename}.xlsx",
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        )
+
+    response = StreamingHttpResponse(stream_csv(columns, rows), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
+
+
 @login_required
 def download_data(request, table_name):
     try:
         # Get the model class dynamically using the table name
         model_class = apps.get_model('IFRS9', table_name)
-        data = model_class.objects.all()
-
-        # Handle filtering via GET parameters
-        filter_column = request.GET.get('filter_column')
-        filter_values = request.GET.get('filter_values')
-
-        if filter_column and filter_values:
-            filter_values_list = filter_values.split(',')
 
-            # Filter out any unwanted values like "on" or "Select All"
-            filter_values_list = [value for value in filter_values_list if value not in ["on", "(Select All)"]]
-
-            # Prepare a Q object to combine multiple conditions
-            filters = Q()
-
-            # If "None" is selected, add an isnull filter
-            if "None" in filter_values_list:
-                filter_values_list.remove("None")
-                filters |= Q(**{f"{filter_column}__isnull": True})
+        # Same filters as the view-data page: reporting date, column filter and sort order
+        parameters = {
+            'fic_mis_date': request.GET.get('fic_mis_date'),
+            'filter_column': request.GET.get('filter_column'),
+            'filter_values': request.GET.get('filter_values'),
+            'sort_order': request.GET.get('sort_order'),
+        }
+        data, columns = build_export_queryset(model_class, parameters)
 
-            # If there are other values selected, add the in filter
-            if filter_values_list:
-                filters |= Q(**{f"{filter_column}__in": filter_values_list})
+        return export_response(request, table_name, data, columns, parameters, table_name)
 
-            # Apply the combined filter to the data
-            data = data.filter(filters)
+    except LookupError:
+        messages.error(request, "Error: The selected table does not exist.")
+        return redirect('view_data')
 
-        # Handle sorting via GET parameters
-        sort_order = request.GET.get('sort_order')
-        if filter_column and sort_order:
-            if sort_order == 'asc':
-                data = data.order_by(filter_column)
-            elif sort_order == 'desc':
-                data = data.order_by(f'-{filter_column}')
 
-        # Create the HTTP response object with the appropriate CSV header.
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename="{table_name}.csv"'
+def get_export_job(request, job_id):
+    """ExportJob requested by the current user (any job for superusers), else 404."""
+    jobs = ExportJob.objects.all() if request.user.is_superuser else ExportJob.objects.filter(created_by=request.user)
+    return get_object_or_404(jobs, id=job_id)
 
-        writer = csv.writer(response)
-        # Write the headers
-        writer.writerow([field.name for field in model_class._meta.fields])
 
-        # Write the data rows
-        for item in data:
-            writer.writerow([getattr(item, field.name) for field in model_class._meta.fields])
+@login_required
+def export_job_status(request, job_id):
+    job = get_export_job(request, job_id)
+    return JsonResponse({
+        'job_id': job.id,
+        'table_name': job.table_name,
+        'status': job.status,
+        'rows_written': job.rows_written,
+        'total_rows': job.total_rows,
+        'percent': round(job.rows_written / job.total_rows * 100, 1) if job.total_rows else None,
+        'error_message': job.error_message,
+    })
 
-        return response
 
-    except LookupError:
-        messages.error(request, "Error: The selected table does not exist.")
-        return redirect('view_data')
+@login_required
+def download_export_job(request, job_id):
+    job = get_export_job(request, job_id)
+    if job.status != 'Success' or not job.file_path or not os.path.exists(job.file_path):
+        return HttpResponse(f"Export is not available (status: {job.status}).", status=404)
+    return FileResponse(open(job.file_path, 'rb'), as_attachment=True, filename=os.path.basename(job.file_path))
 
 
 @login_required
@@ -2173,37 +2166,64 @@ def download_report(request):
    
 
     # Validate filters
-    if not fic_mis_date or not n_run_key:
-        return HttpResponse("Both Reporting Date and Run Key are required.", status=400)
+    if not fic_mis_date:
+        return HttpResponse("Reporting Date is required.", status=400)
 
     # Apply filters to fetch data
-    filters = {'fic_mis_date': fic_mis_date,}
     try:
         report_config = ReportColumnConfig.objects.get(report_name="default_report")
         selected_columns = report_config.selected_columns
     except ReportColumnConfig.DoesNotExist:
         return HttpResponse("Report configuration not found.", status=404)
 
-    report_data = FCT_Reporting_Lines.objects.filter(**filters).values(*selected_columns)
+    parameters = {'fic_mis_date': fic_mis_date, 'columns': selected_columns}
+    report_data, columns = build_export_queryset(FCT_Reporting_Lines, parameters)
     if not report_data.exists():
         return HttpResponse("No data found for the selected filters.", status=404)
 
-    # Create CSV response
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="filtered_report.csv"'
-    writer = csv.writer(response)
-    writer.writerow(selected_columns)
+    return export_response(request, 'FCT_Reporting_Lines', report_data, columns, parameters, "filtered_report")
 
-    for row in report_data:
-        writer.writerow([row[column] for column in selected_columns])
 
-    return response
+############################################
 
+# Amount columns of the ECL summary report and the sub-filters applied to it
+ECL_SUMMARY_MEASURES = ['n_exposure_at_default_ncy', 'n_exposure_at_default_rcy', 'n_12m_ecl_rcy', 'n_lifetime_ecl_rcy']
+ECL_SUMMARY_SUB_FILTERS = ['n_prod_segment', 'n_prod_type', 'n_stage_descr', 'n_loan_type']
 
-############################################
 
-# Directory to save the CSV files
-CSV_DIR = os.path.join(os.getcwd(), 'csv_files')
+def get_report_run_key(fic_mis_date, n_run_key=None):
+    """
+    Run key selected on a report filter form, defaulting to the latest run of fic_mis_date.
+    """
+    if not n_run_key:
+        n_run_key = FCT_Reporting_Lines.objects.filter(fic_mis_date=fic_mis_date).aggregate(Max('n_run_key'))['n_run_key__max']
+    return int(n_run_key) if n_run_key else None
+
+
+def summarize_ecl_rows(queryset, group_by_field, account_count):
+    """
+    Group queryset by group_by_field, summing the ECL amounts. account_count is the aggregate used
+    for the number of accounts. Rows come back as JSON-serialisable dicts so they can be kept in
+    the session for the Excel export.
+    """
+    annotations = {f'total_{measure}': Sum(measure) for measure in ECL_SUMMARY_MEASURES}
+    annotations['total_accounts'] = account_count
+    rows = (
+        queryset.filter(**{f'{group_by_field}__isnull': False})
+        .values(group_by_field)
+        .annotate(**annotations)
+        .order_by(group_by_field)
+    )
+
+    grouped_data = []
+    for row in rows:
+        record = {group_by_field: row[group_by_field]}
+        for measure in ECL_SUMMARY_MEASURES:
+            record[measure] = float(row[f'total_{measure}'] or 0)
+        record['n_account_number'] = int(row['total_accounts'] or 0)
+        grouped_data.append(record)
+    return grouped_data
+
 
 @login_required
 @require_http_methods(["GET", "POST"])
@@ -2212,33 +2232,13 @@ def ecl_main_filter_view(request):
     if request.method == 'POST':
         # Retrieve selected Reporting Date and Run Key from the form
         fic_mis_date = request.POST.get('fic_mis_date')
- 
-        
+        n_run_key = request.POST.get('n_run_key')
+
         if fic_mis_date :
-            # Store the selected filter values in session for later use
+            # Store the selected filter values in session for later use; account counts are only
+            # additive within one run, so the latest run is used when none is selected
             request.session['fic_mis_date'] = fic_mis_date
-            
-
-            # Retrieve filtered data based on the selected main filter values
-            ecl_data = FCT_Reporting_Lines.objects.filter(fic_mis_date=fic_mis_date)
-
-            # Convert the filtered data into a DataFrame
-            ecl_data_df = pd.DataFrame(list(ecl_data.values()))
-
-            # Convert date fields to strings
-            if 'fic_mis_date' in ecl_data_df.columns:
-                ecl_data_df['fic_mis_date'] = ecl_data_df['fic_mis_date'].astype(str)
-            if 'd_maturity_date' in ecl_data_df.columns:
-                ecl_data_df['d_maturity_date'] = ecl_data_df['d_maturity_date'].astype(str)
-
-            # Create the directory if it doesn't exist
-            if not os.path.exists(CSV_DIR):
-                os.makedirs(CSV_DIR)
-
-            # Save the data as a CSV file in the session (store the filename)
-            csv_filename = os.path.join(CSV_DIR, f"ecl_data_{fic_mis_date}.csv")
-            ecl_data_df.to_csv(csv_filename, index=False)
-            request.session['csv_filename'] = csv_filename
+            request.session['n_run_key'] = get_report_run_key(fic_mis_date, n_run_key)
 
             # Redirect to the sub-filter view
             return redirect('ecl_sub_filter_view')
@@ -2265,57 +2265,46 @@ def ecl_main_filter_view(request):
 @login_required
 @require_http_methods(["GET", "POST"])
 def ecl_sub_filter_view(request):
-    # Retrieve the CSV filename from the session
-    csv_filename = request.session.get('csv_filename')
+    # Retrieve the main filter values from the session
+    fic_mis_date = request.session.get('fic_mis_date')
+    n_run_key = request.session.get('n_run_key')
 
     # If no data is available, redirect to the main filter page
-    if not csv_filename or not os.path.exists(csv_filename):
+    if not fic_mis_date:
         return redirect('ecl_main_filter_view')
 
-    # Load the data from the CSV file
-    ecl_data_df = pd.read_csv(csv_filename)
-
-    # Retrieve sub-filter form fields from the request
-    n_prod_segment = request.GET.get('n_prod_segment')
-    n_prod_type = request.GET.get('n_prod_type')
-    n_stage_descr = request.GET.get('n_stage_descr')
-    n_loan_type = request.GET.get('n_loan_type')
+    # The report is answered from the pre-aggregated cube; build it if the run was never summarised
+    main_filters = {'fic_mis_date': fic_mis_date, 'n_run_key': n_run_key}
+    cube_data = FCT_ECL_Summary_Cube.objects.filter(**main_filters)
+    if not cube_data.exists():
+        try:
+            refresh_ecl_summary_cube(fic_mis_date, n_run_key)
+        except Exception as e:
+            messages.error(request, f"Unable to build the ECL summary for {fic_mis_date}: {e}")
+            return redirect('ecl_main_filter_view')
 
     # Apply sub-filters if provided
-    if n_prod_segment:
-        ecl_data_df = ecl_data_df[ecl_data_df['n_prod_segment'] == n_prod_segment]
-    if n_prod_type:
-        ecl_data_df = ecl_data_df[ecl_data_df['n_prod_type'] == n_prod_type]
-    if n_stage_descr:
-        ecl_data_df = ecl_data_df[ecl_data_df['n_stage_descr'] == n_stage_descr]
-    if n_loan_type:
-        ecl_data_df = ecl_data_df[ecl_data_df['n_loan_type'] == n_loan_type]
+    sub_filters = {field: request.GET.get(field) for field in ECL_SUMMARY_SUB_FILTERS if request.GET.get(field)}
+    cube_data = cube_data.filter(**sub_filters)
 
     # Retrieve the selected group by field from the request (GET or POST)
     group_by_field = request.GET.get('group_by_field', 'n_stage_descr')  # Default group by 'n_stage_descr'
 
     # Group the data by the selected field and sum the amounts, while also counting unique accounts
-    grouped_data = (
-        ecl_data_df.groupby(group_by_field)
-        .agg({
-            'n_exposure_at_default_ncy': 'sum',
-            'n_exposure_at_default_rcy': 'sum',
-            'n_12m_ecl_rcy': 'sum',
-            'n_lifetime_ecl_rcy': 'sum',
-            'n_account_number': pd.Series.nunique,  # Count unique accounts in each group
-        })
-        .reset_index()
-        .to_dict(orient='records')
-    )
+    if group_by_field in CUBE_DIMENSIONS:
+        grouped_data = summarize_ecl_rows(cube_data, group_by_field, Sum('n_account_count'))
+    else:
+        # Not a cube dimension: aggregate the reporting lines in the database instead
+        ecl_data = FCT_Reporting_Lines.objects.filter(**main_filters, **sub_filters)
+        grouped_data = summarize_ecl_rows(ecl_data, group_by_field, Count('n_account_number', distinct=True))
 
     # Calculate grand totals
-    grand_totals = {
-        'n_exposure_at_default_ncy': ecl_data_df['n_exposure_at_default_ncy'].sum(),
-        'n_exposure_at_default_rcy': ecl_data_df['n_exposure_at_default_rcy'].sum(),
-        'n_12m_ecl_rcy': ecl_data_df['n_12m_ecl_rcy'].sum(),
-        'n_lifetime_ecl_rcy': ecl_data_df['n_lifetime_ecl_rcy'].sum(),
-        'n_account_number': ecl_data_df['n_account_number'].nunique(),  # Grand total for unique accounts
-    }
+    totals = cube_data.aggregate(
+        **{measure: Sum(measure) for measure in ECL_SUMMARY_MEASURES},
+        n_account_number=Sum('n_account_count'),
+    )
+    grand_totals = {measure: float(totals[measure] or 0) for measure in ECL_SUMMARY_MEASURES}
+    grand_totals['n_account_number'] = int(totals['n_account_number'] or 0)  # Grand total for unique accounts
 
     # Calculate percentages for the second table
     grouped_data_percentages = []
@@ -2332,10 +2321,13 @@ def ecl_sub_filter_view(request):
         })
 
     # Distinct values for sub-filters
-    distinct_prod_segments = list(ecl_data_df['n_prod_segment'].unique())
-    distinct_prod_types = list(ecl_data_df['n_prod_type'].unique())
-    distinct_stage_descrs = list(ecl_data_df['n_stage_descr'].unique())
-    distinct_loan_types = list(ecl_data_df['n_loan_type'].unique())
+    def distinct_values(field):
+        return list(cube_data.order_by(field).values_list(field, flat=True).distinct())
+
+    distinct_prod_segments = distinct_values('n_prod_segment')
+    distinct_prod_types = distinct_values('n_prod_type')
+    distinct_stage_descrs = distinct_values('n_stage_descr')
+    distinct_loan_types = distinct_values('n_loan_type')
 
     # Store the grouped data and grand totals in the session for Excel export
     request.session['grouped_data'] = grouped_data
@@ -2451,7 +2443,13 @@ def style_excel_sheet(ws, data_row_count, headers):
 
 
 
-CSV_DIR = os.path.join(os.getcwd(), 'csv_files')
+# Reporting line columns read by the reconciliation report
+RECONCILIATION_COLUMNS = [
+    'fic_mis_date', 'n_run_key', 'n_account_number', 'n_stage_descr', 'v_ccy_code', 'n_prod_segment',
+    'n_prod_type', 'n_loan_type', 'n_exposure_at_default_ncy', 'n_exposure_at_default_rcy',
+    'n_12m_ecl_rcy', 'n_lifetime_ecl_rcy',
+]
+
 @login_required
 @require_http_methods(["GET", "POST"])
 def ecl_reconciliation_main_filter_view(request):
@@ -2462,9 +2460,9 @@ def ecl_reconciliation_main_filter_view(request):
     if request.method == 'POST':
         # Retrieve selected Reporting Dates and Run Keys from the form
         fic_mis_date1 = request.POST.get('fic_mis_date1')
-      
+        n_run_key1 = request.POST.get('n_run_key1')
         fic_mis_date2 = request.POST.get('fic_mis_date2')
-       
+        n_run_key2 = request.POST.get('n_run_key2')
 
         # Validate that both dates and run keys are provided
         if not fic_mis_date1:
@@ -2476,40 +2474,12 @@ def ecl_reconciliation_main_filter_view(request):
 
         # If there are no errors, proceed to filtering
         if not errors:
-            # Store the selected filter values in session for later use
+            # Store the selected filter values in session; the data itself is read from the
+            # shared snapshot cache by the sub-filter view
             request.session['fic_mis_date1'] = fic_mis_date1
-        
+            request.session['n_run_key1'] = get_report_run_key(fic_mis_date1, n_run_key1)
             request.session['fic_mis_date2'] = fic_mis_date2
-      
-
-            # Retrieve filtered data based on the selected main filter values
-            ecl_data1 = FCT_Reporting_Lines.objects.filter(fic_mis_date=fic_mis_date1)
-            ecl_data2 = FCT_Reporting_Lines.objects.filter(fic_mis_date=fic_mis_date2)
-
-            # Convert the filtered data into a DataFrame
-            ecl_data1_df = pd.DataFrame(list(ecl_data1.values()))
-            ecl_data2_df = pd.DataFrame(list(ecl_data2.values()))
-
-            # Convert date fields to strings for both DataFrames
-            for df in [ecl_data1_df, ecl_data2_df]:
-                if 'fic_mis_date' in df.columns:
-                    df['fic_mis_date'] = df['fic_mis_date'].astype(str)
-                if 'd_maturity_date' in df.columns:
-                    df['d_maturity_date'] = df['d_maturity_date'].astype(str)
-
-            # Create the directory if it doesn't exist
-            if not os.path.exists(CSV_DIR):
-                os.makedirs(CSV_DIR)
-
-            # Save the data as CSV files in the session (store the filenames)
-            csv_filename1 = os.path.join(CSV_DIR, f"ecl_data_{fic_mis_date1}.csv")
-            csv_filename2 = os.path.join(CSV_DIR, f"ecl_data_{fic_mis_date2}.csv")
-            
-            ecl_data1_df.to_csv(csv_filename1, index=False)
-            ecl_data2_df.to_csv(csv_filename2, index=False)
-            # Store the filenames in the session and explicitly mark the session as modified
-            request.session['csv_filename1'] = csv_filename1
-            request.session['csv_filename2'] = csv_filename2
+            request.session['n_run_key2'] = get_report_run_key(fic_mis_date2, n_run_key2)
             request.session.modified = True
             # Redirect to the sub-filter view
             return redirect('ecl_reconciliation_sub_filter_view')
@@ -2538,21 +2508,17 @@ def ecl_reconciliation_main_filter_view(request):
 @login_required
 @require_http_methods(["GET", "POST"])
 def ecl_reconciliation_sub_filter_view(request):
-    # Retrieve the CSV filenames from the session
-    csv_filename_1 = request.session.get('csv_filename1')
-    csv_filename_2 = request.session.get('csv_filename2')
+    # Retrieve the selected dates and run keys from the session
+    fic_mis_date1 = request.session.get('fic_mis_date1')
+    fic_mis_date2 = request.session.get('fic_mis_date2')
 
-    # Check if the CSV files exist and display error if missing
+    # Check that both datasets were selected and display error if missing
     errors = []
-    if not csv_filename_1:
+    if not fic_mis_date1:
         errors.append('The first dataset is missing. Please select a valid Reporting Date 1 and Run Key 1.')
-    elif not os.path.exists(csv_filename_1):
-        errors.append(f"The file for Reporting Date 1 does not exist: {csv_filename_1}")
     
-    if not csv_filename_2:
+    if not fic_mis_date2:
         errors.append('The second dataset is missing. Please select a valid Reporting Date 2 and Run Key 2.')
-    elif not os.path.exists(csv_filename_2):
-        errors.append(f"The file for Reporting Date 2 does not exist: {csv_filename_2}")
 
     # If there are any errors, display them and do not proceed further
     if errors:
@@ -2560,9 +2526,9 @@ def ecl_reconciliation_sub_filter_view(request):
             messages.error(request, error)
         return render(request, 'reports/ecl_reconciliation_report_sub.html', {'errors': errors})
 
-    # Load the data from the CSV files
-    ecl_data_df_1 = pd.read_csv(csv_filename_1)
-    ecl_data_df_2 = pd.read_csv(csv_filename_2)
+    # Load only the columns the reconciliation needs from the snapshot cache
+    ecl_data_df_1 = load_reporting_lines_snapshot(fic_mis_date1, request.session.get('n_run_key1'), RECONCILIATION_COLUMNS)
+    ecl_data_df_2 = load_reporting_lines_snapshot(fic_mis_date2, request.session.get('n_run_key2'), RECONCILIATION_COLUMNS)
 
     # Determine which dataframe has the higher and lower date based on fic_mis_date
     if ecl_data_df_1['fic_mis_date'].max() > ecl_data_df_2['fic_mis_date'].max():
@@ -2927,7 +2893,11 @@ def style_excel_sheet(ws, data_row_count, headers):
             adjusted_width = (max_length + 2)
             ws.column_dimensions[column_letter].width = adjusted_width
 
-CSV_DIR = os.path.join(os.getcwd(), 'csv_files')
+# Reporting line columns read by the waterfall report
+WATERFALL_COLUMNS = [
+    'fic_mis_date', 'n_account_number', 'n_stage_descr', 'n_prod_segment', 'n_exposure_at_default_rcy',
+    'n_twelve_months_pd', 'n_lifetime_pd', 'n_lgd_percent', 'n_12m_ecl_rcy', 'n_lifetime_ecl_rcy',
+]
 
 
 
@@ -2940,9 +2910,9 @@ def water_fall_main_filter_view(request):
     if request.method == 'POST':
         # Retrieve selected Reporting Dates and Run Keys from the form
         fic_mis_date1 = request.POST.get('fic_mis_date1')
-      
+        n_run_key1 = request.POST.get('n_run_key1')
         fic_mis_date2 = request.POST.get('fic_mis_date2')
-       
+        n_run_key2 = request.POST.get('n_run_key2')
 
         # Validate that both dates and run keys are provided
         if not fic_mis_date1:
@@ -2955,39 +2925,9 @@ def water_fall_main_filter_view(request):
         # If no errors, proceed with filter
         if not errors:
             request.session['fic_mis_date1'] = fic_mis_date1
+            request.session['n_run_key1'] = get_report_run_key(fic_mis_date1, n_run_key1)
             request.session['fic_mis_date2'] = fic_mis_date2
-
-            # Retrieve filtered data based on the selected main filter values
-            ecl_data1 = FCT_Reporting_Lines.objects.filter(fic_mis_date=fic_mis_date1)
-            ecl_data2 = FCT_Reporting_Lines.objects.filter(fic_mis_date=fic_mis_date2)
-
-            # Convert the filtered data into a DataFrame
-            ecl_data1_df = pd.DataFrame(list(ecl_data1.values()))
-            ecl_data2_df = pd.DataFrame(list(ecl_data2.values()))
-
-            # Ensure both DataFrames use the same set of account numbers
-            common_account_numbers = set(ecl_data1_df['n_account_number']).intersection(ecl_data2_df['n_account_number'])
-            ecl_data1_df = ecl_data1_df[ecl_data1_df['n_account_number'].isin(common_account_numbers)]
-            ecl_data2_df = ecl_data2_df[ecl_data2_df['n_account_number'].isin(common_account_numbers)]
-
-            # Convert date fields to strings for both DataFrames
-            for df in [ecl_data1_df, ecl_data2_df]:
-                if 'fic_mis_date' in df.columns:
-                    df['fic_mis_date'] = df['fic_mis_date'].astype(str)
-                if 'd_maturity_date' in df.columns:
-                    df['d_maturity_date'] = df['d_maturity_date'].astype(str)
-
-            # Create the directory if it doesn't exist
-            if not os.path.exists(CSV_DIR):
-                os.makedirs(CSV_DIR)
-
-            # Save the data as CSV files in the session
-            csv_filename1 = os.path.join(CSV_DIR, f"ecl_data_{fic_mis_date1}.csv")
-            csv_filename2 = os.path.join(CSV_DIR, f"ecl_data_{fic_mis_date2}.csv")
-            ecl_data1_df.to_csv(csv_filename1, index=False)
-            ecl_data2_df.to_csv(csv_filename2, index=False)
-            request.session['csv_filename1'] = csv_filename1
-            request.session['csv_filename2'] = csv_filename2
+            request.session['n_run_key2'] = get_report_run_key(fic_mis_date2, n_run_key2)
             request.session.modified = True
 
             # Redirect to the sub-filter view
@@ -3016,15 +2956,17 @@ def water_fall_main_filter_view(request):
 @login_required
 @require_http_methods(["GET", "POST"])
 def water_fall_sub_filter_view(request):
-    # Retrieve CSV filenames from the session
-    csv_filename_1 = request.session.get('csv_filename1')
-    csv_filename_2 = request.session.get('csv_filename2')
+    # Retrieve the selected dates from the session
+    fic_mis_date1 = request.session.get('fic_mis_date1')
+    fic_mis_date2 = request.session.get('fic_mis_date2')
+    if not fic_mis_date1 or not fic_mis_date2:
+        return redirect('ecl_water_fall_reconciliation_main_filter')
 
-    # Load CSV files into DataFrames
-    ecl_data_df_1 = pd.read_csv(csv_filename_1)
-    ecl_data_df_2 = pd.read_csv(csv_filename_2)
+    # Load only the columns the waterfall needs from the snapshot cache
+    ecl_data_df_1 = load_reporting_lines_snapshot(fic_mis_date1, request.session.get('n_run_key1'), WATERFALL_COLUMNS)
+    ecl_data_df_2 = load_reporting_lines_snapshot(fic_mis_date2, request.session.get('n_run_key2'), WATERFALL_COLUMNS)
 
-    # Merge data based on account number using an inner join
+    # Merge data based on account number using an inner join (keeps the accounts present on both dates)
     merged_data = pd.merge(
         ecl_data_df_1,
         ecl_data_df_2,
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from ...Functions.cooling_period import COOLING_FIXTURE, compare_cooling_period_engines, get_cooling_fixture_dates
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the set-based cooling period update and the per-account logic on a multi-month "
+        "fixture and report where they differ. Nothing is kept in the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--cooling-period-days',
+            type=int,
+            default=60,
+            help='Cooling period of the fixture definition, in days (default: 60)'
+        )
+
+    def handle(self, *args, **options):
+        dates = get_cooling_fixture_dates()
+        try:
+            differences = compare_cooling_period_engines(options['cooling_period_days'])
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f"Cooling period check failed: {e}"))
+            return
+
+        if not differences:
+            self.stdout.write(self.style.SUCCESS(
+                f"Both engines agree on {len(COOLING_FIXTURE) * 2} accounts over {len(dates)} months "
+                f"({dates[0]} to {dates[-1]})."
+            ))
+            return
+
+        for account_number, fic_mis_date, field, set_based_value, per_account_value in differences:
+            self.stdout.write(
+                f"{account_number} {fic_mis_date} {field}: {set_based_value} set-based, {per_account_value} per account"
+            )
+        self.stdout.write(self.style.ERROR(f"{len(differences)} differences between the two engines."))
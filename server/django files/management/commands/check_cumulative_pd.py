@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from ...Functions.cal_provision_matrix_rating import CUMULATIVE_RATING_PD_FIXTURE, check_cumulative_rating_pd
+
+
+class Command(BaseCommand):
+    help = (
+        "Check the rating cumulative PD solver against the pinned values of a rating chain "
+        "(CUMULATIVE_RATING_PD_FIXTURE). No database access."
+    )
+
+    def handle(self, *args, **options):
+        differences = check_cumulative_rating_pd()
+        if not differences:
+            rating_order, _, expected = CUMULATIVE_RATING_PD_FIXTURE
+            self.stdout.write(self.style.SUCCESS(
+                "Cumulative PDs match: " + ', '.join(f"{rating}={pd_value}" for rating, pd_value in zip(rating_order, expected))
+            ))
+            return
+
+        for rating, expected, computed in differences:
+            self.stdout.write(f"{rating}: expected {expected}, computed {computed}")
+        self.stdout.write(self.style.ERROR(f"{len(differences)} ratings differ from the pinned cumulative PDs."))
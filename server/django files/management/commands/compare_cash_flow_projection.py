@@ -0,0 +1,50 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from ...Functions.cashflow import compare_cash_flow_projections
+
+
+class Command(BaseCommand):
+    help = (
+        "Project the expected cash flows of a reporting date with both the per-loan and the batch "
+        "engine and report every row where they differ. Leaves the batch output in fsi_expected_cashflow."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'fic_mis_date',
+            type=str,
+            help='Reporting date in YYYY-MM-DD format'
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.0,
+            help='Largest accepted absolute difference between amounts (default: 0)'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=50,
+            help='Number of differences printed (default: 50)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            fic_mis_date = datetime.strptime(options['fic_mis_date'], '%Y-%m-%d').date()
+        except ValueError:
+            self.stdout.write(self.style.ERROR("fic_mis_date must be in YYYY-MM-DD format."))
+            return
+
+        differences = compare_cash_flow_projections(fic_mis_date, options['tolerance'])
+        if differences is None:
+            self.stdout.write(self.style.ERROR("A projection failed; see the function logs."))
+            return
+        if not differences:
+            self.stdout.write(self.style.SUCCESS(f"The two projections match for {fic_mis_date}."))
+            return
+
+        for account_number, bucket, description in differences[:options['limit']]:
+            self.stdout.write(f"{account_number} bucket {bucket}: {description}")
+        self.stdout.write(self.style.ERROR(
+            f"{len(differences)} differences between the per-loan and the batch projection for {fic_mis_date}."
+        ))
@@ -0,0 +1,78 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from ...Functions.run_partitions import (
+    PARTITIONED_TABLES,
+    is_partitioned,
+    partition_table,
+    prune_run_partitions,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Convert fsi_financial_cash_flow_cal and fct_reporting_lines into tables partitioned by "
+        "fic_mis_date and run key, moving the existing data, or prune old run partitions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table',
+            choices=sorted(PARTITIONED_TABLES),
+            action='append',
+            help='Table to process (default: all run tables)'
+        )
+        parser.add_argument(
+            '--keep-old',
+            action='store_true',
+            help='Keep the original table as <table>_unpartitioned after migrating'
+        )
+        parser.add_argument(
+            '--prune',
+            type=int,
+            metavar='KEEP_RUNS',
+            help='Instead of migrating, keep only the KEEP_RUNS latest runs of --fic-mis-date'
+        )
+        parser.add_argument(
+            '--fic-mis-date',
+            type=str,
+            help='Reporting date in YYYY-MM-DD format (required with --prune)'
+        )
+        parser.add_argument(
+            '--detach',
+            action='store_true',
+            help='With --prune, detach old run partitions instead of dropping them'
+        )
+
+    def handle(self, *args, **options):
+        tables = options['table'] or sorted(PARTITIONED_TABLES)
+
+        if options['prune'] is not None:
+            try:
+                fic_mis_date = datetime.strptime(options['fic_mis_date'] or '', '%Y-%m-%d').date()
+            except ValueError:
+                self.stdout.write(self.style.ERROR("--prune requires --fic-mis-date in YYYY-MM-DD format."))
+                return
+
+            for table_name in tables:
+                if not is_partitioned(table_name):
+                    self.stdout.write(self.style.WARNING(f"{table_name} is not partitioned; skipped."))
+                    continue
+                removed = prune_run_partitions(table_name, fic_mis_date, options['prune'], options['detach'])
+                action = 'Detached' if options['detach'] else 'Dropped'
+                self.stdout.write(self.style.SUCCESS(
+                    f"{action} {len(removed)} run partitions of {table_name}: {', '.join(removed) or 'none'}."
+                ))
+            return
+
+        for table_name in tables:
+            if is_partitioned(table_name):
+                self.stdout.write(f"{table_name} is already partitioned; skipped.")
+                continue
+
+            self.stdout.write(f"Partitioning {table_name}...")
+            try:
+                moved_count = partition_table(table_name, keep_old=options['keep_old'])
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"Failed to partition {table_name}: {e}"))
+                return
+            self.stdout.write(self.style.SUCCESS(f"Partitioned {table_name}: moved {moved_count} rows."))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...Functions.cal_provision_matrix import provision_matrix
+from ...Functions.cal_provision_matrix_rating import provision_matrix_w_ratings
+
+
+class Command(BaseCommand):
+    help = (
+        "Clear the transition history (counts, flow rates and cumulative PD) of the historical date "
+        "range and recount every period pair, instead of only the new or changed ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fic-mis-date',
+            type=str,
+            required=True,
+            help='Reporting date in YYYY-MM-DD format'
+        )
+        parser.add_argument(
+            '--basis',
+            choices=['D', 'R'],
+            action='append',
+            help="History to rebuild: 'D' delinquency bands, 'R' credit ratings (default: both)"
+        )
+
+    def handle(self, *args, **options):
+        runners = {'D': provision_matrix, 'R': provision_matrix_w_ratings}
+        for basis in options['basis'] or ['D', 'R']:
+            if runners[basis](options['fic_mis_date'], full_rebuild=True) != 1:
+                raise CommandError(f"Rebuilding the {basis} transition history failed; see the logs.")
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt the {basis} transition history."))
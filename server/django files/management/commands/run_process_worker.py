@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from ...Functions.process_jobs import get_worker_id, run_worker
+from ...views import execute_functions_in_background
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued process executions outside the web server. Several workers may run at once; "
+        "a run whose worker stops is resumed by another one after its lease expires."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--worker-id',
+            type=str,
+            help='Name of this worker in dim_process_job (default: host:pid)'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run at most one queued job and exit'
+        )
+        parser.add_argument(
+            '--poll-seconds',
+            type=float,
+            help='Seconds between two polls for queued jobs (default: PROCESS_JOB_POLL_SECONDS)'
+        )
+
+    def handle(self, *args, **options):
+        worker_id = options['worker_id'] or get_worker_id()
+        self.stdout.write(f"Process worker {worker_id} started.")
+        try:
+            run_worker(
+                execute_functions_in_background,
+                worker_id=worker_id,
+                once=options['once'],
+                poll_seconds=options['poll_seconds'],
+            )
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING(f"Process worker {worker_id} stopped."))
@@ -21,6 +21,8 @@ urlpatterns = [
     path('view-data/', view_data, name='view_data'),
     path('filter-table/', filter_table, name='filter_table'),
     path('download-data/<str:table_name>/', download_data, name='download_data'),
+    path('export-jobs/<int:job_id>/status/', export_job_status, name='export_job_status'),
+    path('export-jobs/<int:job_id>/download/', download_export_job, name='download_export_job'),
     path('edit-row/<str:table_name>/<int:row_id>/', edit_row, name='edit_row'),
     path('delete-row/<str:table_name>/<int:row_id>/', delete_row, name='delete_row'),
 
@@ -123,6 +125,8 @@ urlpatterns = [
     path('get-updated-status-table/', views.get_updated_status_table, name='get_updated_status_table'),
     path('running-processes/', running_processes_view, name='running_processes'),
     path('cancel-process/<str:process_run_id>/', cancel_running_process, name='cancel_running_process'),
+    path('resume-process/<str:process_run_id>/', resume_process_run, name='resume_process_run'),
+    path('process/metrics/<int:function_id>/', function_metrics_trend, name='function_metrics_trend'),
     
 
 